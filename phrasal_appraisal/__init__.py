@@ -1,4 +1,5 @@
 from pyramid.config import Configurator
+from pyramid.settings import asbool
 from pyramid.session import SignedCookieSessionFactory
 
 
@@ -12,6 +13,25 @@ def main(global_config, **settings):
     config.include('pyramid_chameleon')
     config.add_static_view('static', 'static', cache_max_age=3600)
     config.add_route('phrasal_form_view', '/')
+    config.add_route('phrase_batch_api', '/api/batch')
+    config.add_route('phrase_stream_api', '/api/stream')
+    config.add_route('phrase_count_api', '/api/count')
+    config.add_route('phrase_outputs_api', '/api/outputs')
+    config.add_route('phrase_jobs_api', '/api/jobs')
+    config.add_route('phrase_job_api', '/api/jobs/{job_id}')
+    config.add_route('phrase_job_result_api', '/api/jobs/{job_id}/result')
     config.add_static_view('deform_static', 'deform:static/')
+    # Timings and counts as plain text on /metrics, see metrics
+    if asbool(settings.get('metrics.enabled', True)):
+        config.include('.metrics')
     config.scan()
+    # Where phrase groups are kept, see phrase_backend
+    from .views import phrase_storage
+    phrase_storage.configure(settings)
+    # Where phrases are generated, see phrase_executor
+    from .phrase_executor import phrase_executor
+    phrase_executor.configure(settings)
+    # Background jobs, off unless there's somewhere to keep them
+    from .phrase_jobs import phrase_jobs
+    phrase_jobs.configure(settings)
     return config.make_wsgi_app()
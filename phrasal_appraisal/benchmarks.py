@@ -0,0 +1,328 @@
+import logging
+log = logging.getLogger(__name__)
+
+# Offline benchmarks for the phrase pipeline
+# Run with "python -m phrasal_appraisal.benchmarks", see --help.  Nothing
+# here needs the web app or network access.
+
+import argparse
+import math
+import random
+import sys
+import time
+import tracemalloc
+
+from collections import namedtuple
+
+from .phrase_groups import (
+    compile_phrase,
+    flatten_phrase,
+    make_work_budget,
+    process_phrase_part,
+    select_phrases,
+    tokenize_phrase
+)
+from .phrase_results import pack_phrase_results
+from .phrase_space import count_phrase_nodes
+from .phrase_storage import PhraseStorage
+
+# Largest phrase set the form accepts
+max_phrase_chars = 10000
+# Samples taken per run of the sampling stages
+default_sample_count = 200
+# Input sizes compared when checking scaling
+scaling_sizes = (1250, 10000)
+# Everything should be linear in the input size; allow for some noise
+max_scaling_exponent = 1.4
+
+StageResult = namedtuple(
+    'StageResult', ['corpus', 'stage', 'chars', 'seconds', 'alloc_bytes']
+)
+ScalingResult = namedtuple(
+    'ScalingResult', ['corpus', 'stage', 'exponent', 'passed']
+)
+
+# Pathological and typical phrase sets, each made to roughly a given size
+def repeat_to_size(piece, size):
+    # Whole pieces only, so brackets aren't cut in half
+    return piece * max(1, size // len(piece))
+
+def make_demo(size):
+    # The demo as-is, repeated as separate groups to reach the size
+    demo_source = PhraseStorage.get_demo_phrase_source()
+    return repeat_to_size(demo_source + "\n#\n", size)
+
+def make_deep_nesting(size):
+    depth = max(1, (size - 1) // 4)
+    return "{a|" * depth + "b" + "}" * depth
+
+def make_wide_alternation(size):
+    word_count = max(2, size // 7)
+    return "{" + "|".join(
+        "w{0:05d}".format(word_num) for word_num in range(word_count)
+    ) + "}"
+
+def make_escape_heavy(size):
+    return repeat_to_size("\\{a\\|b\\} \\\\ {c\\||\\}d} ", size)
+
+def make_many_groups(size):
+    return repeat_to_size("# Group\n{a|b} {c|d}\n", size)
+
+def make_unclosed_brackets(size):
+    # Every line falls back to plain text, with a warning
+    return repeat_to_size("{a|{b|c} d\n", size)
+
+def make_long_lines(size):
+    return repeat_to_size("{The|A} {quick|slow} brown {fox|dog} jumps. ", size)
+
+benchmark_corpus = (
+    ('demo', make_demo),
+    ('deep_nesting', make_deep_nesting),
+    ('wide_alternation', make_wide_alternation),
+    ('escape_heavy', make_escape_heavy),
+    ('many_groups', make_many_groups),
+    ('unclosed_brackets', make_unclosed_brackets),
+    ('long_lines', make_long_lines),
+)
+
+# Stages of the pipeline; each is given the phrase set and returns a
+# function that runs the stage once
+def prepare_tokenize(phrase_set, sample_count):
+    return lambda: list(tokenize_phrase(phrase_set))
+
+def prepare_compile(phrase_set, sample_count):
+    return lambda: compile_phrase(
+        [], make_work_budget('cli'), phrase_set
+    )
+
+def prepare_count(phrase_set, sample_count):
+    compiled_phrase = compile_phrase(
+        [], make_work_budget('cli'), phrase_set
+    )
+    return lambda: count_phrase_nodes(compiled_phrase)
+
+def prepare_select(phrase_set, sample_count):
+    compiled_phrase = compile_phrase(
+        [], make_work_budget('cli'), phrase_set
+    )
+    def run_select():
+        rng = random.Random('benchmark')
+        for _ in range(sample_count):
+            select_phrases(None, None, compiled_phrase, rng)
+    return run_select
+
+def prepare_pack(phrase_set, sample_count):
+    compiled_phrase = compile_phrase(
+        [], make_work_budget('cli'), phrase_set
+    )
+    chosen_phrases = select_phrases(
+        None, None, compiled_phrase, random.Random('benchmark')
+    )
+    return lambda: pack_phrase_results(chosen_phrases)
+
+def get_phrase_lines(phrase_set):
+    return [
+        phrase_line for phrase_line in phrase_set.replace('\r', '').split('\n')
+        if phrase_line.strip() and not phrase_line.startswith('#')
+    ]
+
+def prepare_parse_parts(phrase_set, sample_count):
+    phrase_lines = get_phrase_lines(phrase_set)
+    return lambda: [
+        process_phrase_part(
+            [], make_work_budget('cli'), phrase_line
+        )
+        for phrase_line in phrase_lines
+    ]
+
+def prepare_flatten(phrase_set, sample_count):
+    phrase_parts = [
+        process_phrase_part(
+            [], make_work_budget('cli'), phrase_line
+        )
+        for phrase_line in get_phrase_lines(phrase_set)
+    ]
+    def run_flatten():
+        rng = random.Random('benchmark')
+        for _ in range(sample_count):
+            for line_parts in phrase_parts:
+                flatten_phrase(line_parts, rng)
+    return run_flatten
+
+benchmark_stages = (
+    ('tokenize', prepare_tokenize),
+    ('compile', prepare_compile),
+    ('count', prepare_count),
+    ('select', prepare_select),
+    ('pack', prepare_pack),
+    ('parse_parts', prepare_parse_parts),
+    ('flatten', prepare_flatten),
+)
+
+def time_stage(run_stage, repeat):
+    # Best of a few runs, since anything slower is noise from elsewhere
+    best_seconds = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        run_stage()
+        run_seconds = time.perf_counter() - start_time
+        if best_seconds is None or run_seconds < best_seconds:
+            best_seconds = run_seconds
+    return best_seconds
+
+def measure_allocations(run_stage):
+    # Most memory held at once while running, above what was held before
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        start_size, _ = tracemalloc.get_traced_memory()
+        run_stage()
+        _, peak_size = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak_size - start_size
+
+def find_corpus(corpus_names):
+    if not corpus_names:
+        return benchmark_corpus
+    return tuple(
+        (corpus_name, make_phrase)
+        for corpus_name, make_phrase in benchmark_corpus
+        if corpus_name in corpus_names
+    )
+
+def find_stages(stage_names):
+    if not stage_names:
+        return benchmark_stages
+    return tuple(
+        (stage_name, prepare_stage)
+        for stage_name, prepare_stage in benchmark_stages
+        if stage_name in stage_names
+    )
+
+def run_benchmarks(
+        corpus_names = None, stage_names = None, size = max_phrase_chars,
+        repeat = 3, sample_count = default_sample_count, allocations = True):
+    # Yields a StageResult for every stage of every corpus entry
+    for corpus_name, make_phrase in find_corpus(corpus_names):
+        phrase_set = make_phrase(size)
+        for stage_name, prepare_stage in find_stages(stage_names):
+            run_stage = prepare_stage(phrase_set, sample_count)
+            alloc_bytes = None
+            if allocations:
+                alloc_bytes = measure_allocations(run_stage)
+            yield StageResult(
+                corpus_name, stage_name, len(phrase_set),
+                time_stage(run_stage, repeat), alloc_bytes
+            )
+
+def check_scaling(
+        corpus_names = None, stage_names = ('compile', 'select'),
+        sizes = scaling_sizes, repeat = 5,
+        sample_count = default_sample_count):
+    # Yields a ScalingResult with how run time grows against input size,
+    # as the exponent k in "time ~ size ** k"; linear stages are near 1
+    small_size, large_size = sizes
+    for corpus_name, make_phrase in find_corpus(corpus_names):
+        small_phrase = make_phrase(small_size)
+        large_phrase = make_phrase(large_size)
+        for stage_name, prepare_stage in find_stages(stage_names):
+            small_seconds = time_stage(
+                prepare_stage(small_phrase, sample_count), repeat
+            )
+            large_seconds = time_stage(
+                prepare_stage(large_phrase, sample_count), repeat
+            )
+            # Clamp, so stages too fast to measure count as linear
+            small_seconds = max(small_seconds, 1e-6)
+            large_seconds = max(large_seconds, small_seconds)
+            exponent = (
+                math.log(large_seconds / small_seconds)
+                / math.log(len(large_phrase) / len(small_phrase))
+            )
+            yield ScalingResult(
+                corpus_name, stage_name, exponent,
+                exponent <= max_scaling_exponent
+            )
+
+def format_bytes(byte_count):
+    if byte_count is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB'):
+        if byte_count < 1024:
+            return "{0:.0f} {1}".format(byte_count, unit)
+        byte_count /= 1024
+    return "{0:.1f} GB".format(byte_count)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the phrase pipeline, stage by stage"
+    )
+    parser.add_argument(
+        '--corpus', action='append',
+        help="Only run this corpus entry (repeatable): {0}".format(
+            ', '.join(corpus_name for corpus_name, _ in benchmark_corpus)
+        )
+    )
+    parser.add_argument(
+        '--stage', action='append',
+        help="Only run this stage (repeatable): {0}".format(
+            ', '.join(stage_name for stage_name, _ in benchmark_stages)
+        )
+    )
+    parser.add_argument('--size', type=int, default=max_phrase_chars)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--samples', type=int, default=default_sample_count,
+        help="Samples per run of the sampling stages"
+    )
+    parser.add_argument(
+        '--no-allocations', action='store_true',
+        help="Skip measuring allocations, which is slow"
+    )
+    parser.add_argument(
+        '--check-scaling', action='store_true',
+        help="Also compare sizes {0}; exit with an error if any stage "
+        "grows faster than size ** {1}".format(
+            scaling_sizes, max_scaling_exponent
+        )
+    )
+    parser.add_argument(
+        '--verbose', action='store_true',
+        help="Show warnings logged while parsing, e.g. for unclosed brackets"
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.WARNING if args.verbose else logging.ERROR
+    )
+
+    print("{0:<18} {1:<12} {2:>7} {3:>12} {4:>10}".format(
+        'corpus', 'stage', 'chars', 'ms', 'peak mem'
+    ))
+    for stage_result in run_benchmarks(
+            args.corpus, args.stage, args.size, args.repeat, args.samples,
+            not args.no_allocations):
+        print("{0:<18} {1:<12} {2:>7} {3:>12.3f} {4:>10}".format(
+            stage_result.corpus, stage_result.stage, stage_result.chars,
+            stage_result.seconds * 1000,
+            format_bytes(stage_result.alloc_bytes)
+        ))
+
+    if not args.check_scaling:
+        return 0
+    print()
+    print("{0:<18} {1:<12} {2:>9}".format('corpus', 'stage', 'exponent'))
+    all_passed = True
+    for scaling_result in check_scaling(
+            args.corpus, args.stage or ('compile', 'select'),
+            sample_count=args.samples):
+        print("{0:<18} {1:<12} {2:>9.2f}{3}".format(
+            scaling_result.corpus, scaling_result.stage,
+            scaling_result.exponent,
+            '' if scaling_result.passed else '  TOO SLOW'
+        ))
+        all_passed = all_passed and scaling_result.passed
+    return 0 if all_passed else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
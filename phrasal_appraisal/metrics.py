@@ -0,0 +1,315 @@
+import logging
+log = logging.getLogger(__name__)
+
+# Count and time what the app is doing, shown as plain text on /metrics in
+# the Prometheus text format, for dashboards and alerts
+
+import threading
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from pyramid.events import BeforeRender
+from pyramid.response import Response
+
+# Upper bounds of the histogram buckets, in seconds
+default_buckets_sec = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+    5, 10
+)
+# Anything else is counted as 'other', so clients can't make up new series
+known_request_methods = frozenset((
+    'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'
+))
+
+def format_metric_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+def format_metric_labels(label_names, label_values):
+    if not label_names:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(
+            label_name,
+            str(label_value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n')
+        )
+        for label_name, label_value in zip(label_names, label_values)
+    ) + '}'
+
+class MetricCounter(object):
+    # Only ever goes up, per set of label values
+    metric_type = 'counter'
+
+    def __init__(self, name, help_text, label_names = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        if not self.label_names:
+            # Show zero until there's something to count
+            self.values[()] = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount = 1, *label_values):
+        with self.lock:
+            self.values[label_values] = (
+                self.values.get(label_values, 0) + amount
+            )
+
+    def get_value(self, *label_values):
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def take_values(self):
+        # Everything counted so far, starting again from zero
+        with self.lock:
+            values = self.values
+            self.values = {}
+            if not self.label_names:
+                self.values[()] = 0
+        return values
+
+    def add_values(self, values):
+        # Add what take_values returned, e.g. in another process
+        with self.lock:
+            for label_values, value in values.items():
+                self.values[label_values] = (
+                    self.values.get(label_values, 0) + value
+                )
+
+    def iter_samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            yield self.name, self.label_names, label_values, value
+
+class MetricHistogram(object):
+    # How many values fell into each bucket, per set of label values
+    metric_type = 'histogram'
+
+    def __init__(
+            self, name, help_text, label_names = (),
+            buckets = default_buckets_sec):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # By label values, [bucket counts..., count of everything larger]
+        # and the sum of all values
+        self.bucket_counts = {}
+        self.value_sums = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        # Values equal to a bucket's bound belong in that bucket
+        bucket_num = bisect_left(self.buckets, value)
+        with self.lock:
+            bucket_counts = self.bucket_counts.get(label_values)
+            if bucket_counts is None:
+                bucket_counts = [0] * (len(self.buckets) + 1)
+                self.bucket_counts[label_values] = bucket_counts
+                self.value_sums[label_values] = 0.0
+            bucket_counts[bucket_num] += 1
+            self.value_sums[label_values] += value
+
+    def get_count(self, *label_values):
+        with self.lock:
+            return sum(self.bucket_counts.get(label_values, ()))
+
+    def take_values(self):
+        # Everything observed so far, starting again from empty
+        with self.lock:
+            values = (self.bucket_counts, self.value_sums)
+            self.bucket_counts = {}
+            self.value_sums = {}
+        return values
+
+    def add_values(self, values):
+        # Add what take_values returned, e.g. in another process
+        other_bucket_counts, other_value_sums = values
+        with self.lock:
+            for label_values, other_counts in other_bucket_counts.items():
+                bucket_counts = self.bucket_counts.get(label_values)
+                if bucket_counts is None:
+                    bucket_counts = [0] * (len(self.buckets) + 1)
+                    self.bucket_counts[label_values] = bucket_counts
+                    self.value_sums[label_values] = 0.0
+                for bucket_num, bucket_count in enumerate(other_counts):
+                    bucket_counts[bucket_num] += bucket_count
+                self.value_sums[label_values] += (
+                    other_value_sums[label_values]
+                )
+
+    def iter_samples(self):
+        with self.lock:
+            series = sorted(
+                (label_values, list(bucket_counts),
+                 self.value_sums[label_values])
+                for label_values, bucket_counts in self.bucket_counts.items()
+            )
+        bucket_label_names = self.label_names + ('le',)
+        for label_values, bucket_counts, value_sum in series:
+            # Buckets are shown adding up everything smaller
+            total_count = 0
+            for bucket_bound, bucket_count in zip(
+                    self.buckets + (float('inf'),), bucket_counts):
+                total_count += bucket_count
+                yield (
+                    self.name + '_bucket', bucket_label_names,
+                    label_values + (format_metric_value(bucket_bound),),
+                    total_count
+                )
+            yield self.name + '_sum', self.label_names, label_values, value_sum
+            yield (
+                self.name + '_count', self.label_names, label_values,
+                total_count
+            )
+
+class MetricCallback(object):
+    # Read from elsewhere when shown, e.g. how many groups are in memory
+    def __init__(self, name, help_text, metric_type, read_value):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.read_value = read_value
+
+    def iter_samples(self):
+        yield self.name, (), (), self.read_value()
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def add_metric(self, metric):
+        # Adding the same name again keeps the first, so modules and apps
+        # can be set up more than once
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, label_names = ()):
+        return self.add_metric(MetricCounter(name, help_text, label_names))
+
+    def histogram(
+            self, name, help_text, label_names = (),
+            buckets = default_buckets_sec):
+        return self.add_metric(
+            MetricHistogram(name, help_text, label_names, buckets)
+        )
+
+    def callback(self, name, help_text, read_value, metric_type = 'gauge'):
+        return self.add_metric(
+            MetricCallback(name, help_text, metric_type, read_value)
+        )
+
+    def take_values(self):
+        # Counts and observations made since the last call, by metric name,
+        # e.g. to send from a worker process to the one serving /metrics
+        with self.lock:
+            metrics = list(self.metrics.items())
+        return {
+            name: metric.take_values()
+            for name, metric in metrics
+            if isinstance(metric, (MetricCounter, MetricHistogram))
+        }
+
+    def add_values(self, metric_values):
+        # Add what take_values returned, skipping metrics not set up here
+        for name, values in metric_values.items():
+            with self.lock:
+                metric = self.metrics.get(name)
+            if metric is not None:
+                metric.add_values(values)
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        for name, metric in metrics:
+            lines.append('# HELP {0} {1}'.format(name, metric.help_text))
+            lines.append('# TYPE {0} {1}'.format(name, metric.metric_type))
+            try:
+                for sample_name, label_names, label_values, value in (
+                        metric.iter_samples()):
+                    lines.append('{0}{1} {2}'.format(
+                        sample_name,
+                        format_metric_labels(label_names, label_values),
+                        format_metric_value(value)
+                    ))
+            except Exception as e:
+                # One broken metric shouldn't hide the others
+                log.error(
+                    "metrics: Couldn't read %s: %s", name, e, exc_info = True
+                )
+        return '\n'.join(lines) + '\n'
+
+metrics_registry = MetricsRegistry()
+stage_seconds = metrics_registry.histogram(
+    'phrasal_stage_seconds',
+    'Time spent in each stage of handling a request', ('stage',)
+)
+request_seconds = metrics_registry.histogram(
+    'phrasal_request_seconds',
+    'Time taken to handle each request, including rendering',
+    ('route', 'method', 'status')
+)
+
+@contextmanager
+def time_stage(stage_name):
+    # Record how long the block takes, even if it raises
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start_time, stage_name)
+
+def metrics_tween_factory(handler, registry):
+    # Time every request, and the template rendering within it
+    def metrics_tween(request):
+        start_time = time.perf_counter()
+        status = 500
+        try:
+            response = handler(request)
+            status = response.status_code
+            return response
+        finally:
+            end_time = time.perf_counter()
+            render_start_time = getattr(request, 'render_start_time', None)
+            if render_start_time is not None:
+                stage_seconds.observe(end_time - render_start_time, 'render')
+            matched_route = getattr(request, 'matched_route', None)
+            method = request.method
+            if method not in known_request_methods:
+                method = 'other'
+            request_seconds.observe(
+                end_time - start_time,
+                matched_route.name if matched_route is not None else '',
+                method, status
+            )
+    return metrics_tween
+
+def mark_render_start(event):
+    # Templates are rendered after the view returns, so note when that
+    # starts; see metrics_tween_factory
+    request = event.get('request')
+    if request is not None:
+        request.render_start_time = time.perf_counter()
+
+def metrics_view(request):
+    return Response(
+        metrics_registry.render(),
+        content_type='text/plain', charset='utf-8'
+    )
+
+def includeme(config):
+    # Set up with config.include, see main
+    config.add_tween('phrasal_appraisal.metrics.metrics_tween_factory')
+    config.add_subscriber(mark_render_start, BeforeRender)
+    config.add_route('metrics_view', '/metrics')
+    config.add_view(metrics_view, route_name='metrics_view')
@@ -31,8 +31,8 @@ class OpMessage(object):
             # Encapulsate the value in a list
             self.op_details = [ details ]
         log.debug(
-            "OpMessage: Created new message: {0}"
-            .format(self)
+            "OpMessage: Created new message: %s",
+            self
         )
 
     @property
@@ -71,3 +71,15 @@ class OpMessage(object):
             'message': self.op_message,
             'details': self.op_details
         }
+
+    def convert_to_record(self):
+        # Plain values that can be saved and turned back into a message
+        return [
+            self.op_msg_type.name, self.op_message, self.op_title,
+            self.op_details
+        ]
+
+    @staticmethod
+    def from_record(record):
+        msg_type, message, title, details = record
+        return OpMessage(MessageType[msg_type], message, title, details)
@@ -0,0 +1,154 @@
+import logging
+log = logging.getLogger(__name__)
+
+from abc import ABCMeta, abstractmethod
+
+import json
+import sqlite3
+import threading
+import time
+
+from .op_messages import OpMessage
+from .phrase_results import (
+    convert_results_to_record,
+    results_from_record
+)
+
+# Turn phrase groups into text and back, for backends that store text
+def encode_phrase_group(phrase_group):
+    # Messages and results are objects, and new groups use their UUID as is;
+    # everything else is already plain values
+    phrase_record = dict(phrase_group)
+    phrase_record['results'] = convert_results_to_record(
+        phrase_group['results']
+    )
+    phrase_record['msgs'] = [
+        msg.convert_to_record() for msg in phrase_group['msgs']
+    ]
+    return json.dumps(phrase_record, default=str)
+
+def decode_phrase_group(phrase_data):
+    phrase_group = json.loads(phrase_data)
+    phrase_group['results'] = results_from_record(phrase_group['results'])
+    phrase_group['msgs'] = [
+        OpMessage.from_record(msg_record)
+        for msg_record in phrase_group['msgs']
+    ]
+    return phrase_group
+
+# Keep phrase groups somewhere longer-lived than a single process
+class PhraseStorageBackend(object):
+    # Used by PhraseStorage, which caches groups in memory in front of this.
+    # Groups are keyed by the string form of their UUID, and saved already
+    # encoded with encode_phrase_group.
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def load_phrase_group(self, group_key): raise NotImplementedError
+
+    @abstractmethod
+    def save_phrase_groups(self, encoded_groups): raise NotImplementedError
+
+    def close(self):
+        pass
+
+class SQLitePhraseBackend(PhraseStorageBackend):
+    # One SQLite file shared by every worker process
+    # WAL mode lets readers carry on while a batch of groups is written, and
+    # groups not saved for max_age_sec are cleaned up now and then.
+    prune_interval_sec = 3600
+
+    def __init__(self, path, max_age_sec = 30 * 24 * 3600, timeout_sec = 5):
+        self.path = path
+        self.max_age_sec = max_age_sec
+        self.timeout_sec = timeout_sec
+        # SQLite connections can't be shared between threads
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.last_prune_time = 0
+        connection = self.get_connection()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS phrase_groups ("
+                "uid TEXT PRIMARY KEY, data TEXT NOT NULL, "
+                "updated REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS phrase_groups_updated "
+                "ON phrase_groups (updated)"
+            )
+        log.info("backend: Using SQLite database %s", path)
+
+    def get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout_sec)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Safe with WAL; a power loss may only lose the latest batch
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    def load_phrase_group(self, group_key):
+        row = self.get_connection().execute(
+            "SELECT data FROM phrase_groups WHERE uid = ?", (group_key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def save_phrase_groups(self, encoded_groups):
+        # Write every group in one transaction
+        cur_time = time.time()
+        connection = self.get_connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO phrase_groups (uid, data, updated) "
+                "VALUES (?, ?, ?)",
+                [
+                    (group_key, group_data, cur_time)
+                    for group_key, group_data in encoded_groups.items()
+                ]
+            )
+            if cur_time - self.last_prune_time > self.prune_interval_sec:
+                self.last_prune_time = cur_time
+                pruned = connection.execute(
+                    "DELETE FROM phrase_groups WHERE updated < ?",
+                    (cur_time - self.max_age_sec,)
+                ).rowcount
+                if pruned:
+                    log.info("backend: Pruned %s old groups", pruned)
+        log.debug("backend: Saved %s groups", len(encoded_groups))
+
+    def close(self):
+        with self.connections_lock:
+            for connection in self.connections:
+                try:
+                    connection.close()
+                except sqlite3.ProgrammingError:
+                    # Closed from the wrong thread, leave it to be collected
+                    pass
+            self.connections = []
+        self.local = threading.local()
+
+def create_phrase_backend(settings):
+    # Pick a backend from the app settings, e.g.
+    #   phrase_storage.backend = sqlite
+    #   phrase_storage.sqlite_path = %(here)s/phrase_groups.sqlite
+    # Returns None to keep groups in memory only
+    backend_name = settings.get('phrase_storage.backend', 'memory')
+    if backend_name == 'memory':
+        return None
+    if backend_name == 'sqlite':
+        return SQLitePhraseBackend(
+            settings['phrase_storage.sqlite_path'],
+            float(settings.get(
+                'phrase_storage.max_age_days', 30
+            )) * 24 * 3600
+        )
+    raise ValueError(
+        "Unknown phrase_storage.backend '{0}'".format(backend_name)
+    )
@@ -0,0 +1,44 @@
+import logging
+log = logging.getLogger(__name__)
+
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+# Keep compiled phrases around to skip parsing identical sources
+class CompiledPhraseCache(object):
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.compiled_phrases = OrderedDict()
+        # Shared between request threads
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def hash_source(phrase_source):
+        # Content-addressed, so identical sources share one compiled phrase
+        return hashlib.sha256(phrase_source.encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return len(self.compiled_phrases)
+
+    def get(self, source_hash):
+        with self.lock:
+            compiled_phrase = self.compiled_phrases.get(source_hash)
+            if compiled_phrase is not None:
+                # Mark as most recently used
+                self.compiled_phrases.move_to_end(source_hash)
+        return compiled_phrase
+
+    def set(self, source_hash, compiled_phrase):
+        with self.lock:
+            self.compiled_phrases[source_hash] = compiled_phrase
+            self.compiled_phrases.move_to_end(source_hash)
+            # Clean up the least recently used phrases
+            while len(self.compiled_phrases) > self.max_entries:
+                old_hash, _ = self.compiled_phrases.popitem(last=False)
+                log.debug("cache: Dropping compiled phrase %s", old_hash)
+
+    def clear(self):
+        with self.lock:
+            self.compiled_phrases.clear()
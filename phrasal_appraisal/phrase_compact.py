@@ -0,0 +1,214 @@
+import logging
+log = logging.getLogger(__name__)
+
+from array import array
+
+# Compiled phrase node kinds
+NODE_TEXT = 0
+NODE_SEQUENCE = 1
+NODE_CHOICE = 2
+
+# Typecodes for the node arrays; unsigned ints are plenty for any phrase set
+# that fits in memory as text
+kind_typecode = 'b'
+index_typecode = 'I'
+
+# Build a CompiledPhrase, one node at a time
+class CompiledPhraseBuilder(object):
+    # Used in place of PhrasePartBuilder by build_phrase_parts.  Every node
+    # is an index into a few flat arrays instead of an object:
+    #  - text: node_starts/node_ends are the bounds in the text pool
+    #  - sequence and choice: node_starts/node_ends are the bounds of its
+    #    children in child_nodes
+    # Children are always added before their parents, so walking the nodes
+    # in order visits every child before anything that uses it.
+    def __init__(self):
+        self.text_pieces = []
+        self.text_length = 0
+        self.node_kinds = array(kind_typecode)
+        self.node_levels = array(index_typecode)
+        self.node_starts = array(index_typecode)
+        self.node_ends = array(index_typecode)
+        self.child_nodes = array(index_typecode)
+        self.line_roots = array(index_typecode)
+        self.line_starts = array(index_typecode)
+        self.line_ends = array(index_typecode)
+        self.line_warnings = {}
+        self.group_titles = []
+        self.group_starts = array(index_typecode)
+        self.group_ends = array(index_typecode)
+        self.group_line_start = 0
+
+    @property
+    def node_count(self):
+        return len(self.node_kinds)
+
+    def add_node(self, node_kind, choice_level, node_start, node_end):
+        self.node_kinds.append(node_kind)
+        self.node_levels.append(choice_level)
+        self.node_starts.append(node_start)
+        self.node_ends.append(node_end)
+        return len(self.node_kinds) - 1
+
+    def add_text(self, text, choice_level):
+        text_start = self.text_length
+        self.text_pieces.append(text)
+        self.text_length += len(text)
+        return self.add_node(
+            NODE_TEXT, choice_level, text_start, self.text_length
+        )
+
+    def is_text(self, node):
+        return self.node_kinds[node] == NODE_TEXT
+
+    def add_children(self, node_kind, child_nodes, choice_level):
+        children_start = len(self.child_nodes)
+        self.child_nodes.extend(child_nodes)
+        return self.add_node(
+            node_kind, choice_level, children_start, len(self.child_nodes)
+        )
+
+    def add_sequence(self, child_nodes, choice_level):
+        if len(child_nodes) == 1:
+            # Same as the child on its own, e.g. a branch that's one choice
+            return child_nodes[0]
+        return self.add_children(NODE_SEQUENCE, child_nodes, choice_level)
+
+    def add_choice(self, child_nodes, choice_level):
+        return self.add_children(NODE_CHOICE, child_nodes, choice_level)
+
+    def add_line(self, root_node, line_start, line_end, warnings):
+        # Lines are added group by group, see add_group
+        line_num = len(self.line_roots)
+        self.line_roots.append(root_node)
+        self.line_starts.append(line_start)
+        self.line_ends.append(line_end)
+        if warnings:
+            self.line_warnings[line_num] = tuple(warnings)
+        return line_num
+
+    def add_group(self, title):
+        # Finish a group with every line added since the last one
+        self.group_titles.append(title)
+        self.group_starts.append(self.group_line_start)
+        self.group_ends.append(len(self.line_roots))
+        self.group_line_start = len(self.line_roots)
+
+    def build(self, source_hash, source):
+        return CompiledPhrase(source_hash, source, self)
+
+# Keep parsed phrase sources
+class CompiledPhrase(object):
+    # Shared between requests via the cache; treat everything as read-only
+    # Built by CompiledPhraseBuilder.  Line and group bounds are kept as
+    # positions in the source, so it's only stored once.
+    def __init__(self, source_hash, source, builder):
+        self.source_hash_internal = source_hash
+        self.source = source
+        self.text_pool = ''.join(builder.text_pieces)
+        self.node_kinds = builder.node_kinds
+        self.node_levels = builder.node_levels
+        self.node_starts = builder.node_starts
+        self.node_ends = builder.node_ends
+        self.child_nodes = builder.child_nodes
+        self.line_roots = builder.line_roots
+        self.line_starts = builder.line_starts
+        self.line_ends = builder.line_ends
+        self.line_warnings = builder.line_warnings
+        self.group_titles = tuple(builder.group_titles)
+        self.group_starts = builder.group_starts
+        self.group_ends = builder.group_ends
+        # Results of analyzing this phrase (see phrase_space), kept so it's
+        # only done once
+        self.analysis = {}
+        log.debug(
+            "CompiledPhrase: Created %s with %s groups and %s nodes",
+            source_hash, len(self.group_titles), len(self.node_kinds)
+        )
+
+    @property
+    def source_hash(self):
+        return self.source_hash_internal
+
+    @property
+    def group_count(self):
+        return len(self.group_titles)
+
+    @property
+    def node_count(self):
+        return len(self.node_kinds)
+
+    def get_group_lines(self, group_num):
+        # Line numbers of one group, in order
+        return range(self.group_starts[group_num], self.group_ends[group_num])
+
+    def get_line_source(self, line_num):
+        return self.source[self.line_starts[line_num]:self.line_ends[line_num]]
+
+    def get_line_warnings(self, line_num):
+        return self.line_warnings.get(line_num, ())
+
+    def get_children(self, node):
+        return self.child_nodes[self.node_starts[node]:self.node_ends[node]]
+
+    def get_text(self, node):
+        return self.text_pool[self.node_starts[node]:self.node_ends[node]]
+
+    def iter_line_nodes(self, line_num, rng):
+        # Apply random choices to one line, yielding the text nodes picked
+        # Walks the nodes with an explicit stack, picking choices in the
+        # order they appear so seeded samples always come out the same
+        node_kinds = self.node_kinds
+        node_starts = self.node_starts
+        node_ends = self.node_ends
+        child_nodes = self.child_nodes
+        pending_nodes = [self.line_roots[line_num]]
+        while pending_nodes:
+            node = pending_nodes.pop()
+            node_kind = node_kinds[node]
+            if node_kind == NODE_TEXT:
+                yield node
+            elif node_kind == NODE_SEQUENCE:
+                # Last in, first out, so queue up the last child first
+                pending_nodes.extend(
+                    reversed(child_nodes[node_starts[node]:node_ends[node]])
+                )
+            else:
+                children_start = node_starts[node]
+                pending_nodes.append(
+                    child_nodes[
+                        children_start
+                        + rng.randrange(node_ends[node] - children_start)
+                    ]
+                )
+
+    def sample_line(self, line_num, rng, phrase_array = None):
+        # Returns the fragments of one random sample of a line, as
+        # [{'choice_level', 'result'}, ...], added to the end of phrase_array
+        # if given
+        if phrase_array is None:
+            phrase_array = []
+        node_levels = self.node_levels
+        node_starts = self.node_starts
+        node_ends = self.node_ends
+        text_pool = self.text_pool
+        for node in self.iter_line_nodes(line_num, rng):
+            phrase_array.append({
+                'choice_level': node_levels[node],
+                'result': text_pool[node_starts[node]:node_ends[node]]
+            })
+        return phrase_array
+
+    def sample_line_text(self, line_num, rng, text_pieces = None):
+        # Like sample_line, but only the text of each fragment, ready to be
+        # joined.  Picks the same choices as sample_line for the same rng.
+        if text_pieces is None:
+            text_pieces = []
+        node_starts = self.node_starts
+        node_ends = self.node_ends
+        text_pool = self.text_pool
+        text_pieces.extend(
+            text_pool[node_starts[node]:node_ends[node]]
+            for node in self.iter_line_nodes(line_num, rng)
+        )
+        return text_pieces
@@ -0,0 +1,273 @@
+import logging
+log = logging.getLogger(__name__)
+
+# Run phrase generation in worker processes, so a heavy phrase set only
+# slows down its own request, and more cores mean more throughput
+
+import atexit
+import multiprocessing
+import queue
+import threading
+import time
+
+from .metrics import (
+    metrics_registry,
+    time_stage
+)
+from .phrase_groups import (
+    append_phrase_exception,
+    append_phrase_timeout
+)
+from .time_limiter import TimeoutException
+
+# Longest a worker may take before it's killed and replaced
+default_worker_limit_sec = 20
+
+worker_kills = metrics_registry.counter(
+    'phrasal_executor_worker_kills_total',
+    'Worker processes killed for taking too long'
+)
+
+class PhraseWorkerError(Exception):
+    """Raise for when a worker process fails instead of returning."""
+
+def run_phrase_worker(connection):
+    # Runs in each worker process until told to stop
+    # Each call is (function, args); function is given a new msgs list
+    # first, like process_phrase, and the messages are sent back with the
+    # result.  So are any metrics recorded during the call, e.g. stage
+    # timings, since only the parent serves /metrics.  Compiled phrases
+    # stay cached here between calls.
+    while True:
+        try:
+            request = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if request is None:
+            return
+        function, args = request
+        msgs = []
+        try:
+            result = function(msgs, *args)
+        except Exception as e:
+            log.error("worker: Call failed: %s", e, exc_info = True)
+            # The exception itself might not survive being sent
+            connection.send(
+                (False, repr(e), msgs, metrics_registry.take_values())
+            )
+            continue
+        connection.send((True, result, msgs, metrics_registry.take_values()))
+
+class PhraseWorker(object):
+    def __init__(self, process, connection):
+        self.process = process
+        self.connection = connection
+
+    def stop(self, kill = False):
+        if not kill:
+            try:
+                self.connection.send(None)
+            except (OSError, ValueError):
+                # Already gone
+                kill = True
+        if not kill:
+            self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+
+class PhraseProcessPool(object):
+    # A fixed number of worker processes, each running one call at a time
+    # Workers are started up front from a clean server process
+    # ("forkserver") with the phrase modules already imported, and reused
+    # most recently used first so their compiled phrase caches stay warm.
+    # A call that takes longer than limit_sec gets its worker killed, unlike
+    # TimeLimiter, which relies on the code checking it.  Callers give up
+    # sooner if they had to wait for a free worker, leaving the worker to
+    # finish in the background.
+    def __init__(self, worker_count, limit_sec = default_worker_limit_sec):
+        self.worker_count = worker_count
+        self.limit_sec = limit_sec
+        start_methods = multiprocessing.get_all_start_methods()
+        if 'forkserver' in start_methods:
+            self.context = multiprocessing.get_context('forkserver')
+            self.context.set_forkserver_preload([
+                'phrasal_appraisal.phrase_groups',
+                'phrasal_appraisal.phrase_space'
+            ])
+        else:
+            self.context = multiprocessing.get_context('spawn')
+        self.idle_workers = queue.LifoQueue()
+        self.workers_lock = threading.Lock()
+        self.workers = []
+        self.closed = False
+        for _ in range(worker_count):
+            self.idle_workers.put(self.start_worker())
+        log.info("executor: Started %s worker processes", worker_count)
+
+    @property
+    def idle_count(self):
+        return self.idle_workers.qsize()
+
+    def start_worker(self):
+        parent_connection, child_connection = self.context.Pipe()
+        process = self.context.Process(
+            target=run_phrase_worker, args=(child_connection,),
+            name='phrase-worker'
+        )
+        process.daemon = True
+        process.start()
+        # Only the worker uses its end
+        child_connection.close()
+        worker = PhraseWorker(process, parent_connection)
+        with self.workers_lock:
+            self.workers.append(worker)
+        return worker
+
+    def replace_worker(self, worker):
+        with self.workers_lock:
+            if worker in self.workers:
+                # Otherwise already stopped by close
+                self.workers.remove(worker)
+        worker.stop(kill=True)
+        if not self.closed:
+            self.idle_workers.put(self.start_worker())
+
+    def call(self, msgs, function, *args):
+        # Returns function(worker_msgs, *args) run in a worker, adding
+        # worker_msgs to msgs.  function and everything passed to and from
+        # it must be picklable, e.g. functions defined at module level.
+        # Waiting for a free worker and running share one limit, so callers
+        # (e.g. holding a group's lock) never wait longer than limit_sec
+        deadline = time.monotonic() + self.limit_sec
+        try:
+            worker = self.idle_workers.get(timeout=self.limit_sec)
+        except queue.Empty:
+            worker = None
+        wait_sec = deadline - time.monotonic()
+        if worker is None or wait_sec <= 0:
+            if worker is not None:
+                # Never started, so the worker is fine
+                self.idle_workers.put(worker)
+            raise TimeoutException(
+                "No free worker within '{0}' sec".format(self.limit_sec)
+            )
+        kill_time = time.monotonic() + self.limit_sec
+        worker_done = False
+        try:
+            worker.connection.send((function, args))
+            if not worker.connection.poll(wait_sec):
+                # Stop waiting, but only kill the worker once it's taken
+                # longer than limit_sec itself
+                worker_done = True
+                self.drain_worker(worker, kill_time)
+                raise TimeoutException(
+                    "Exceeded time limit of '{0}' sec".format(self.limit_sec)
+                )
+            succeeded, result, worker_msgs, metric_values = (
+                worker.connection.recv()
+            )
+            worker_done = True
+            self.idle_workers.put(worker)
+        except (EOFError, OSError) as e:
+            raise PhraseWorkerError(
+                "Worker {0} stopped: {1!r}".format(worker.process.pid, e)
+            )
+        finally:
+            if not worker_done:
+                self.replace_worker(worker)
+        msgs.extend(worker_msgs)
+        metrics_registry.add_values(metric_values)
+        if not succeeded:
+            raise PhraseWorkerError(result)
+        return result
+
+    def drain_worker(self, worker, kill_time):
+        # Wait in the background for a call nobody is waiting for anymore,
+        # then reuse the worker, or kill it if still running by kill_time
+        def wait_for_worker():
+            try:
+                finished = worker.connection.poll(
+                    max(0, kill_time - time.monotonic())
+                )
+                if finished:
+                    _, _, _, metric_values = worker.connection.recv()
+                    metrics_registry.add_values(metric_values)
+            except (EOFError, OSError):
+                finished = False
+            if finished:
+                self.idle_workers.put(worker)
+                return
+            log.warning(
+                "executor: Killing worker %s, took over '%s' sec",
+                worker.process.pid, self.limit_sec
+            )
+            worker_kills.inc()
+            self.replace_worker(worker)
+        drain_thread = threading.Thread(
+            target=wait_for_worker, name='phrase-worker-drain'
+        )
+        drain_thread.daemon = True
+        drain_thread.start()
+
+    def close(self):
+        self.closed = True
+        with self.workers_lock:
+            workers = self.workers
+            self.workers = []
+        for worker in workers:
+            worker.stop()
+
+class PhraseExecutor(object):
+    # Runs phrase functions in the request thread, or in a process pool if
+    # configured, e.g.
+    #   phrase_executor.workers = 4
+    #   phrase_executor.limit_sec = 20
+    def __init__(self):
+        self.pool = None
+        self.exit_registered = False
+
+    def configure(self, settings):
+        self.close()
+        worker_count = int(settings.get('phrase_executor.workers', 0))
+        if worker_count <= 0:
+            return
+        self.pool = PhraseProcessPool(
+            worker_count,
+            float(settings.get(
+                'phrase_executor.limit_sec', default_worker_limit_sec
+            ))
+        )
+        if not self.exit_registered:
+            atexit.register(self.close)
+            self.exit_registered = True
+
+    def run(self, msgs, function, *args, timeout_result = None):
+        # Same as function(msgs, *args), returning timeout_result instead if
+        # a worker had to be killed, or failed
+        if self.pool is None:
+            return function(msgs, *args)
+        try:
+            with time_stage('worker'):
+                return self.pool.call(msgs, function, *args)
+        except TimeoutException as e:
+            append_phrase_timeout(msgs, self.pool, e)
+            return timeout_result
+        except PhraseWorkerError as e:
+            append_phrase_exception(msgs, e)
+            return timeout_result
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+phrase_executor = PhraseExecutor()
+metrics_registry.callback(
+    'phrasal_executor_idle_workers', 'Worker processes waiting for work',
+    lambda: (
+        phrase_executor.pool.idle_count
+        if phrase_executor.pool is not None else 0
+    )
+)
@@ -3,12 +3,17 @@ log = logging.getLogger(__name__)
 
 from abc import ABCMeta, abstractmethod
 
+import itertools
 import random
+import re
+
+from collections import namedtuple
 
 # Track time to avoid potential infinite loops
 from .time_limiter import (
-    TimeLimiter,
-    TimeoutException
+    TimeoutException,
+    WorkBudget,
+    WorkBudgetExceeded
 )
 
 from .op_messages import (
@@ -16,166 +21,382 @@ from .op_messages import (
     OpMessage
 )
 
+from .metrics import (
+    metrics_registry,
+    time_stage
+)
+from .phrase_cache import CompiledPhraseCache
+from .phrase_compact import (
+    CompiledPhraseBuilder
+)
+
+# Compiled phrases shared between requests, most recently used kept
+max_compiled_phrases = 128
+compiled_phrase_cache = CompiledPhraseCache(max_compiled_phrases)
+metrics_registry.callback(
+    'phrasal_compiled_phrases', 'Compiled phrases kept in the cache',
+    lambda: len(compiled_phrase_cache)
+)
+phrase_timeouts = metrics_registry.counter(
+    'phrasal_phrase_timeouts_total',
+    'Phrase sets that took too long to process'
+)
+
+# Limits for each kind of request, see make_work_budget
+# Work is counted in characters parsed and phrase nodes created or sampled,
+# so the same phrases pass or fail however busy the server is.  A core does
+# roughly a million a second; the times are only a backstop.
+PhraseLimits = namedtuple('PhraseLimits', ['max_work', 'limit_sec'])
+phrase_limits = {
+    # A single sample for the web form
+    'form': PhraseLimits(500000, 2),
+    # Up to max_batch_samples samples in one go
+    'api': PhraseLimits(5000000, 15),
+    # Up to max_stream_samples samples, sent as they're made; no time limit,
+    # since that depends on how fast the client reads
+    'stream': PhraseLimits(50000000, None),
+    # Background jobs, see phrase_jobs
+    'job': PhraseLimits(500000000, 3600),
+    # Run by hand, e.g. benchmarks; no limits
+    'cli': PhraseLimits(None, None)
+}
+max_batch_samples = 10000
+# Streamed samples aren't held in memory, so allow far more
+max_stream_samples = 10000000
+
+# Phrase tokens
+TOKEN_TEXT = 0
+TOKEN_OPEN = 1
+TOKEN_PIPE = 2
+TOKEN_CLOSE = 3
+TOKEN_HEADER = 4
+TOKEN_LINE_END = 5
+
+# Characters that can be escaped with a backslash
+phrase_escape_chars = '{}|#\\'
+phrase_escape_pattern = re.compile(r'\\([{}|#\\])')
+# An escape code, a special character, or a run of plain text
+phrase_token_pattern = re.compile(r'\\(.)?|[{}|]|[^\\{}|]+', re.DOTALL)
+phrase_line_token_pattern = re.compile(r'\\(.)?|[{}|\n]|[^\\{}|\n]+')
+
 
 # Process the requested phrase
-def process_phrase(msgs, phrase_set, seed = ''):
-    # Seed the random number generator.  We don't need cryptographic security.
-    if seed:
-        log.debug("process_phrase: Setting random seed to {0}".format(seed))
-        random.seed(seed)
+def process_phrase(msgs, phrase_set, seed = '', rng = None, tier = 'form'):
+    # Give each request its own random number generator, so concurrent
+    # requests don't reseed each other.  We don't need cryptographic security.
+    if rng is not None:
+        log.debug("process_phrase: Using given random number generator")
+    elif seed:
+        log.debug("process_phrase: Setting random seed to %s", seed)
+        rng = random.Random(seed)
     else:
         log.debug("process_phrase: Setting random seed to default")
-        random.seed()
+        rng = random.Random()
 
     log.debug(
-        "process_phrase: Processing phrase set: '{0}'"
-        .format(phrase_set)
+        "process_phrase: Processing phrase set: '%s'",
+        phrase_set
     )
     # Process the given phrases
     # Don't allow this to run on indefinitely
-    time_limit = TimeLimiter(0.5)
+    time_limit = make_work_budget(tier)
     try:
-        # Parse the input phrases
-        phrases_raw = process_phrase_sections(msgs, time_limit, phrase_set)
+        # Parse the input phrases, reusing prior work if possible
+        with time_stage('compile'):
+            compiled_phrase = get_compiled_phrase(
+                msgs, time_limit, phrase_set
+            )
         # Check time in between processing and grabbing
         time_limit.check()
         # Select a set of phrases and apply the random selections
-        chosen_phrases = select_phrases(msgs, time_limit, phrases_raw)
+        with time_stage('select'):
+            chosen_phrases = select_phrases(
+                msgs, time_limit, compiled_phrase, rng
+            )
         log.debug(
-            "process_phrase: Picked phrases: '{0}'"
-            .format(chosen_phrases)
+            "process_phrase: Picked phrases: '%s'",
+            chosen_phrases
         )
     except TimeoutException as e:
         # Clear any chosen phrases
         chosen_phrases = []
-        log.error(
-            "process_phrase: Exceeded time limit of '{0}': {1}"
-            .format(time_limit.limit_sec, e),
-            exc_info = True
-        )
-        msgs.append(
-            OpMessage(
-                MessageType.Danger,
-                "Check for misplaced brackets, or if the phrases look "
-                "complex.  It's possible there's a bug in this app.",
-                "Ran out of time",
-                "Stopping since this is taking more than {0} seconds."
-                .format(time_limit.limit_sec)
+        append_phrase_timeout(msgs, time_limit, e)
+    except Exception as e:
+        # Clear any chosen phrases
+        chosen_phrases = []
+        append_phrase_exception(msgs, e)
+
+    return chosen_phrases
+
+# Process many samples of the requested phrase, parsing it only once
+def process_phrase_batch(
+        msgs, phrase_set, count, seed = '', seed_per_sample = False,
+        tier = 'api'):
+    # With seed_per_sample, sample N uses the seed get_sample_seed(seed, N),
+    # so any single sample can be repeated with process_phrase.  Otherwise
+    # one random number generator is shared by the whole batch, which is
+    # a bit faster.
+    seed = get_batch_seed(seed, seed_per_sample)
+    log.debug(
+        "process_phrase_batch: Processing %s samples of phrase set: '%s'",
+        count, phrase_set
+    )
+    # Don't allow this to run on indefinitely
+    time_limit = make_work_budget(tier)
+    try:
+        # Parse the input phrases, reusing prior work if possible
+        compiled_phrase = get_compiled_phrase(msgs, time_limit, phrase_set)
+        # Warn once about every line with trouble, not once per sample
+        append_compiled_warnings(msgs, compiled_phrase)
+        samples = list(
+            iter_phrase_samples(
+                compiled_phrase, count, seed, seed_per_sample, time_limit
             )
         )
+    except TimeoutException as e:
+        # Clear any chosen phrases
+        samples = []
+        append_phrase_timeout(msgs, time_limit, e)
     except Exception as e:
         # Clear any chosen phrases
-        chosen_phrases = []
-        log.error(
-            "process_phrase: Ran into a generic exception: {1}"
-            .format(e),
-            exc_info = True
+        samples = []
+        append_phrase_exception(msgs, e)
+
+    return seed, samples
+
+def load_compiled_phrase(msgs, phrase_set, tier = 'api'):
+    # Compile the phrase on its own, e.g. before streaming samples from it
+    # Returns None if that didn't work out, with the reason added to msgs
+    time_limit = make_work_budget(tier)
+    try:
+        compiled_phrase = get_compiled_phrase(msgs, time_limit, phrase_set)
+    except TimeoutException as e:
+        append_phrase_timeout(msgs, time_limit, e)
+        return None
+    except Exception as e:
+        append_phrase_exception(msgs, e)
+        return None
+    append_compiled_warnings(msgs, compiled_phrase)
+    return compiled_phrase
+
+def iter_phrase_samples(
+        compiled_phrase, count, seed = '', seed_per_sample = False,
+        time_limit = None, annotate = True):
+    # Yield samples one at a time, keeping memory use flat for any count
+    # Each sample is a dict with 'phrases' (as from select_phrases) and, with
+    # seed_per_sample, the 'seed' it used.  Without annotate, each phrase
+    # 'result' is the joined text instead of a list of choice fragments.
+    if seed:
+        rng = random.Random(seed)
+    else:
+        rng = random.Random()
+    for sample_num in range(count):
+        if time_limit is not None:
+            time_limit.check()
+        sample = {}
+        if seed_per_sample:
+            sample['seed'] = get_sample_seed(seed, sample_num)
+            rng = random.Random(sample['seed'])
+        sample['phrases'] = select_phrases(
+            None, time_limit, compiled_phrase, rng, annotate
         )
+        yield sample
+
+def iter_limited_samples(msgs, time_limit, samples):
+    # Pass samples along until time_limit runs out, then stop, saying why in
+    # msgs, e.g. for a stream that's already been partly sent
+    try:
+        for sample in samples:
+            yield sample
+    except TimeoutException as e:
+        append_phrase_timeout(msgs, time_limit, e)
+
+def join_phrase_result(phrase_result):
+    # Plain text of a flattened phrase
+    return ''.join(item['result'] for item in phrase_result)
+
+def get_batch_seed(seed, seed_per_sample):
+    if seed_per_sample and not seed:
+        # Pick a master seed so the batch can still be repeated
+        return str(random.Random().getrandbits(64))
+    return seed
+
+def get_sample_seed(seed, sample_num):
+    # Seed for one sample of a batch, usable as-is in the phrase form
+    return "{0}-{1}".format(seed, sample_num)
+
+def make_work_budget(tier):
+    # Limits for one request, see phrase_limits
+    max_work, limit_sec = phrase_limits[tier]
+    return WorkBudget(max_work, limit_sec)
+
+def append_phrase_timeout(msgs, time_limit, e):
+    phrase_timeouts.inc()
+    if isinstance(e, WorkBudgetExceeded):
+        # Expected for huge phrases, not a problem with the app
+        log.info("process_phrase: %s", e)
         msgs.append(
             OpMessage(
                 MessageType.Danger,
-                "Check for misplaced brackets, or if the phrases look "
-                "complex.  It's possible there's a bug in this app.",
-                "Something unexpected happened",
-                "Ran into an unexpected exception while building phrases."
+                "Try fewer or simpler phrases, or fewer samples.",
+                "Too much to do",
+                "Stopping since this needs more work than allowed."
             )
         )
+        return
+    log.error(
+        "process_phrase: Exceeded time limit of '%s': %s",
+        time_limit.limit_sec, e,
+        exc_info = True
+    )
+    msgs.append(
+        OpMessage(
+            MessageType.Danger,
+            "Check for misplaced brackets, or if the phrases look "
+            "complex.  It's possible there's a bug in this app.",
+            "Ran out of time",
+            "Stopping since this is taking more than {0} seconds."
+            .format(time_limit.limit_sec)
+        )
+    )
 
-    return chosen_phrases
+def append_phrase_exception(msgs, e):
+    log.error(
+        "process_phrase: Ran into a generic exception: %s",
+        e,
+        exc_info = True
+    )
+    msgs.append(
+        OpMessage(
+            MessageType.Danger,
+            "Check for misplaced brackets, or if the phrases look "
+            "complex.  It's possible there's a bug in this app.",
+            "Something unexpected happened",
+            "Ran into an unexpected exception while building phrases."
+        )
+    )
 
-def process_phrase_sections(msgs, time_limit, groups):
+def get_compiled_phrase(
+        msgs, time_limit, phrase_set, cache = compiled_phrase_cache):
+    source_hash = CompiledPhraseCache.hash_source(phrase_set)
+    compiled_phrase = cache.get(source_hash)
+    if compiled_phrase is not None:
+        log.debug(
+            "get_compiled_phrase: Reusing compiled phrase %s",
+            source_hash
+        )
+        # Counted as if compiled again, so the cache doesn't change whether
+        # a request fits its budget
+        time_limit.spend(get_compile_work(compiled_phrase))
+        return compiled_phrase
+
+    log.debug(
+        "get_compiled_phrase: Compiling new phrase %s",
+        source_hash
+    )
+    compiled_phrase = compile_phrase(msgs, time_limit, phrase_set)
+    # Only finished phrases are stored; timeouts raise before getting here
+    cache.set(source_hash, compiled_phrase)
+    return compiled_phrase
+
+def get_compile_work(compiled_phrase):
+    # Work spent by compile_phrase, see WorkBudget
+    return len(compiled_phrase.source) + compiled_phrase.node_count
+
+def compile_phrase(msgs, time_limit, phrase_set):
+    # Parse every line of every group once, up front, in a single pass
+    # Everything goes into the flat arrays of a CompiledPhrase rather than
+    # PhrasePart objects, so many compiled phrases can be cached cheaply.
+    # Every branch is compiled, even ones never picked: counting and listing
+    # outputs (see phrase_space) visit them all anyway, and a compiled
+    # phrase is shared read-only between threads and costs the same work
+    # whether or not it's cached.
+    source_hash = CompiledPhraseCache.hash_source(phrase_set)
     # Switch to '\n' only for new lines
-    groups = groups.replace('\r', '')
+    phrase_set = phrase_set.replace('\r', '')
+    # Every character is parsed, so count them up front
+    time_limit.spend(len(phrase_set))
 
+    builder = CompiledPhraseBuilder()
     current_title = ''
+    current_line_count = 0
 
-    # Split
-    phrases_string = groups.split('\n')
-    log.debug(
-        "process_phrase_sections: Given {0} potential phrase entries"
-        .format(len(phrases_string))
-    )
-    groups_raw = []
-    current_group = []
-    for phrase_line in phrases_string:
-        if not phrase_line.strip():
+    tokens = tokenize_phrase(phrase_set)
+    for token in tokens:
+        token_type, token_value, token_pos = token
+        if token_type is TOKEN_LINE_END:
+            # Empty line, or the end of a group title
             continue
-        if phrase_line.startswith('#'):
-            log.debug(
-                "process_phrase_sections: Found a new group in line: '{0}'"
-                .format(phrase_line)
-            )
+        if token_type is TOKEN_HEADER:
             # This marks a new phrase group
-            if current_group:
+            if current_line_count:
                 log.debug(
-                    "process_phrase_sections: Saving prior group '{0}' with "
-                    "{1} entries"
-                    .format(current_title, len(current_group))
+                    "compile_phrase: Saving prior group '%s' with %s "
+                    "entries",
+                    current_title, current_line_count
                 )
-                # Add all existing to a new entry
-                groups_raw.append({
-                    'title': current_title,
-                    'phrases': current_group
-                })
+                builder.add_group(current_title)
                 # Reset the current group
-                current_group = []
-            # Grab the group title
-            # Skip over the '#' symbol, then remove any leading whitespace
-            current_title = phrase_line[1:].lstrip(" ")
-        else:
-            log.debug(
-                "process_phrase_sections: Adding regular line to current "
-                "group '{0}', line: '{1}'"
-                .format(current_title, phrase_line)
-            )
-            # Add to the existing group
-            current_group.append(phrase_line)
+                current_line_count = 0
+            current_title = token_value
+            continue
 
-    # Finish up the current group, if any
-    if current_group:
-        log.debug(
-            "process_phrase_sections: Saving final group '{0}' with {1}"
-            "entries"
-            .format(current_title, len(current_group))
+        # Anything else starts a phrase line
+        # Track any warning messages, only shown if this line is chosen
+        process_warn_details = []
+        node_count = builder.node_count
+        root_node, line_end = build_phrase_parts(
+            process_warn_details, time_limit,
+            itertools.chain((token,), tokens), phrase_set, token_pos,
+            builder = builder
         )
-        # Add all existing to a new entry
-        groups_raw.append({
-            'title': current_title,
-            'phrases': current_group
-        })
+        time_limit.spend(builder.node_count - node_count)
+        if not phrase_set[token_pos:line_end].strip():
+            continue
+        builder.add_line(
+            root_node, token_pos, line_end, process_warn_details
+        )
+        current_line_count += 1
 
-    return groups_raw
+    # Finish up the current group, if any
+    if current_line_count:
+        builder.add_group(current_title)
+
+    return builder.build(source_hash, phrase_set)
 
-def select_phrases(msgs, time_limit, raw_phrases):
+def select_phrases(msgs, time_limit, compiled_phrase, rng, annotate = True):
+    # Without annotate, each 'result' is the joined text instead of a list of
+    # choice fragments, which skips building the fragments at all
     phrases_processed = []
     log.debug(
-        "select_phrases: Given {0} phrase groups to process"
-        .format(len(raw_phrases))
+        "select_phrases: Given %s phrase groups to process",
+        compiled_phrase.group_count
     )
     
-    phrases_warned = []
+    lines_warned = []
 
     # For each group of phrases
-    for raw_phrase_group in raw_phrases:
+    for group_num, group_title in enumerate(compiled_phrase.group_titles):
         # Pick a random phrase in the group
-        group_title = raw_phrase_group['title']
-        raw_phrase = random.choice(raw_phrase_group['phrases'])
+        line_num = rng.choice(compiled_phrase.get_group_lines(group_num))
         log.debug(
-            "select_phrases: In group '{0}', picked phrase: '{1}'"
-            .format(group_title, raw_phrase)
-        )
-        # Process the raw phrase into a bunch of PhrasePart objects
-        # Track any warning messages
-        process_warn_details = []
-        chosen_phrase = flatten_phrase(
-            process_phrase_part(process_warn_details, time_limit, raw_phrase)
+            "select_phrases: In group '%s', picked phrase: '%s'",
+            group_title, compiled_phrase.get_line_source(line_num)
         )
-        if process_warn_details:
+        # Apply the random choices to the already-parsed line
+        if annotate:
+            chosen_phrase = compiled_phrase.sample_line(line_num, rng)
+            fragment_count = len(chosen_phrase)
+        else:
+            text_pieces = compiled_phrase.sample_line_text(line_num, rng)
+            fragment_count = len(text_pieces)
+            chosen_phrase = ''.join(text_pieces)
+        if time_limit is not None:
+            # The group and each fragment sampled
+            time_limit.spend(1 + fragment_count)
+        if line_num in compiled_phrase.line_warnings:
             # Something went wrong, but didn't crash.  Queue a message for it.
-            phrases_warned.append({
-                'phrase': raw_phrase,
-                'details': process_warn_details
-            })
+            lines_warned.append(line_num)
 
         # Add phrase to the list of processed phrases
         phrases_processed.append({
@@ -183,55 +404,73 @@ def select_phrases(msgs, time_limit, raw_phrases):
             'result': chosen_phrase
         })
 
-    # Check for trouble situations
-    if phrases_warned:
-        # At least one phrase had trouble being processed.  Build a message.
-        warning_details = []
-        for phrase_warned in phrases_warned:
-            # Convert the details to a friendly list
-            friendly_details = ''
-            for warning_detail in phrase_warned['details']:
-                friendly_details += " > {0}\n".format(warning_detail)
-            # Remove extra spaces at the end
-            friendly_details = friendly_details.rstrip()
-            # Create a friendly overview message
-            warning_details.append(
-                "Trouble with:\n\t\"{0}\"\nReasons:\n{1}"
-                .format(phrase_warned['phrase'], friendly_details)
-            )
-        msgs.append(
-            OpMessage(
-                MessageType.Warn,
-                "Something went wrong while building your phrases.  Double-"
-                "check that you have the right number of brackets and pipes.  "
-                "Check the Demo for some examples.",
-                "Trouble building phrases",
-                warning_details
-            )
-        )
+    # Check for trouble situations, unless the caller handles them
+    if msgs is not None:
+        append_phrase_warnings(msgs, compiled_phrase, lines_warned)
 
     log.debug(
-        "select_phrases: Processed {0} phrase groups"
-        .format(len(phrases_processed))
+        "select_phrases: Processed %s phrase groups",
+        len(phrases_processed)
     )
     # Hand 'em over
     return phrases_processed
 
-def flatten_phrase(phrase_parts):
-    phrase_array = []
-    if isinstance(phrase_parts, list):
-        for phrase_base_part in phrase_parts:
-            phrase_array.extend(flatten_phrase(phrase_base_part))
-    else:
-        phrase_result = phrase_parts.result
-        if isinstance(phrase_result, list):
-            for phrase_base_part in phrase_result:
-                phrase_array.extend(flatten_phrase(phrase_base_part))
-        else:
+def append_compiled_warnings(msgs, compiled_phrase):
+    # Warn about every line with trouble, whether or not it gets picked
+    append_phrase_warnings(
+        msgs, compiled_phrase, sorted(compiled_phrase.line_warnings)
+    )
+
+def append_phrase_warnings(msgs, compiled_phrase, lines_warned):
+    if not lines_warned:
+        return
+    # At least one phrase had trouble being processed.  Build a message.
+    warning_details = []
+    for line_num in lines_warned:
+        # Convert the details to a friendly list
+        friendly_details = ''
+        for warning_detail in compiled_phrase.get_line_warnings(line_num):
+            friendly_details += " > {0}\n".format(warning_detail)
+        # Remove extra spaces at the end
+        friendly_details = friendly_details.rstrip()
+        # Create a friendly overview message
+        line_source = compiled_phrase.get_line_source(line_num)
+        warning_details.append(
+            "Trouble with:\n\t\"{0}\"\nReasons:\n{1}"
+            .format(line_source, friendly_details)
+        )
+    msgs.append(
+        OpMessage(
+            MessageType.Warn,
+            "Something went wrong while building your phrases.  Double-"
+            "check that you have the right number of brackets and pipes.  "
+            "Check the Demo for some examples.",
+            "Trouble building phrases",
+            warning_details
+        )
+    )
+
+def flatten_phrase(phrase_parts, rng, phrase_array = None):
+    # Apply the random choices to PhrasePart objects, adding the fragments to
+    # the end of phrase_array if given
+    # Walks the parts with an explicit stack, so deep nesting doesn't run into
+    # the recursion limit or copy fragments once per level.
+    if phrase_array is None:
+        phrase_array = []
+    pending_parts = [phrase_parts]
+    while pending_parts:
+        phrase_part = pending_parts.pop()
+        if isinstance(phrase_part, list):
+            # Last in, first out, so queue up the last part first
+            pending_parts.extend(reversed(phrase_part))
+        elif isinstance(phrase_part, PhraseSinglePart):
             phrase_array.append({
-                'choice_level': phrase_parts.choice_level,
-                'result': phrase_result
+                'choice_level': phrase_part.choice_level,
+                'result': phrase_part.result
             })
+        else:
+            # Apply the random choice, then flatten whatever was chosen
+            pending_parts.append(phrase_part.get_result(rng))
 
     return phrase_array
 
@@ -242,73 +481,95 @@ def strip_escape_chars(phrase_result):
     #   \| -> |
     #   \# -> #
     #   \\ -> \
-    phrase_unescaped = phrase_result.replace("\\{", "{") \
-        .replace("\\}", "}").replace("\\|", "|")         \
-        .replace("\\#", "#").replace("\\\\", "\\")
-    return phrase_unescaped
-
-def skip_escape_char(phrase, start_index):
-    if start_index < 0 or start_index > len(phrase):
-        log.debug(
-            "skip_escape_char: start_index of {0} is out of range, "
-            "phrase length is {1}"
-            .format(start_index - 1, len(phrase))
-        )
-        return start_index
-    if phrase[start_index - 1] is '\\':
-        log.debug(
-            "skip_escape_char: Found escape code at {0}, "
-            "advancing by one manually"
-            .format(start_index - 1)
-        )
-        start_index += 1
-    return start_index
-    
-
-def process_phrase_part(msg_details, time_limit, phrase, choice_level = 0):
-    log.debug(
-        "process_phrase_part: [ENTER] Phrase is: '{0}'"
-        .format(phrase)
-    )
-    if '{' not in phrase:
-        # Handle non-bracketed text
-        # E.g. "Some text."
-        log.debug(
-            "process_phrase_part: [EXIT] No '{{' found, adding "
-            "PhraseSinglePart: '{0}'"
-            .format(phrase)
-        )
-        return PhraseSinglePart(strip_escape_chars(phrase), choice_level)
-
-    # Reference from
-    # https://stackoverflow.com/questions/15717436/js-regex-to-match-everything-inside-braces-including-nested-braces-i-want/27088184#27088184
-    # Set up
-    phrase_parts = []
+    return phrase_escape_pattern.sub(r'\1', phrase_result)
+
+def unescape_phrase_char(escaped_char):
+    # Match strip_escape_chars for a single escape code
+    if escaped_char is None:
+        # Nothing left to escape, keep the backslash
+        return '\\'
+    if escaped_char in phrase_escape_chars:
+        return escaped_char
+    # Not a known escape code, keep it as-is
+    return '\\' + escaped_char
+
+def tokenize_phrase(phrase, split_lines = True):
+    # Walk the phrase once, turning it into (type, value, position) tokens
+    # Escapes are resolved here, so the parser never looks back
+    # With split_lines, each '\n' ends a line and lines starting with '#' are
+    # group titles; otherwise the whole phrase is treated as a single line.
+    if split_lines:
+        token_pattern = phrase_line_token_pattern
+    else:
+        token_pattern = phrase_token_pattern
+    phrase_len = len(phrase)
     cur_pos = 0
-    start_index = phrase.index("{")
-    escaped_start_index = skip_escape_char(phrase, start_index)
-    # Only process beginning differently if not escaped
-
-    if (start_index > 0 and escaped_start_index is start_index):
-        # Handle non-bracketed text at the beginning
-        # E.g. "Some {text|non-text}"
-        phrase_begin = phrase[0:start_index]
-        log.debug(
-            "process_phrase_part: Found text from 0 to {0}, "
-            "adding begin PhraseSinglePart: '{1}'"
-            .format(start_index, phrase_begin)
-        )
-        phrase_parts.append(
-            PhraseSinglePart(strip_escape_chars(phrase_begin), choice_level)
-        )
-        cur_pos = start_index
-
-    # Handle all brackets
-    # Check up until end of string
-    open_brackets = 0
+    line_start = True
+    while cur_pos < phrase_len:
+        if line_start and split_lines and phrase[cur_pos] == '#':
+            # Group title, skip over the '#' symbol and leading whitespace
+            title_end = phrase.find('\n', cur_pos)
+            if title_end < 0:
+                title_end = phrase_len
+            yield (
+                TOKEN_HEADER, phrase[cur_pos + 1:title_end].lstrip(" "),
+                cur_pos
+            )
+            cur_pos = title_end
+            line_start = False
+            continue
+        line_start = False
+
+        token_match = token_pattern.match(phrase, cur_pos)
+        token_text = token_match.group()
+        token_char = token_text[0]
+        if token_char == '\\':
+            yield (
+                TOKEN_TEXT, unescape_phrase_char(token_match.group(1)),
+                cur_pos
+            )
+        elif token_char == '{':
+            yield (TOKEN_OPEN, token_char, cur_pos)
+        elif token_char == '|':
+            yield (TOKEN_PIPE, token_char, cur_pos)
+        elif token_char == '}':
+            yield (TOKEN_CLOSE, token_char, cur_pos)
+        elif token_char == '\n' and split_lines:
+            yield (TOKEN_LINE_END, token_char, cur_pos)
+            line_start = True
+        else:
+            yield (TOKEN_TEXT, token_text, cur_pos)
+        cur_pos = token_match.end()
+
+def finish_phrase_branch(builder, phrase_parts, choice_level):
+    # Simplify the parts of a finished line or bracket choice
+    if not phrase_parts:
+        # E.g. the blank side of "{|some string}"
+        return builder.add_text('', choice_level)
+    if len(phrase_parts) == 1 and builder.is_text(phrase_parts[0]):
+        return phrase_parts[0]
+    return builder.add_sequence(phrase_parts, choice_level)
+
+def build_phrase_parts(
+        msg_details, time_limit, tokens, phrase, line_start = 0,
+        choice_level = 0, builder = None):
+    # Turn the tokens of one line into PhrasePart objects, or into whatever
+    # the given builder makes (see PhrasePartBuilder)
+    # Brackets are tracked on an explicit stack rather than by recursing, so
+    # each token is only looked at once no matter how deeply it's nested.
+    if builder is None:
+        builder = phrase_part_builder
+    open_groups = []
+    phrase_parts = []
+    group_branches = None
+    text_pieces = []
+    cur_level = choice_level
+    line_end = len(phrase)
+    # Only build trace messages if someone will read them
+    trace_enabled = log.isEnabledFor(logging.DEBUG)
 
     loop_counter = 0
-    while (cur_pos < len(phrase)):
+    for token_type, token_value, token_pos in tokens:
         # Check time to avoid infinite loops, but don't always check to reduce
         # performance impact.
         if loop_counter > 100:
@@ -317,307 +578,101 @@ def process_phrase_part(msg_details, time_limit, phrase, choice_level = 0):
         else:
             loop_counter += 1
 
-        if '{' not in phrase[cur_pos:]:
-            log.debug(
-                "process_phrase_part: No more brackets left at {0} out of {1}"
-                .format(cur_pos, len(phrase))
-            )
-            # No more brackets left
+        if token_type is TOKEN_TEXT:
+            # Join neighboring text into one part later
+            text_pieces.append(token_value)
+            continue
+        if token_type is TOKEN_LINE_END:
+            line_end = token_pos
             break
 
-        start_index = phrase.index("{", cur_pos)
-        escaped_start_index = skip_escape_char(phrase, start_index)
-        if start_index != escaped_start_index:
-            # Check after any skipped escape character
-            log.debug(
-                "process_phrase_part: Found middle escape character at {0}"
-                .format(escaped_start_index)
-            )
-            if '{' not in phrase[escaped_start_index:]:
-                # No more
-                break
-            escaped_start_index = phrase.index("{", escaped_start_index)
+        if token_type is not TOKEN_OPEN and not open_groups:
+            # Pipes and closing brackets outside of any brackets are text
+            text_pieces.append(token_value)
+            continue
 
-        log.debug(
-            "process_phrase_part: Searching for '{{' at {0}, found at {1}"
-            .format(cur_pos, start_index)
-        )
-        
-        if start_index > 0 and (cur_pos + 1) < start_index:
-            # Handle non-bracketed text at the middle
-            # E.g. "Some {text|non-text} here {there}"
-            phrase_middle = phrase[cur_pos:start_index]
-            log.debug(
-                "process_phrase_part: Found text from {0} to {1}, "
-                "adding middle PhraseSinglePart: '{2}'"
-                .format(cur_pos + 1, start_index, phrase_middle)
-            )
+        if text_pieces:
             phrase_parts.append(
-                PhraseSinglePart(
-                    strip_escape_chars(phrase_middle), choice_level
-                )
+                builder.add_text(''.join(text_pieces), cur_level)
             )
-            cur_pos = start_index
-        
-        # Apply escaping
-        start_index = escaped_start_index
-
-        # Find all brackets
-        cur_pos = start_index
-        loop_counter_inner = 0
-        while (cur_pos < len(phrase)):
-            # Check time to avoid infinite loops, but don't always check to reduce
-            # performance impact.
-            if loop_counter_inner > 100:
-                loop_counter_inner = 0
-                time_limit.check()
-            else:
-                loop_counter_inner += 1
-            # Grab the current character
-            cur_char = phrase[cur_pos]
-            if cur_char is '\\':
-                # Skip the current and next character
-                log.debug(
-                    "process_phrase_part: Skipping escape char at {0}"
-                    .format(cur_pos)
-                )
-                cur_pos += 2
-                continue
-
-            if cur_char is '{':
-                open_brackets += 1
-                log.debug(
-                    "process_phrase_part: Found '{{' at {0}, {1} open brackets"
-                    .format(cur_pos, open_brackets)
-                )
-            elif cur_char is '}':
-                open_brackets -= 1
-                log.debug(
-                    "process_phrase_part: Found '}}' at {0}, {1} open brackets"
-                    .format(cur_pos, open_brackets)
-                )
+            text_pieces = []
 
-            if open_brackets is 0:
-                # Found a complete section, parse it
-                # Add +1 to start_index to skip the given character
-                phrase_contents = phrase[start_index + 1:cur_pos]
-                cur_pos = start_index + 1 + len(phrase_contents)
+        if token_type is TOKEN_OPEN:
+            # Start of a new choice, e.g. "{text|non-text}"
+            if trace_enabled:
                 log.debug(
-                    "process_phrase_part: Found complete section at {0} to "
-                    "{1}, contents: '{2}'"
-                    .format(start_index + 1, cur_pos, phrase_contents)
-                )
-                phrase_parts.append(
-                    process_phrase_subsections(
-                        msg_details, time_limit, phrase_contents,
-                        choice_level + 1
-                    )
+                    "build_phrase_parts: Found '{' at %s, %s open brackets",
+                    token_pos - line_start, len(open_groups) + 1
                 )
-                # Found, escape out to check for others
-                # Go to the next character
-                cur_pos += 1
-                break
-
-            # Go to the next character
-            cur_pos += 1
-
-    if open_brackets is not 0:
-        # A bracket wasn't closed somewhere.  Reset from start_index, treat
-        # as if it's a regular phrase.
-        log.warn(
-            "process_phrase_part: Open brackets is {0}, expected zero.  "
-            "Missing bracket maybe?  Resetting cur_pos from {1} to {2}"
-            .format(open_brackets, cur_pos, start_index)
-        )
-        msg_details.append(
-            "Open brackets is {0}, expected zero by {1}, check near {2}.  "
-            "Too many open/missing close brackets, maybe?"
-            .format(open_brackets, cur_pos, start_index)
-        )
-        cur_pos = start_index
-
-    if cur_pos < len(phrase):
-        # Handle any dangling non-bracketed text
-        # E.g. "{text|non-text} here"
-        phrase_end = phrase[cur_pos:]
-        if (cur_pos + 1 == len(phrase)) and phrase_end is '}':
-            log.debug(
-                "process_phrase_part: Reached {0} out of {1} characters, but "
-                "last character is a '}}'.  Skipping '}}'."
-                .format(cur_pos, len(phrase))
+            open_groups.append((phrase_parts, group_branches, token_pos))
+            phrase_parts = []
+            group_branches = []
+            cur_level += 1
+        elif token_type is TOKEN_PIPE:
+            # Finish the current choice, start the next one
+            group_branches.append(
+                finish_phrase_branch(builder, phrase_parts, cur_level)
             )
+            phrase_parts = []
         else:
-            log.debug(
-                "process_phrase_part: Reached {0} out of {1} characters,"
-                " adding end PhraseSinglePart: '{2}'"
-                .format(cur_pos, len(phrase), phrase_end)
-            )
-            phrase_parts.append(
-                PhraseSinglePart(strip_escape_chars(phrase_end), choice_level)
+            # Closing bracket, finish the whole group
+            group_branches.append(
+                finish_phrase_branch(builder, phrase_parts, cur_level)
             )
-
-    log.debug(
-        "process_phrase_part: [EXIT] Finished processing phrase: '{0}'"
-        .format(phrase)
-    )
-    
-    return phrase_parts
-
-def process_phrase_subsections(
-        msg_details, time_limit, phrase_subsections, choice_level):
-    # Handle splitting up sections inside a phrase
-    # Need to handle escaped '|' symbols
-    log.debug(
-        "process_phrase_subsections: [ENTER] Phrase subsections are: '{0}'"
-        .format(phrase_subsections)
-    )
-
-    if '|' not in phrase_subsections:
-        # Handle text
-        # E.g. "Some text."
-        log.debug(
-            "process_phrase_subsections: No '|' found, processing "
-            "phrase: '{0}'"
-            .format(phrase_subsections)
-        )
-        return process_phrase_part(
-            msg_details, time_limit, phrase_subsections, choice_level
-        )
-
-    phrase_subsections += "|"
-    log.debug(
-        "process_phrase_subsections: Adding extra '|' for processing, new "
-        "result: '{0}'"
-        .format(phrase_subsections)
-    )
-
-    open_brackets = 0
-    split_start = 0 #phrase_subsections.index("|")
-    split_pos = 0
-    split_entries = []
-    split_last_empty = False
-
-    loop_counter = 0
-
-    while (split_pos < len(phrase_subsections)):
-        # Check time to avoid infinite loops, but don't always check to reduce
-        # performance impact.
-        if loop_counter > 100:
-            loop_counter = 0
-            time_limit.check()
-        else:
-            loop_counter += 1
-
-        # Grab the current character
-        cur_char = phrase_subsections[split_pos]
-        
-        if cur_char is '\\':
-            # Skip the current and next character
-            split_pos += 2
-            continue
-
-        if cur_char is '{':
-            open_brackets += 1
-            log.debug(
-                "process_phrase_subsections: Found '{{' at {0}, {1} open "
-                "brackets"
-                .format(split_pos, open_brackets)
-            )
-        elif cur_char is '}':
-            open_brackets -= 1
-            log.debug(
-                "process_phrase_subsections: Found '}}' at {0}, {1} open "
-                "brackets"
-                .format(split_pos, open_brackets)
-            )
-
-        if cur_char is '|':
-            if open_brackets is not 0:
-                # Skip the current character
+            if trace_enabled:
                 log.debug(
-                    "process_phrase_subsections: Found '|' at {0} with open "
-                    "bracket level {1}, ignoring"
-                    .format(split_pos, open_brackets)
+                    "build_phrase_parts: Found '}' at %s, %s choices at "
+                    "depth %s",
+                    token_pos - line_start, len(group_branches), cur_level
                 )
+            if len(group_branches) == 1:
+                # Nothing to choose from, e.g. "{text}"
+                group_part = group_branches[0]
             else:
-                # New split detected
-                # Found a complete section, parse it
-                # Add +1 to start_index to skip the given character, unless
-                # it's the first run.
-                if split_start is not 0 or split_last_empty:
-                    log.debug(
-                        "process_phrase_subsections: Skipping split start "
-                        "ahead from {0} to {1}, split_last_empty = {2}, prior "
-                        "contents: '{3}'"
-                        .format(
-                            split_start, split_start + 1, split_last_empty,
-                            phrase_subsections[split_start:split_pos]
-                        )
-                    )
-                    split_start += 1
-                phrase_piece = phrase_subsections[split_start:split_pos]
-                split_pos = split_start + len(phrase_piece)
-                log.debug(
-                    "process_phrase_subsections: Found complete section at "
-                    "{0} to {1}, contents: '{2}'"
-                    .format(split_start, split_pos, phrase_piece)
-                )
-                split_entries.append(
-                    process_phrase_part(
-                        msg_details, time_limit, phrase_piece, choice_level
-                    )
-                )
-                if (split_start is 0 and split_pos is 0):
-                    # Special case for "{|some string}" when the first is
-                    # picked.
-                    split_last_empty = True
-                    log.debug(
-                        "process_phrase_subsections: Included blank from "
-                        "start of string complete section"
-                    )
-                else:
-                    split_last_empty = False
-
-                # Added split, don't try to add from it again
-                split_start = split_pos
-
-        # Go to the next character
-        split_pos += 1
-
-    if open_brackets is not 0:
-        # A bracket wasn't closed somewhere.
-        log.warn(
-            "process_phrase_subsections: Open brackets is {0}, expected "
-            "zero."
-            .format(open_brackets)
+                group_part = builder.add_choice(group_branches, cur_level)
+            phrase_parts, group_branches, _ = open_groups.pop()
+            cur_level -= 1
+            phrase_parts.append(group_part)
+
+    if open_groups:
+        # A bracket wasn't closed somewhere.  Reset from the first unclosed
+        # bracket, treat as if it's a regular phrase.
+        phrase_parts, _, start_index = open_groups[0]
+        log.warning(
+            "build_phrase_parts: Open brackets is %s, expected zero.  "
+            "Missing bracket maybe?  Resetting from %s to %s",
+            len(open_groups), line_end - line_start, start_index - line_start
         )
         msg_details.append(
-            "Open brackets is {0}, expected zero.  "
+            "Open brackets is {0}, expected zero by {1}, check near {2}.  "
             "Too many open/missing close brackets, maybe?"
-            .format(open_brackets)
+            .format(
+                len(open_groups), line_end - line_start,
+                start_index - line_start
+            )
         )
+        cur_level = choice_level
+        text_pieces = [strip_escape_chars(phrase[start_index:line_end])]
+
+    if text_pieces:
+        phrase_parts.append(builder.add_text(''.join(text_pieces), cur_level))
 
-    if split_pos < len(phrase_subsections):
-        # Grab the last entry
-        # It might be a blank entry, e.g. {word|} would have a blank at end
-        phrase_end = phrase_subsections[split_pos:]
+    if trace_enabled:
         log.debug(
-            "process_phrase_subsections: Reached {0} out of {1} characters, "
-            "processing end phrase: '{2}'"
-            .format(split_pos, len(phrase_subsections), phrase_end)
-        )
-        split_entries.append(
-            process_phrase_part(
-                msg_details, time_limit, phrase_end, choice_level
-            )
+            "build_phrase_parts: Finished processing phrase: '%s'",
+            phrase[line_start:line_end]
         )
+    return (
+        finish_phrase_branch(builder, phrase_parts, choice_level), line_end
+    )
 
-    log.debug(
-        "process_phrase_subsections: [EXIT] Finished processing phrase "
-        "subsections: '{0}'"
-        .format(phrase_subsections))
-
-    return PhraseMultiPart(split_entries, choice_level)
+def process_phrase_part(msg_details, time_limit, phrase, choice_level = 0):
+    # Parse a single phrase line into PhrasePart objects
+    phrase_parts, _ = build_phrase_parts(
+        msg_details, time_limit, tokenize_phrase(phrase, False), phrase, 0,
+        choice_level
+    )
+    return phrase_parts
 
 # Keep phrases
 class PhrasePart(object):
@@ -627,16 +682,12 @@ class PhrasePart(object):
     def choice_level(self): raise NotImplementedError
 
     @abstractmethod
-    def result(self): raise NotImplementedError
+    def get_result(self, rng): raise NotImplementedError
 
 class PhraseSinglePart(PhrasePart):
     def __init__(self, phrase, choice_level = 0):
         self.phrase = phrase
         self.choice_level_internal = choice_level
-        log.debug(
-            "PhraseSinglePart: Creating new at depth {0}, from phrase: '{1}'"
-            .format(choice_level, phrase)
-        )
 
     @property
     def choice_level(self):
@@ -646,6 +697,9 @@ class PhraseSinglePart(PhrasePart):
     def result(self):
         return self.phrase
 
+    def get_result(self, rng):
+        return self.phrase
+
     def __str__(self):
         return self.phrase
 
@@ -653,20 +707,13 @@ class PhraseMultiPart(PhrasePart):
     def __init__(self, phrases, choice_level = 0):
         self.phrases = phrases
         self.choice_level_internal = choice_level
-        log.debug(
-            "PhraseMultiPart: Creating new at depth {0}, from {1} "
-            "phrases: '{2}'"
-            .format(choice_level, len(phrases), str(phrases))
-        )
 
     @property
     def choice_level(self):
         return self.choice_level_internal
 
-    @property
-    def result(self):
-        phrase_result = random.choice(self.phrases)
-        return random.choice(self.phrases)
+    def get_result(self, rng):
+        return rng.choice(self.phrases)
 
     def __str__(self):
         result_str = ''
@@ -677,3 +724,21 @@ class PhraseMultiPart(PhrasePart):
                 result_str += "'{0}', ".format(str(phrase_entry))
         # Remove the trailing space and comma
         return "[{0}]".format(result_str[:-2])
+
+# Make PhrasePart objects for build_phrase_parts
+class PhrasePartBuilder(object):
+    # A line or branch with several parts is a plain list of them
+    def add_text(self, text, choice_level):
+        return PhraseSinglePart(text, choice_level)
+
+    def is_text(self, phrase_part):
+        return isinstance(phrase_part, PhraseSinglePart)
+
+    def add_sequence(self, phrase_parts, choice_level):
+        return phrase_parts
+
+    def add_choice(self, phrase_branches, choice_level):
+        return PhraseMultiPart(phrase_branches, choice_level)
+
+# Nothing is kept between calls, so one builder does for everyone
+phrase_part_builder = PhrasePartBuilder()
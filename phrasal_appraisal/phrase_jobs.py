@@ -0,0 +1,548 @@
+import logging
+log = logging.getLogger(__name__)
+
+# Run big generation requests in the background, e.g. a million samples or
+# every output of a phrase set, instead of within a request
+# Everything about a job is kept in its own directory of a spool directory
+# on disk: job.json with its state, and the result once done.  Finished
+# jobs are deleted after a while.  Several server processes can share a
+# spool directory; each job is only ever run by one of them at a time.
+
+import atexit
+import fcntl
+import json
+import multiprocessing
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from .metrics import metrics_registry
+from .op_messages import (
+    parse_messages,
+    MessageType,
+    OpMessage
+)
+from .phrase_groups import (
+    append_compiled_warnings,
+    append_phrase_exception,
+    append_phrase_timeout,
+    get_batch_seed,
+    get_compiled_phrase,
+    iter_phrase_samples,
+    join_phrase_result,
+    make_work_budget
+)
+from .phrase_results import encode_phrase_stream
+from .phrase_space import (
+    count_compiled_phrase,
+    iter_phrase_outputs,
+    iter_unique_phrase_samples
+)
+from .time_limiter import TimeoutException
+
+# Most samples or outputs a single job can make
+max_job_samples = 1000000
+# Keep finished jobs this long by default
+default_job_max_age_sec = 24 * 3600
+# Check for expired jobs this often
+job_prune_interval_sec = 60
+# Save progress this often while running
+job_progress_interval_sec = 0.5
+# Look for a cancel marker left by another process this often while running
+job_cancel_check_sec = 0.5
+
+# Job states
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+finished_job_states = frozenset((JOB_DONE, JOB_FAILED, JOB_CANCELLED))
+
+# Kinds of job
+JOB_SAMPLES = 'samples'
+JOB_UNIQUE = 'unique'
+JOB_OUTPUTS = 'outputs'
+
+job_state_name = 'job.json'
+job_claim_name = 'claim.lock'
+job_cancel_name = 'cancel'
+job_result_part_name = 'result.part'
+job_result_names = {'ndjson': 'result.ndjson', 'text': 'result.txt'}
+# Job IDs come from clients, so only ever use ones that look right
+job_id_pattern = re.compile(r'^[0-9a-f]{32}$')
+
+class PhraseJobCancelled(Exception):
+    """Raise for when a running job is cancelled."""
+
+def save_job_state(job_dir, job_state):
+    # Replace the whole file at once, so it's never read half-written
+    job_state['updated'] = time.time()
+    state_path = os.path.join(job_dir, job_state_name)
+    with open(state_path + '.tmp', 'w') as state_file:
+        json.dump(job_state, state_file)
+    os.replace(state_path + '.tmp', state_path)
+
+def load_job_state(job_dir):
+    try:
+        with open(os.path.join(job_dir, job_state_name)) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return None
+
+def claim_job(job_dir):
+    # Returns an open file holding an exclusive lock on the job, or None if
+    # another worker has it, in this process or any other sharing the spool
+    # Close the file to let go.  The lock goes away with the process holding
+    # it, so jobs left running by a crashed server can be claimed again.
+    try:
+        claim_file = open(os.path.join(job_dir, job_claim_name), 'a')
+    except OSError:
+        # Expired and deleted
+        return None
+    try:
+        fcntl.flock(claim_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        claim_file.close()
+        return None
+    return claim_file
+
+def make_cancel_check(job_dir, cancel_event):
+    # Returns a function for run_phrase_job's is_cancelled, which also looks
+    # for the cancel marker written by cancel_job in any process sharing the
+    # spool, setting cancel_event once it's there
+    cancel_path = os.path.join(job_dir, job_cancel_name)
+    next_check_time = 0
+    def is_cancelled():
+        nonlocal next_check_time
+        if cancel_event.is_set():
+            return True
+        if time.monotonic() < next_check_time:
+            return False
+        next_check_time = time.monotonic() + job_cancel_check_sec
+        if os.path.exists(cancel_path):
+            cancel_event.set()
+            return True
+        return False
+    return is_cancelled
+
+def prepare_job_samples(msgs, job_params, time_limit):
+    # Returns how many samples the job makes and an iterator over them
+    compiled_phrase = get_compiled_phrase(
+        msgs, time_limit, job_params['phrases']
+    )
+    append_compiled_warnings(msgs, compiled_phrase)
+    count = job_params['count']
+    # Text lines can't show choices
+    annotate = job_params['annotate'] and job_params['format'] == 'ndjson'
+    if job_params['kind'] == JOB_SAMPLES:
+        return count, iter_phrase_samples(
+            compiled_phrase, count, job_params['seed'],
+            job_params['seed_per_sample'], time_limit, annotate
+        )
+    count = min(count, count_compiled_phrase(compiled_phrase).total)
+    if job_params['kind'] == JOB_UNIQUE:
+        return count, iter_unique_phrase_samples(
+            compiled_phrase, count, random.Random(job_params['seed']),
+            time_limit, annotate
+        )
+    def iter_outputs():
+        # Every output in order, like the outputs API
+        for output_index, chosen_phrases in iter_phrase_outputs(
+                compiled_phrase, 0, count, 1, time_limit):
+            if not annotate:
+                for chosen_phrase in chosen_phrases:
+                    chosen_phrase['result'] = join_phrase_result(
+                        chosen_phrase['result']
+                    )
+            yield dict(index=output_index, phrases=chosen_phrases)
+    return count, iter_outputs()
+
+def run_phrase_job(job_dir, is_cancelled):
+    # Make a job's result, saving progress as it goes
+    # is_cancelled is called after every sample; once it returns True, the
+    # job stops and its partial result is deleted.
+    job_state = load_job_state(job_dir)
+    job_params = job_state['params']
+    job_state.update(status=JOB_RUNNING, started=time.time(), done=0)
+    save_job_state(job_dir, job_state)
+    log.info("jobs: Running job %s", job_state['id'])
+
+    msgs = []
+    time_limit = make_work_budget('job')
+    part_path = os.path.join(job_dir, job_result_part_name)
+    def track_progress(samples):
+        next_save_time = time.monotonic() + job_progress_interval_sec
+        for sample in samples:
+            if is_cancelled():
+                raise PhraseJobCancelled()
+            yield sample
+            job_state['done'] += 1
+            if time.monotonic() > next_save_time:
+                save_job_state(job_dir, job_state)
+                next_save_time = time.monotonic() + job_progress_interval_sec
+    try:
+        job_state['total'], samples = prepare_job_samples(
+            msgs, job_params, time_limit
+        )
+        with open(part_path, 'wb') as part_file:
+            for chunk in encode_phrase_stream(
+                    track_progress(samples), job_params['format']):
+                part_file.write(chunk)
+        os.replace(
+            part_path,
+            os.path.join(job_dir, job_result_names[job_params['format']])
+        )
+        job_state['status'] = JOB_DONE
+    except PhraseJobCancelled:
+        job_state['status'] = JOB_CANCELLED
+    except TimeoutException as e:
+        job_state['status'] = JOB_FAILED
+        append_phrase_timeout(msgs, time_limit, e)
+    except Exception as e:
+        job_state['status'] = JOB_FAILED
+        append_phrase_exception(msgs, e)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    job_state['messages'] = parse_messages(msgs)
+    job_state['finished'] = time.time()
+    save_job_state(job_dir, job_state)
+    log.info("jobs: Job %s is %s", job_state['id'], job_state['status'])
+
+def run_phrase_job_process(job_dir, parent_pid):
+    # Run in a process of its own, which is killed to cancel it
+    # The parent holds the job's claim, so if it dies, stop without saving
+    # anything and leave the job to whoever claims it next
+    def is_cancelled():
+        if os.getppid() != parent_pid:
+            raise SystemExit(1)
+        return False
+    run_phrase_job(job_dir, is_cancelled)
+
+class PhraseJobQueue(object):
+    # Runs jobs one at a time on each of a few background threads
+    # In 'process' mode, each thread runs its jobs in a separate process
+    # instead, so they don't compete with requests for the GIL.  Jobs
+    # still queued or running when the server stops are run again once it
+    # (or another server sharing the spool) starts back up.  Workers claim
+    # each job before running it, see claim_job.
+    def __init__(self):
+        self.spool_dir = None
+        self.worker_count = 0
+        self.mode = 'thread'
+        self.max_age_sec = default_job_max_age_sec
+        self.job_queue = queue.Queue()
+        # Cancel events of running jobs, by job ID
+        self.running_jobs = {}
+        self.lock = threading.Lock()
+        self.workers = []
+        self.workers_stop = None
+        self.exit_registered = False
+
+    @property
+    def enabled(self):
+        return self.spool_dir is not None
+
+    @property
+    def queued_count(self):
+        return self.job_queue.qsize()
+
+    @property
+    def running_count(self):
+        return len(self.running_jobs)
+
+    def configure(self, settings):
+        # e.g.
+        #   phrase_jobs.spool_dir = %(here)s/phrase_jobs
+        #   phrase_jobs.workers = 1
+        #   phrase_jobs.mode = process
+        #   phrase_jobs.max_age_hours = 24
+        # Without a spool_dir, jobs are turned off
+        self.close()
+        spool_dir = settings.get('phrase_jobs.spool_dir')
+        if not spool_dir:
+            self.spool_dir = None
+            return
+        self.spool_dir = spool_dir
+        self.worker_count = int(settings.get('phrase_jobs.workers', 1))
+        self.mode = settings.get('phrase_jobs.mode', 'thread')
+        if self.mode not in ('thread', 'process'):
+            raise ValueError(
+                "Unknown phrase_jobs.mode '{0}'".format(self.mode)
+            )
+        self.max_age_sec = float(settings.get(
+            'phrase_jobs.max_age_hours', default_job_max_age_sec / 3600
+        )) * 3600
+        os.makedirs(spool_dir, exist_ok=True)
+        self.job_queue = queue.Queue()
+        self.recover_jobs()
+        self.start()
+
+    def start(self):
+        self.workers_stop = threading.Event()
+        self.workers = []
+        for worker_num in range(self.worker_count):
+            worker = threading.Thread(
+                target=self.run_worker, args=(self.workers_stop,),
+                name='phrase-jobs-{0}'.format(worker_num)
+            )
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        if not self.exit_registered:
+            atexit.register(self.close)
+            self.exit_registered = True
+
+    def close(self):
+        # Stop the workers; running jobs are cancelled, and run again from
+        # the start next time
+        if self.workers_stop is None:
+            return
+        self.workers_stop.set()
+        with self.lock:
+            for cancel_event in self.running_jobs.values():
+                cancel_event.set()
+        for worker in self.workers:
+            self.job_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.workers_stop = None
+
+    def get_job_dir(self, job_id):
+        if not self.enabled or not job_id_pattern.match(job_id):
+            return None
+        return os.path.join(self.spool_dir, job_id)
+
+    def recover_jobs(self):
+        # Queue up anything left over from before a restart, oldest first
+        # Jobs claimed by another process sharing the spool are left alone;
+        # anything else unfinished was left by a server that stopped.
+        recovered_jobs = []
+        for job_id in os.listdir(self.spool_dir):
+            job_dir = self.get_job_dir(job_id)
+            if job_dir is None:
+                continue
+            claim_file = claim_job(job_dir)
+            if claim_file is None:
+                continue
+            try:
+                job_state = load_job_state(job_dir)
+                if (job_state is None
+                        or job_state['status'] in finished_job_states):
+                    continue
+                if job_state['status'] != JOB_QUEUED:
+                    job_state['status'] = JOB_QUEUED
+                    save_job_state(job_dir, job_state)
+            finally:
+                claim_file.close()
+            recovered_jobs.append((job_state['created'], job_id))
+        for _, job_id in sorted(recovered_jobs):
+            self.job_queue.put(job_id)
+        if recovered_jobs:
+            log.info("jobs: Queued %s unfinished jobs", len(recovered_jobs))
+
+    def submit_job(self, job_params):
+        # Returns the state of the new job; see PhraseJobForm for the params
+        job_params = dict(job_params)
+        # Always seeded, so a job run again after a restart is the same
+        job_params['seed'] = get_batch_seed(job_params['seed'], True)
+        job_id = uuid.uuid4().hex
+        job_dir = self.get_job_dir(job_id)
+        os.makedirs(job_dir)
+        job_state = dict(
+            id=job_id, status=JOB_QUEUED, params=job_params,
+            created=time.time(), done=0, total=job_params['count'],
+            messages=[]
+        )
+        save_job_state(job_dir, job_state)
+        self.job_queue.put(job_id)
+        log.info("jobs: Queued job %s", job_id)
+        return job_state
+
+    def get_job_state(self, job_id):
+        # None if there's no such job, or it expired
+        job_dir = self.get_job_dir(job_id)
+        if job_dir is None:
+            return None
+        return load_job_state(job_dir)
+
+    def get_job_result_path(self, job_id):
+        # None unless the job is done
+        job_state = self.get_job_state(job_id)
+        if job_state is None or job_state['status'] != JOB_DONE:
+            return None
+        return os.path.join(
+            self.get_job_dir(job_id),
+            job_result_names[job_state['params']['format']]
+        )
+
+    def cancel_job(self, job_id):
+        # Returns the job's state, or None if there's no such job
+        job_dir = self.get_job_dir(job_id)
+        if job_dir is None:
+            return None
+        with self.lock:
+            cancel_event = self.running_jobs.get(job_id)
+            if cancel_event is not None:
+                # The worker running it saves it as cancelled
+                cancel_event.set()
+                return load_job_state(job_dir)
+            claim_file = claim_job(job_dir)
+            if claim_file is None:
+                # Starting here, or running in another process; leave a
+                # marker for whichever worker has it, see make_cancel_check
+                job_state = load_job_state(job_dir)
+                if (job_state is not None
+                        and job_state['status'] not in finished_job_states):
+                    with open(os.path.join(job_dir, job_cancel_name), 'w'):
+                        pass
+                return job_state
+            try:
+                job_state = load_job_state(job_dir)
+                if (job_state is not None
+                        and job_state['status'] == JOB_QUEUED):
+                    job_state['status'] = JOB_CANCELLED
+                    job_state['finished'] = time.time()
+                    save_job_state(job_dir, job_state)
+            finally:
+                claim_file.close()
+        return job_state
+
+    def wait_for_job(self, job_id, timeout_sec = None):
+        # Mostly for tests and scripts; returns the job's latest state
+        end_time = None
+        if timeout_sec is not None:
+            end_time = time.monotonic() + timeout_sec
+        while True:
+            job_state = self.get_job_state(job_id)
+            if job_state is None or job_state['status'] in finished_job_states:
+                return job_state
+            if end_time is not None and time.monotonic() > end_time:
+                return job_state
+            time.sleep(0.05)
+
+    def prune_jobs(self):
+        # Delete finished jobs once they're too old
+        expire_time = time.time() - self.max_age_sec
+        for job_id in os.listdir(self.spool_dir):
+            job_dir = self.get_job_dir(job_id)
+            if job_dir is None:
+                continue
+            job_state = load_job_state(job_dir)
+            if job_state is None:
+                # Broken, or only just being made
+                if os.path.getmtime(job_dir) < expire_time:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+                continue
+            if (job_state['status'] in finished_job_states
+                    and job_state['updated'] < expire_time):
+                log.info("jobs: Deleting expired job %s", job_id)
+                shutil.rmtree(job_dir, ignore_errors=True)
+
+    def run_worker(self, workers_stop):
+        next_prune_time = 0
+        while not workers_stop.is_set():
+            if time.monotonic() > next_prune_time:
+                try:
+                    self.prune_jobs()
+                except OSError as e:
+                    log.error("jobs: Couldn't prune jobs: %s", e)
+                next_prune_time = time.monotonic() + job_prune_interval_sec
+            try:
+                job_id = self.job_queue.get(timeout=job_prune_interval_sec)
+            except queue.Empty:
+                continue
+            if job_id is None:
+                # Stopping
+                return
+            job_dir = self.get_job_dir(job_id)
+            claim_file = claim_job(job_dir)
+            if claim_file is None:
+                # Run by another worker, maybe in another process
+                continue
+            try:
+                self.run_claimed_job(job_id, job_dir, workers_stop)
+            finally:
+                claim_file.close()
+
+    def run_claimed_job(self, job_id, job_dir, workers_stop):
+        # Call with the job claimed, see claim_job
+        cancel_event = threading.Event()
+        with self.lock:
+            job_state = load_job_state(job_dir)
+            if job_state is None or job_state['status'] != JOB_QUEUED:
+                # Cancelled, expired or already run while waiting
+                return
+            self.running_jobs[job_id] = cancel_event
+        try:
+            if self.mode == 'process':
+                self.run_job_process(job_dir, cancel_event)
+            else:
+                run_phrase_job(
+                    job_dir, make_cancel_check(job_dir, cancel_event)
+                )
+        except Exception as e:
+            log.error(
+                "jobs: Job %s failed: %s", job_id, e, exc_info = True
+            )
+        finally:
+            with self.lock:
+                del self.running_jobs[job_id]
+        if (workers_stop.is_set() and cancel_event.is_set()
+                and not os.path.exists(
+                    os.path.join(job_dir, job_cancel_name))):
+            # Stopped by close rather than a client, so run it again
+            # next time
+            job_state = load_job_state(job_dir)
+            job_state['status'] = JOB_QUEUED
+            save_job_state(job_dir, job_state)
+
+    def run_job_process(self, job_dir, cancel_event):
+        job_process = multiprocessing.get_context('spawn').Process(
+            target=run_phrase_job_process, args=(job_dir, os.getpid()),
+            name='phrase-job'
+        )
+        job_process.daemon = True
+        job_process.start()
+        is_cancelled = make_cancel_check(job_dir, cancel_event)
+        while job_process.is_alive():
+            if cancel_event.wait(0.1) or is_cancelled():
+                job_process.kill()
+            job_process.join(0.1)
+        job_state = load_job_state(job_dir)
+        if job_state['status'] not in finished_job_states:
+            # Killed, or crashed before it could say
+            if cancel_event.is_set():
+                job_state['status'] = JOB_CANCELLED
+            else:
+                job_state['status'] = JOB_FAILED
+                job_state['messages'] = parse_messages([
+                    OpMessage(
+                        MessageType.Danger,
+                        "It might've run out of memory.",
+                        "Something unexpected happened",
+                        "The job stopped without finishing."
+                    )
+                ])
+            job_state['finished'] = time.time()
+            part_path = os.path.join(job_dir, job_result_part_name)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            save_job_state(job_dir, job_state)
+
+phrase_jobs = PhraseJobQueue()
+metrics_registry.callback(
+    'phrasal_jobs_queued', 'Background jobs waiting to run',
+    lambda: phrase_jobs.queued_count
+)
+metrics_registry.callback(
+    'phrasal_jobs_running', 'Background jobs running now',
+    lambda: phrase_jobs.running_count
+)
@@ -0,0 +1,205 @@
+import logging
+log = logging.getLogger(__name__)
+
+import html
+import json
+import re
+import threading
+
+from array import array
+from collections import OrderedDict
+
+from .op_messages import parse_messages
+
+# Typecode for fragment lengths and choice levels
+span_typecode = 'I'
+# Choice levels past this all look the same
+max_styled_choice_level = 8
+# CSS classes for each choice level, worked out on first use
+fragment_classes = {}
+
+# Keep generated phrases compactly, e.g. for storing between requests
+def pack_phrase_results(phrases_processed):
+    # Turn the output of select_phrases into one
+    # {'title', 'text', 'spans'} dict per group, where text is the joined
+    # result and spans is a flat array of (length, choice_level) pairs, one
+    # per fragment.  Each fragment starts where the one before it ends.
+    packed_results = []
+    for chosen_phrase in phrases_processed:
+        text_pieces = []
+        spans = array(span_typecode)
+        for phrase_item in chosen_phrase['result']:
+            text_pieces.append(phrase_item['result'])
+            spans.append(len(phrase_item['result']))
+            spans.append(phrase_item['choice_level'])
+        packed_results.append({
+            'title': chosen_phrase['title'],
+            'text': ''.join(text_pieces),
+            'spans': spans
+        })
+    return packed_results
+
+def get_fragment_class(choice_level):
+    fragment_class = fragment_classes.get(choice_level)
+    if fragment_class is None:
+        if not choice_level:
+            fragment_class = 'phrase-results-normal'
+        else:
+            fragment_class = (
+                'phrase-results-highlight phrase-results-depth-{0}'
+                .format(choice_level)
+            )
+            if choice_level > max_styled_choice_level:
+                fragment_class += ' phrase-results-depth-max'
+        fragment_classes[choice_level] = fragment_class
+    return fragment_class
+
+def render_result_html(packed_result):
+    # One <span> per fragment, styled by how deeply it was chosen
+    return ''.join(
+        '<span class="{0}">{1}</span>'.format(
+            get_fragment_class(choice_level), html.escape(text)
+        )
+        for choice_level, text in iter_result_fragments(packed_result)
+    )
+
+def iter_result_fragments(packed_result):
+    # Yield (choice_level, text) for each fragment of one packed group
+    text = packed_result['text']
+    spans = packed_result['spans']
+    text_start = 0
+    for span_num in range(0, len(spans), 2):
+        text_end = text_start + spans[span_num]
+        yield spans[span_num + 1], text[text_start:text_end]
+        text_start = text_end
+
+def convert_results_to_record(packed_results):
+    # Plain values that can be saved, see phrase_backend
+    if not packed_results:
+        return []
+    return [
+        {
+            'title': packed_result['title'],
+            'text': packed_result['text'],
+            'spans': packed_result['spans'].tolist()
+        }
+        for packed_result in packed_results
+    ]
+
+def results_from_record(results_record):
+    if not results_record:
+        return []
+    packed_results = []
+    for result_record in results_record:
+        if 'spans' not in result_record:
+            # Saved before results were packed
+            packed_results.extend(pack_phrase_results([result_record]))
+            continue
+        packed_results.append(dict(
+            result_record, spans=array(span_typecode, result_record['spans'])
+        ))
+    return packed_results
+
+# Keep results rendered to HTML for page views
+class RenderedResultsCache(object):
+    # Results only change when they're generated again, so every view of
+    # them can share one rendering.  Kept apart from the phrase groups, so
+    # only groups that are being looked at take up room for their HTML.
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.rendered_results = OrderedDict()
+        # Shared between request threads
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rendered_results)
+
+    def get_results_html(self, render_key, packed_results):
+        # One HTML string per packed group; render_key must change whenever
+        # the results do, e.g. the group's UUID and when they were made
+        with self.lock:
+            results_html = self.rendered_results.get(render_key)
+            if results_html is not None:
+                # Mark as most recently used
+                self.rendered_results.move_to_end(render_key)
+                return results_html
+        # Rendering the same results twice is harmless, so not locked
+        results_html = [
+            render_result_html(packed_result)
+            for packed_result in packed_results or ()
+        ]
+        with self.lock:
+            self.rendered_results[render_key] = results_html
+            self.rendered_results.move_to_end(render_key)
+            # Clean up the least recently viewed results
+            while len(self.rendered_results) > self.max_entries:
+                self.rendered_results.popitem(last=False)
+        return results_html
+
+    def clear(self):
+        with self.lock:
+            self.rendered_results.clear()
+
+# Results of the most recently viewed groups
+max_rendered_results = 64
+rendered_results_cache = RenderedResultsCache(max_rendered_results)
+
+# Samples sent in one go when streaming or saving many samples
+stream_chunk_samples = 100
+# Characters that would break up text lines, and how they're written
+stream_text_escapes = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+stream_text_escape_pattern = re.compile(r'[\\\t\n\r]')
+
+def encode_phrase_stream(samples, stream_format, msgs = None):
+    # Turn samples into chunks of lines, one sample per line
+    # NDJSON lines are whole samples; text lines are each group's phrase,
+    # separated by tabs (text samples must not be annotated), see
+    # encode_stream_text
+    # Anything already in msgs, e.g. warnings from compiling, is sent before
+    # the first sample; messages added while making the samples, e.g. if the
+    # work budget ran out, after the last one.  See encode_stream_messages.
+    message_count = 0
+    chunk = []
+    if msgs is not None:
+        message_count = len(msgs)
+        chunk.extend(encode_stream_messages(msgs, stream_format))
+    for sample in samples:
+        if stream_format == 'ndjson':
+            chunk.append(json.dumps(sample))
+        else:
+            chunk.append(encode_stream_text(sample))
+        if len(chunk) >= stream_chunk_samples:
+            yield ('\n'.join(chunk) + '\n').encode('utf-8')
+            chunk = []
+    if msgs is not None:
+        chunk.extend(
+            encode_stream_messages(msgs[message_count:], stream_format)
+        )
+    if chunk:
+        yield ('\n'.join(chunk) + '\n').encode('utf-8')
+
+def encode_stream_text(sample):
+    # Backslashes, tabs and new lines are escaped like in JSON strings, so
+    # each sample stays on one line with one column per group, and a line
+    # starting with '#' is escaped as in phrases, to tell it from messages
+    line = '\t'.join(
+        stream_text_escape_pattern.sub(
+            lambda escape_match: stream_text_escapes[escape_match.group()],
+            chosen_phrase['result']
+        )
+        for chosen_phrase in sample['phrases']
+    )
+    if line.startswith('#'):
+        line = '\\' + line
+    return line
+
+def encode_stream_messages(msgs, stream_format):
+    # Lines telling clients about trouble, told apart from samples by having
+    # 'messages' instead of 'phrases' in NDJSON, or starting with '#' in text
+    if not msgs:
+        return []
+    if stream_format == 'ndjson':
+        return [json.dumps(dict(messages=parse_messages(msgs)))]
+    return [
+        "# {0}: {1}".format(msg.title, msg.message) for msg in msgs
+    ]
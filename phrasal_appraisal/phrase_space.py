@@ -0,0 +1,372 @@
+import logging
+log = logging.getLogger(__name__)
+
+import bisect
+import hashlib
+import random
+
+from collections import namedtuple
+
+# Track time to avoid potential infinite loops
+from .time_limiter import TimeoutException
+
+from .phrase_compact import (
+    NODE_SEQUENCE,
+    NODE_TEXT
+)
+
+from .phrase_groups import (
+    append_compiled_warnings,
+    append_phrase_exception,
+    append_phrase_timeout,
+    get_batch_seed,
+    get_compiled_phrase,
+    join_phrase_result,
+    load_compiled_phrase,
+    make_work_budget
+)
+
+# Most outputs to shuffle all at once when picking unique samples
+max_shuffled_outputs = 100000
+
+# Number of possible outputs for a whole phrase set and for each group
+PhraseOutputCount = namedtuple('PhraseOutputCount', ['total', 'groups'])
+
+# Count the outputs of a phrase set
+def count_phrase(msgs, phrase_set):
+    # Returns None if the phrase set couldn't be compiled, with the reason
+    # added to msgs
+    compiled_phrase = load_compiled_phrase(msgs, phrase_set)
+    if compiled_phrase is None:
+        return None
+    return count_compiled_phrase(compiled_phrase)
+
+def count_compiled_phrase(compiled_phrase):
+    # Every distinct set of choices counts as one output, even if two sets
+    # happen to produce the same text, e.g. "{a|a}" counts as 2
+    output_count = compiled_phrase.analysis.get('output_count')
+    if output_count is not None:
+        return output_count
+
+    # Counts for every node, used to find outputs by index
+    node_counts = count_phrase_nodes(compiled_phrase)
+    group_counts = []
+    group_offsets = []
+    for group_num in range(compiled_phrase.group_count):
+        # One line is picked from each group, so it works like a choice
+        line_offsets = [0]
+        for line_num in compiled_phrase.get_group_lines(group_num):
+            line_offsets.append(
+                line_offsets[-1]
+                + node_counts[compiled_phrase.line_roots[line_num]]
+            )
+        group_counts.append(line_offsets[-1])
+        group_offsets.append(line_offsets)
+
+    # One phrase is picked from every group
+    if group_counts:
+        total_count = 1
+        for group_count in group_counts:
+            total_count *= group_count
+    else:
+        # Nothing to pick from
+        total_count = 0
+
+    output_count = PhraseOutputCount(total_count, tuple(group_counts))
+    log.debug(
+        "count_compiled_phrase: Phrase %s has %s outputs",
+        compiled_phrase.source_hash, total_count
+    )
+    # Only share finished results with other threads
+    compiled_phrase.analysis['node_counts'] = node_counts
+    compiled_phrase.analysis['group_offsets'] = group_offsets
+    compiled_phrase.analysis['choice_offsets'] = {}
+    compiled_phrase.analysis['output_count'] = output_count
+    return output_count
+
+def count_phrase_nodes(compiled_phrase):
+    # Count the possible outputs of every node of a compiled phrase
+    # A sequence multiplies the counts of its children, a choice adds up the
+    # counts of its branches.  Children always come before their parents, so
+    # one pass over the nodes in order counts everything.
+    node_kinds = compiled_phrase.node_kinds
+    node_counts = [1] * compiled_phrase.node_count
+    for node in range(compiled_phrase.node_count):
+        node_kind = node_kinds[node]
+        if node_kind == NODE_TEXT:
+            continue
+        child_counts = [
+            node_counts[child_node]
+            for child_node in compiled_phrase.get_children(node)
+        ]
+        if node_kind == NODE_SEQUENCE:
+            children_total = 1
+            for child_count in child_counts:
+                children_total *= child_count
+        else:
+            children_total = sum(child_counts)
+        node_counts[node] = children_total
+    return node_counts
+
+def split_mixed_radix(output_index, radixes):
+    # Split an index into one digit per radix, first radix most significant
+    digits = [0] * len(radixes)
+    for digit_num in range(len(radixes) - 1, -1, -1):
+        output_index, digits[digit_num] = divmod(
+            output_index, radixes[digit_num]
+        )
+    return digits
+
+# Find outputs by index, in the order of the choices in the phrase set
+def get_phrase_output(compiled_phrase, output_index):
+    # Returns the same structure as select_phrases, without going through
+    # any of the outputs before it
+    output_count = count_compiled_phrase(compiled_phrase)
+    if not 0 <= output_index < output_count.total:
+        raise IndexError(
+            "Output {0} is out of range, phrase has {1} outputs"
+            .format(output_index, output_count.total)
+        )
+    phrases_processed = []
+    group_indexes = split_mixed_radix(output_index, output_count.groups)
+    for group_num, line_offsets, group_index in zip(
+            range(compiled_phrase.group_count),
+            compiled_phrase.analysis['group_offsets'],
+            group_indexes):
+        line_num = bisect.bisect_right(line_offsets, group_index) - 1
+        phrases_processed.append({
+            'title': compiled_phrase.group_titles[group_num],
+            'result': decode_phrase_nodes(
+                compiled_phrase,
+                compiled_phrase.get_group_lines(group_num)[line_num],
+                group_index - line_offsets[line_num]
+            )
+        })
+    return phrases_processed
+
+def decode_phrase_nodes(compiled_phrase, line_num, line_index):
+    # Flatten one line like CompiledPhrase.sample_line, but with the choices
+    # given by line_index instead of picked at random
+    node_counts = compiled_phrase.analysis['node_counts']
+    node_kinds = compiled_phrase.node_kinds
+    phrase_array = []
+    pending_nodes = [(compiled_phrase.line_roots[line_num], line_index)]
+    while pending_nodes:
+        node, node_index = pending_nodes.pop()
+        node_kind = node_kinds[node]
+        if node_kind == NODE_TEXT:
+            phrase_array.append({
+                'choice_level': compiled_phrase.node_levels[node],
+                'result': compiled_phrase.get_text(node)
+            })
+        elif node_kind == NODE_SEQUENCE:
+            child_nodes = compiled_phrase.get_children(node)
+            child_indexes = split_mixed_radix(node_index, [
+                node_counts[child_node] for child_node in child_nodes
+            ])
+            # Last in, first out, so queue up the last child first
+            pending_nodes.extend(
+                reversed(list(zip(child_nodes, child_indexes)))
+            )
+        else:
+            branch_offsets = get_choice_offsets(compiled_phrase, node)
+            branch_num = bisect.bisect_right(branch_offsets, node_index) - 1
+            pending_nodes.append((
+                compiled_phrase.get_children(node)[branch_num],
+                node_index - branch_offsets[branch_num]
+            ))
+    return phrase_array
+
+def get_choice_offsets(compiled_phrase, node):
+    # First output index of each branch of a choice, worked out on first use
+    choice_offsets = compiled_phrase.analysis['choice_offsets']
+    branch_offsets = choice_offsets.get(node)
+    if branch_offsets is None:
+        node_counts = compiled_phrase.analysis['node_counts']
+        branch_offsets = [0]
+        for child_node in compiled_phrase.get_children(node):
+            branch_offsets.append(branch_offsets[-1] + node_counts[child_node])
+        choice_offsets[node] = branch_offsets
+    return branch_offsets
+
+def iter_phrase_outputs(
+        compiled_phrase, start = 0, stop = None, step = 1,
+        time_limit = None):
+    # Yield (index, output) for every output in range(start, stop, step)
+    # Separate workers can each take a share of the outputs with e.g.
+    # start = worker_num, step = worker_total, or pick up where a prior run
+    # left off with start.
+    total_count = count_compiled_phrase(compiled_phrase).total
+    if stop is None or stop > total_count:
+        stop = total_count
+    output_index = start
+    # Plain loop rather than range(), which can't hold huge indexes
+    while output_index < stop:
+        if time_limit is not None:
+            time_limit.check()
+        chosen_phrases = get_phrase_output(compiled_phrase, output_index)
+        if time_limit is not None:
+            # Each group and fragment, like select_phrases
+            time_limit.spend(sum(
+                1 + len(chosen_phrase['result'])
+                for chosen_phrase in chosen_phrases
+            ))
+        yield output_index, chosen_phrases
+        output_index += step
+
+def process_phrase_outputs(
+        msgs, phrase_set, start, count, step = 1, tier = 'api'):
+    # Returns the total number of outputs and up to count of them, as
+    # [{'index', 'phrases'}, ...], starting from start; see
+    # iter_phrase_outputs.  The total is None if that didn't work out.
+    # Don't allow this to run on indefinitely
+    time_limit = make_work_budget(tier)
+    try:
+        compiled_phrase = get_compiled_phrase(msgs, time_limit, phrase_set)
+        append_compiled_warnings(msgs, compiled_phrase)
+        total_count = count_compiled_phrase(compiled_phrase).total
+        outputs = [
+            dict(index=output_index, phrases=output_phrases)
+            for output_index, output_phrases in iter_phrase_outputs(
+                compiled_phrase, start, start + count * step, step,
+                time_limit
+            )
+        ]
+    except TimeoutException as e:
+        append_phrase_timeout(msgs, time_limit, e)
+        return None, []
+    except Exception as e:
+        append_phrase_exception(msgs, e)
+        return None, []
+    return total_count, outputs
+
+# Pick outputs at random, never the same one twice
+def process_unique_phrase_batch(
+        msgs, phrase_set, count, seed = '', tier = 'api'):
+    # Like process_phrase_batch, but every sample is a different output
+    # Returns fewer samples than asked for if there aren't enough outputs
+    seed = get_batch_seed(seed, True)
+    # Don't allow this to run on indefinitely
+    time_limit = make_work_budget(tier)
+    try:
+        # Parse the input phrases, reusing prior work if possible
+        compiled_phrase = get_compiled_phrase(msgs, time_limit, phrase_set)
+        append_compiled_warnings(msgs, compiled_phrase)
+        samples = list(
+            iter_unique_phrase_samples(
+                compiled_phrase, count, random.Random(seed), time_limit
+            )
+        )
+    except TimeoutException as e:
+        # Clear any chosen phrases
+        samples = []
+        append_phrase_timeout(msgs, time_limit, e)
+    except Exception as e:
+        # Clear any chosen phrases
+        samples = []
+        append_phrase_exception(msgs, e)
+
+    return seed, samples
+
+def iter_unique_phrase_samples(
+        compiled_phrase, count, rng, time_limit = None, annotate = True):
+    # Yield up to count samples with distinct outputs, in random order
+    # Each sample is a dict with 'index' (see get_phrase_output) and
+    # 'phrases', like iter_phrase_samples
+    total_count = count_compiled_phrase(compiled_phrase).total
+    count = min(count, total_count)
+    if count * 2 >= total_count and total_count <= max_shuffled_outputs:
+        # Asking for most of the outputs anyways, so just shuffle them all
+        output_indexes = list(range(total_count))
+        rng.shuffle(output_indexes)
+        del output_indexes[count:]
+    else:
+        # Shuffle without keeping track of what's been picked
+        index_permutation = PhraseIndexPermutation(total_count, rng)
+        output_indexes = (
+            index_permutation.get_index(sample_num)
+            for sample_num in range(count)
+        )
+
+    for output_index in output_indexes:
+        if time_limit is not None:
+            time_limit.check()
+        chosen_phrases = get_phrase_output(compiled_phrase, output_index)
+        if time_limit is not None:
+            # Each group and fragment, like select_phrases
+            time_limit.spend(sum(
+                1 + len(chosen_phrase['result'])
+                for chosen_phrase in chosen_phrases
+            ))
+        if not annotate:
+            for chosen_phrase in chosen_phrases:
+                chosen_phrase['result'] = join_phrase_result(
+                    chosen_phrase['result']
+                )
+        yield dict(index=output_index, phrases=chosen_phrases)
+
+class PhraseIndexPermutation(object):
+    # Shuffle range(size) without storing it, using a keyed Feistel network
+    # over the smallest even number of bits covering size.  Any index that
+    # lands past size is sent through again ("cycle walking"); the network
+    # covers less than 4 * size, so that's rarely more than a few rounds.
+    feistel_rounds = 4
+
+    def __init__(self, size, rng):
+        self.size = size
+        self.half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.half_mask = (1 << self.half_bits) - 1
+        self.half_bytes = (self.half_bits + 7) // 8
+        self.round_keys = [
+            rng.getrandbits(128).to_bytes(16, 'big')
+            for _ in range(self.feistel_rounds)
+        ]
+
+    def round_function(self, half_value, round_key):
+        # Mix half of the bits with the round key, as many bits as needed
+        half_bytes = half_value.to_bytes(self.half_bytes, 'big')
+        digest = b''
+        block_num = 0
+        while len(digest) < self.half_bytes:
+            digest += hashlib.blake2b(
+                half_bytes + block_num.to_bytes(4, 'big'), key=round_key
+            ).digest()
+            block_num += 1
+        return int.from_bytes(digest[:self.half_bytes], 'big') & self.half_mask
+
+    def get_index(self, position):
+        # Where position ends up after shuffling, 0 <= position < size
+        if not 0 <= position < self.size:
+            raise IndexError(
+                "Position {0} is out of range for size {1}"
+                .format(position, self.size)
+            )
+        shuffled = position
+        while True:
+            left = shuffled >> self.half_bits
+            right = shuffled & self.half_mask
+            for round_key in self.round_keys:
+                left, right = right, left ^ self.round_function(
+                    right, round_key
+                )
+            shuffled = (left << self.half_bits) | right
+            if shuffled < self.size:
+                return shuffled
+
+# JavaScript numbers lose precision past this
+max_json_safe_int = 2 ** 53 - 1
+
+def format_json_count(output_count):
+    # Counts past max_json_safe_int go out as decimal strings
+    if output_count is None or abs(output_count) <= max_json_safe_int:
+        return output_count
+    return str(output_count)
+
+def format_output_count(output_count):
+    # Friendly text for possibly huge numbers, e.g. "about 1.2 × 10^40"
+    if output_count < 10 ** 15:
+        return "{0:,}".format(output_count)
+    count_digits = str(output_count)
+    return "about {0}.{1} × 10^{2}".format(
+        count_digits[0], count_digits[1:3], len(count_digits) - 1
+    )
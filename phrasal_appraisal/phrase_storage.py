@@ -1,9 +1,57 @@
 import logging
 log = logging.getLogger(__name__)
 
-import copy
+import atexit
+import threading
+import time
 
-from collections import deque
+from array import array
+
+from collections import OrderedDict
+
+from .op_messages import OpMessage
+from .phrase_backend import (
+    create_phrase_backend,
+    decode_phrase_group,
+    encode_phrase_group
+)
+
+# With a backend, re-read groups from it this often by default, so changes
+# made by other processes sharing it show up
+default_cache_ttl_sec = 2
+
+# Rough memory use of stored values, for keeping within a byte budget
+string_overhead_bytes = 50
+container_overhead_bytes = 100
+
+def estimate_stored_size(stored_value):
+    # Walks dicts, lists and messages with an explicit stack, counting each
+    # character as a byte; close enough for budgeting
+    total_size = 0
+    pending_values = [stored_value]
+    while pending_values:
+        cur_value = pending_values.pop()
+        if isinstance(cur_value, str):
+            total_size += string_overhead_bytes + len(cur_value)
+        elif isinstance(cur_value, dict):
+            total_size += container_overhead_bytes
+            pending_values.extend(cur_value.values())
+        elif isinstance(cur_value, array):
+            total_size += (
+                container_overhead_bytes + len(cur_value) * cur_value.itemsize
+            )
+        elif isinstance(cur_value, (list, tuple)):
+            total_size += container_overhead_bytes
+            pending_values.extend(cur_value)
+        elif isinstance(cur_value, OpMessage):
+            total_size += container_overhead_bytes
+            pending_values.extend(
+                (cur_value.title, cur_value.message, cur_value.details)
+            )
+        else:
+            # Numbers, None, UUIDs and the like
+            total_size += string_overhead_bytes
+    return total_size
 
 # Store phrases
 class PhraseStorage(object):
@@ -49,57 +97,279 @@ class PhraseStorage(object):
 
     default_phrase_group = dict(
         uid='100', seed='', title='Default',
-        source='', results='', msgs=[]
+        source='', results='', results_time=None, output_count=None,
+        msgs=[]
     )
 
-    def __init__(self, max_active_groups):
+    # Locks shared out between all of the groups
+    lock_stripe_count = 256
+
+    def __init__(
+            self, max_active_groups, backend = None, flush_interval_sec = 1,
+            flush_batch_size = 100, max_active_bytes = None):
+        # Groups are kept in memory; with a backend (see phrase_backend),
+        # they're also saved there a batch at a time in the background, and
+        # loaded from there if not in memory
+        # The least recently used groups are dropped from memory once there
+        # are more than max_active_groups, or they take up more than
+        # max_active_bytes (see estimate_stored_size)
+        # Safe to use from many request threads at once.  Each group has a
+        # lock (shared with a few other groups) held while it's loaded,
+        # created or changed, see lock_phrase_group.  groups_lock is only
+        # held briefly to update the shared bookkeeping below, never while
+        # waiting on a group's lock.
+        self.lock_stripes = [
+            threading.RLock() for _ in range(self.lock_stripe_count)
+        ]
+        self.groups_lock = threading.Lock()
         self.max_active_groups = max_active_groups
-        self.active_phrase_groups = deque()
-        self.phrase_groups = {}
+        self.max_active_bytes = max_active_bytes
+        self.phrase_groups = OrderedDict()
+        self.phrase_group_sizes = {}
+        self.active_bytes = 0
+        # Groups dropped from memory to make room, ever
+        self.evicted_count = 0
+        # Re-read groups from the backend after this long, in case another
+        # process changed them; None to always trust what's in memory, the
+        # default without a backend
+        self.cache_ttl_sec = (
+            default_cache_ttl_sec if backend is not None else None
+        )
+        self.phrase_group_times = {}
+        # Encoded groups waiting to be saved, by group key
+        self.flush_interval_sec = flush_interval_sec
+        self.flush_batch_size = flush_batch_size
+        self.pending_writes = {}
+        # Groups being saved right now, still read from here until done
+        self.flushing_writes = {}
+        self.pending_lock = threading.Lock()
+        # Only one batch is saved at a time
+        self.flush_lock = threading.Lock()
+        self.flush_wakeup = threading.Event()
+        self.flush_stop = None
+        self.flush_thread = None
+        self.backend = None
+        self.exit_registered = False
+        self.set_backend(backend)
+
+    def configure(self, settings):
+        # Apply the app settings, see create_phrase_backend
+        if 'phrase_storage.max_active_groups' in settings:
+            self.max_active_groups = int(
+                settings['phrase_storage.max_active_groups']
+            )
+        if 'phrase_storage.max_active_mb' in settings:
+            self.max_active_bytes = int(
+                float(settings['phrase_storage.max_active_mb']) * 1024 * 1024
+            )
+        backend = create_phrase_backend(settings)
+        cache_ttl_sec = settings.get('phrase_storage.cache_ttl_sec')
+        if cache_ttl_sec is None:
+            cache_ttl_sec = default_cache_ttl_sec
+        elif cache_ttl_sec.strip().lower() in ('', 'none'):
+            cache_ttl_sec = None
+        if backend is None or cache_ttl_sec is None:
+            # Nothing else can change the groups
+            self.cache_ttl_sec = None
+        else:
+            self.cache_ttl_sec = float(cache_ttl_sec)
+        self.set_backend(backend)
+
+    def set_backend(self, backend):
+        # Finish up with any prior backend first
+        self.close()
+        self.backend = backend
+        if backend is None:
+            return
+        self.flush_stop = threading.Event()
+        self.flush_thread = threading.Thread(
+            target=self.run_flush_thread, args=(self.flush_stop,),
+            name='phrase-storage-flush'
+        )
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+        if not self.exit_registered:
+            # Don't lose the last few changes when shutting down
+            atexit.register(self.close)
+            self.exit_registered = True
+
+    def run_flush_thread(self, flush_stop):
+        while not flush_stop.is_set():
+            self.flush_wakeup.wait(self.flush_interval_sec)
+            self.flush_wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        # Save every pending group to the backend in one batch
+        with self.flush_lock:
+            with self.pending_lock:
+                if not self.pending_writes or self.backend is None:
+                    return
+                pending_writes = self.pending_writes
+                self.pending_writes = {}
+                self.flushing_writes = pending_writes
+            try:
+                self.backend.save_phrase_groups(pending_writes)
+            except Exception as e:
+                log.error(
+                    "storage: Couldn't save %s groups, will retry: %s",
+                    len(pending_writes), e,
+                    exc_info = True
+                )
+                with self.pending_lock:
+                    # Anything saved again since then is newer, keep that
+                    for group_key, group_data in pending_writes.items():
+                        self.pending_writes.setdefault(group_key, group_data)
+            finally:
+                with self.pending_lock:
+                    self.flushing_writes = {}
+
+    def close(self):
+        # Stop the background saving, saving anything still pending
+        if self.flush_thread is not None:
+            self.flush_stop.set()
+            self.flush_wakeup.set()
+            self.flush_thread.join()
+            self.flush_thread = None
+        self.flush()
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
 
     @staticmethod
     def get_default_phrase_group():
-        # Deep copy to avoid linking items
-        return copy.deepcopy(PhraseStorage.default_phrase_group)
+        # Everything else in the default group is immutable, so only the
+        # messages need their own copy; much cheaper than a deep copy
+        return dict(PhraseStorage.default_phrase_group, msgs=[])
+
+    @staticmethod
+    def get_new_phrase_group(active_uuid):
+        phrase_group = PhraseStorage.get_default_phrase_group()
+        phrase_group['uid'] = active_uuid
+        # TODO: Better auto-generated titles
+        phrase_group['title'] = active_uuid
+        return phrase_group
 
     @staticmethod
     def get_demo_phrase_source():
         return PhraseStorage.demo_phrase_source
 
+    def lock_phrase_group(self, active_uuid):
+        # Hold this to make several changes to a group without other threads
+        # getting in between, e.g. "with storage.lock_phrase_group(uuid):"
+        return self.lock_stripes[
+            hash(str(active_uuid)) % len(self.lock_stripes)
+        ]
+
     def has_phrase_group(self, active_uuid):
-        return active_uuid in self.phrase_groups
+        with self.lock_phrase_group(active_uuid):
+            with self.groups_lock:
+                if active_uuid in self.phrase_groups:
+                    self.phrase_groups.move_to_end(active_uuid)
+                    return True
+            # Maybe saved by another process, or before a restart
+            phrase_group = self.load_phrase_group(active_uuid)
+            if phrase_group is None:
+                return False
+            self.add_phrase_group(active_uuid, phrase_group)
+            return True
 
-    def get_phrase_group(self, active_uuid):
-        if active_uuid not in self.phrase_groups:
-            # Clean up old groups
-            while ((len(self.phrase_groups) + 1) > self.max_active_groups
-                    and len(self.active_phrase_groups) > 0):
-                # Remove the oldest first
-                old_uuid = self.active_phrase_groups.popleft()
-                log.info("storage: Deleting old group {0}"
-                    .format(old_uuid)
-                )
-                del self.phrase_groups[old_uuid]
-
-            # Track this group
-            log.info("storage: Adding new group {0}".format(active_uuid))
-            self.active_phrase_groups.append(active_uuid)
-            # Clone the default phrase group
-            self.phrase_groups[active_uuid] = (
-                PhraseStorage.get_default_phrase_group()
+    def load_phrase_group(self, active_uuid):
+        # Read a group from the backend, or None if it's not there
+        if self.backend is None:
+            return None
+        group_key = str(active_uuid)
+        with self.pending_lock:
+            phrase_data = self.pending_writes.get(group_key)
+            if phrase_data is None:
+                phrase_data = self.flushing_writes.get(group_key)
+        if phrase_data is None:
+            phrase_data = self.backend.load_phrase_group(group_key)
+        if phrase_data is None:
+            return None
+        log.debug("storage: Loaded group %s from backend", active_uuid)
+        return decode_phrase_group(phrase_data)
+
+    def is_phrase_group_stale(self, active_uuid):
+        # Call with groups_lock held
+        if self.backend is None or self.cache_ttl_sec is None:
+            return False
+        loaded_time = self.phrase_group_times.get(active_uuid, 0)
+        return time.time() - loaded_time > self.cache_ttl_sec
+
+    def add_phrase_group(self, active_uuid, phrase_group):
+        # Keep a group in memory as the most recently used, making room for
+        # it if needed
+        group_size = estimate_stored_size(phrase_group)
+        with self.groups_lock:
+            self.active_bytes += (
+                group_size - self.phrase_group_sizes.get(active_uuid, 0)
             )
-            self.phrase_groups[active_uuid]['uid'] = active_uuid
-            # TODO: Better auto-generated titles
-            self.phrase_groups[active_uuid]['title'] = active_uuid
+            self.phrase_groups[active_uuid] = phrase_group
+            self.phrase_groups.move_to_end(active_uuid)
+            self.phrase_group_sizes[active_uuid] = group_size
+            self.phrase_group_times[active_uuid] = time.time()
+
+            # Clean up old groups, always keeping the newest one
+            while len(self.phrase_groups) > 1 and self.is_over_capacity():
+                # Remove the least recently used first
+                old_uuid, _ = self.phrase_groups.popitem(last=False)
+                log.info("storage: Deleting old group %s", old_uuid)
+                self.active_bytes -= self.phrase_group_sizes.pop(old_uuid)
+                self.phrase_group_times.pop(old_uuid, None)
+                self.evicted_count += 1
+
+    def is_over_capacity(self):
+        # Call with groups_lock held
+        if len(self.phrase_groups) > self.max_active_groups:
+            return True
+        return (
+            self.max_active_bytes is not None
+            and self.active_bytes > self.max_active_bytes
+        )
+
+    def get_phrase_group(self, active_uuid):
+        with self.lock_phrase_group(active_uuid):
+            with self.groups_lock:
+                phrase_group = self.phrase_groups.get(active_uuid)
+                if phrase_group is not None:
+                    # Mark as most recently used
+                    self.phrase_groups.move_to_end(active_uuid)
+                    if self.is_phrase_group_stale(active_uuid):
+                        phrase_group = None
+            if phrase_group is None:
+                phrase_group = self.load_phrase_group(active_uuid)
+                if phrase_group is None:
+                    with self.groups_lock:
+                        # Not saved anywhere else, keep what's in memory
+                        phrase_group = self.phrase_groups.get(active_uuid)
+                if phrase_group is None:
+                    # Hand out a new group, only kept once it's set; that
+                    # way visitors who never change anything don't take up
+                    # space or push out other groups
+                    log.debug("storage: New unsaved group %s", active_uuid)
+                    return PhraseStorage.get_new_phrase_group(active_uuid)
+                self.add_phrase_group(active_uuid, phrase_group)
 
-        desired_group = self.phrase_groups[active_uuid]
-        log.debug("storage: Getting group {0} of {1}"
-            .format(active_uuid, desired_group)
+        log.debug(
+            "storage: Getting group %s of %s", active_uuid, phrase_group
         )
-        return desired_group
+        return phrase_group
 
     def set_phrase_group(self, active_uuid, phrase_group):
-        log.debug("storage: Setting group {0} to {1}"
-            .format(active_uuid, phrase_group)
+        # Changes made directly to a group aren't saved to the backend until
+        # it's set again
+        log.debug(
+            "storage: Setting group %s to %s", active_uuid, phrase_group
         )
-        self.phrase_groups[active_uuid] = phrase_group
+        with self.lock_phrase_group(active_uuid):
+            self.add_phrase_group(active_uuid, phrase_group)
+            if self.backend is None:
+                return
+            # Encode now, so later changes can't race with saving
+            phrase_data = encode_phrase_group(phrase_group)
+            with self.pending_lock:
+                self.pending_writes[str(active_uuid)] = phrase_data
+                pending_count = len(self.pending_writes)
+        if pending_count >= self.flush_batch_size:
+            self.flush_wakeup.set()
@@ -1,3 +1,4 @@
+import random
 import unittest
 
 from pyramid import testing
@@ -10,11 +11,903 @@ class ViewTests(unittest.TestCase):
     def tearDown(self):
         testing.tearDown()
 
-    def test_my_view(self):
-        from .views import my_view
+    def test_phrasal_form_view(self):
+        from .views import PhrasalViews
         request = testing.DummyRequest()
-        info = my_view(request)
-        self.assertEqual(info['project'], 'Phrasal Appraisal')
+        info = PhrasalViews(request).phrasal_form_view()
+        self.assertIn('<form', info['form'])
+        self.assertFalse(info['results'])
+        self.assertEqual(info['parsed_msgs'], [])
+
+
+class PhraseCompileTests(unittest.TestCase):
+    def test_compiled_phrase_cached(self):
+        from .phrase_cache import CompiledPhraseCache
+        from .phrase_groups import get_compiled_phrase
+        from .time_limiter import TimeLimiter
+        cache = CompiledPhraseCache(2)
+        source = "{John|Jane} goes to {school|work}."
+        first = get_compiled_phrase([], TimeLimiter(1), source, cache)
+        second = get_compiled_phrase([], TimeLimiter(1), source, cache)
+        self.assertIs(first, second)
+        self.assertEqual(first.group_count, 1)
+
+    def test_compiled_phrase_cache_evicts_least_recent(self):
+        from .phrase_cache import CompiledPhraseCache
+        cache = CompiledPhraseCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+
+    def test_seeded_phrase_repeatable(self):
+        from .phrase_groups import process_phrase
+        from .phrase_storage import PhraseStorage
+        source = PhraseStorage.get_demo_phrase_source()
+        first = process_phrase([], source, 'seed')
+        second = process_phrase([], source, 'seed')
+        self.assertEqual(first, second)
+
+
+class PhraseRandomTests(unittest.TestCase):
+    def test_seed_isolated_from_global_random(self):
+        from .phrase_groups import process_phrase
+        source = "{a|b|c|d}{e|f|g|h}{i|j|k|l}"
+        first = process_phrase([], source, 'seed')
+        # Other users of the global generator don't change seeded results
+        random.seed('other')
+        second = process_phrase([], source, 'seed')
+        self.assertEqual(first, second)
+
+    def test_given_rng(self):
+        from .phrase_groups import process_phrase
+        source = "{a|b|c|d}{e|f|g|h}{i|j|k|l}"
+        self.assertEqual(
+            process_phrase([], source, rng=random.Random(5)),
+            process_phrase([], source, rng=random.Random(5))
+        )
+
+
+class PhraseBatchTests(unittest.TestCase):
+    def test_batch_samples_repeatable(self):
+        from .phrase_groups import get_sample_seed, process_phrase
+        from .phrase_groups import process_phrase_batch
+        source = "{a|b|c|d}{e|f|g|h}\n# Second\n{i|j|k|l}"
+        seed, samples = process_phrase_batch([], source, 5, 'master', True)
+        self.assertEqual(seed, 'master')
+        self.assertEqual(len(samples), 5)
+        for sample_num, sample in enumerate(samples):
+            self.assertEqual(sample['seed'], get_sample_seed(seed, sample_num))
+            self.assertEqual(
+                sample['phrases'], process_phrase([], source, sample['seed'])
+            )
+
+    def test_text_samples_match_annotated(self):
+        from .phrase_groups import (
+            iter_phrase_samples,
+            join_phrase_result,
+            load_compiled_phrase
+        )
+        compiled_phrase = load_compiled_phrase(
+            [], "{a|b{c|d}} {|e}\n# Second\n{f|g}"
+        )
+        annotated = iter_phrase_samples(compiled_phrase, 20, 'seed')
+        text = iter_phrase_samples(
+            compiled_phrase, 20, 'seed', annotate=False
+        )
+        for annotated_sample, text_sample in zip(annotated, text):
+            self.assertEqual(
+                [join_phrase_result(phrase['result'])
+                    for phrase in annotated_sample['phrases']],
+                [phrase['result'] for phrase in text_sample['phrases']]
+            )
+
+    def test_batch_warns_once(self):
+        from .phrase_groups import process_phrase_batch
+        msgs = []
+        _, samples = process_phrase_batch(msgs, "{a|b", 10)
+        self.assertEqual(len(samples), 10)
+        self.assertEqual(len(msgs), 1)
+
+
+class PhraseBudgetTests(unittest.TestCase):
+    def test_budget_exceeded(self):
+        from .time_limiter import WorkBudget, WorkBudgetExceeded
+        work_budget = WorkBudget(10)
+        work_budget.spend(10)
+        with self.assertRaises(WorkBudgetExceeded):
+            work_budget.spend(1)
+
+    def test_cached_compile_costs_the_same(self):
+        from .phrase_cache import CompiledPhraseCache
+        from .phrase_groups import get_compiled_phrase
+        from .time_limiter import WorkBudget
+        cache = CompiledPhraseCache(2)
+        source = "{John|Jane} goes to {school|{work|home}}.\r\n# Two\nx"
+        work_spent = []
+        for _ in range(2):
+            work_budget = WorkBudget()
+            get_compiled_phrase([], work_budget, source, cache)
+            work_spent.append(work_budget.work_spent)
+        self.assertEqual(work_spent[0], work_spent[1])
+        self.assertGreater(work_spent[0], len(source))
+
+    def test_batch_over_budget(self):
+        from .phrase_groups import PhraseLimits, phrase_limits
+        from .phrase_groups import process_phrase_batch
+        from unittest import mock
+        with mock.patch.dict(phrase_limits, test=PhraseLimits(300, None)):
+            msgs = []
+            _, samples = process_phrase_batch(
+                msgs, "{a|b} {c|d}", 100, 'seed', tier='test'
+            )
+            self.assertEqual(samples, [])
+            self.assertEqual(msgs[0].title, "Too much to do")
+            # Always fails at the same point, however busy the machine is
+            _, samples = process_phrase_batch(
+                [], "{a|b} {c|d}", 50, 'seed', tier='test'
+            )
+            self.assertEqual(len(samples), 50)
+
+
+class PhraseSpaceTests(unittest.TestCase):
+    def test_count_phrase(self):
+        from .phrase_space import count_phrase
+        output_count = count_phrase(
+            [], "{a|b}{c|{d|e}|}\nx\n# Second\n{f|g}"
+        )
+        self.assertEqual(output_count.groups, (9, 2))
+        self.assertEqual(output_count.total, 18)
+
+    def test_count_demo(self):
+        from .phrase_space import count_phrase
+        from .phrase_storage import PhraseStorage
+        output_count = count_phrase(
+            [], PhraseStorage.get_demo_phrase_source()
+        )
+        self.assertEqual(output_count.total, 4320)
+
+    def test_count_huge(self):
+        from .phrase_space import count_phrase, format_output_count
+        output_count = count_phrase([], "{a|b}" * 200)
+        self.assertEqual(output_count.total, 2 ** 200)
+        self.assertTrue(
+            format_output_count(output_count.total).endswith("10^60")
+        )
+
+
+class PhraseOutputTests(unittest.TestCase):
+    def _outputs(self, phrase_set, *args):
+        from .phrase_groups import join_phrase_result, load_compiled_phrase
+        from .phrase_space import iter_phrase_outputs
+        compiled_phrase = load_compiled_phrase([], phrase_set)
+        return [
+            tuple(join_phrase_result(phrase['result']) for phrase in output)
+            for _, output in iter_phrase_outputs(compiled_phrase, *args)
+        ]
+
+    def test_enumerate_all(self):
+        self.assertEqual(
+            self._outputs("{a|b{c|d}}\n#\n{|e}"),
+            [('a', ''), ('a', 'e'), ('bc', ''), ('bc', 'e'), ('bd', ''),
+                ('bd', 'e')]
+        )
+
+    def test_enumerate_shards(self):
+        phrase_set = "{a|b|c}{d|{e|f}}\nx{y|z}"
+        all_outputs = self._outputs(phrase_set)
+        self.assertEqual(len(set(all_outputs)), 11)
+        shards = [self._outputs(phrase_set, shard, None, 3)
+            for shard in range(3)]
+        self.assertEqual(
+            sorted(sum(shards, [])), sorted(all_outputs)
+        )
+
+    def test_output_by_index(self):
+        from .phrase_groups import join_phrase_result, load_compiled_phrase
+        from .phrase_space import get_phrase_output
+        compiled_phrase = load_compiled_phrase([], "{a|b}" * 100)
+        output = get_phrase_output(compiled_phrase, 2 ** 100 - 2)
+        self.assertEqual(
+            join_phrase_result(output[0]['result']), "b" * 99 + "a"
+        )
+        self.assertRaises(
+            IndexError, get_phrase_output, compiled_phrase, 2 ** 100
+        )
+
+
+class PhraseUniqueTests(unittest.TestCase):
+    def test_permutation(self):
+        from .phrase_space import PhraseIndexPermutation
+        for size in (1, 2, 7, 64, 1000):
+            index_permutation = PhraseIndexPermutation(
+                size, random.Random(size)
+            )
+            self.assertEqual(
+                sorted(
+                    index_permutation.get_index(position)
+                    for position in range(size)
+                ),
+                list(range(size))
+            )
+
+    def test_unique_batch(self):
+        from .phrase_space import process_unique_phrase_batch
+        for count in (50, 1024, 5000):
+            seed, samples = process_unique_phrase_batch(
+                [], "{a|b}" * 10, count, 'seed'
+            )
+            indexes = [sample['index'] for sample in samples]
+            self.assertEqual(len(indexes), min(count, 1024))
+            self.assertEqual(len(set(indexes)), len(indexes))
+
+    def test_unique_batch_repeatable(self):
+        from .phrase_space import process_unique_phrase_batch
+        first = process_unique_phrase_batch([], "{a|b|c}" * 20, 10, 's')
+        second = process_unique_phrase_batch([], "{a|b|c}" * 20, 10, 's')
+        self.assertEqual(first, second)
+
+
+class PhraseParseTests(unittest.TestCase):
+    def _flatten_text(self, phrase):
+        from .phrase_groups import process_phrase_part
+        from .time_limiter import TimeLimiter
+        msg_details = []
+        phrase_parts = process_phrase_part(
+            msg_details, TimeLimiter(1), phrase
+        )
+        return phrase_parts, msg_details
+
+    def test_text_between_choices(self):
+        from .phrase_groups import flatten_phrase
+        phrase_parts, msg_details = self._flatten_text("{a}b{c}")
+        self.assertEqual(
+            [(item['choice_level'], item['result'])
+                for item in flatten_phrase(phrase_parts, random.Random())],
+            [(1, 'a'), (0, 'b'), (1, 'c')]
+        )
+        self.assertEqual(msg_details, [])
+
+    def test_escaped_characters(self):
+        from .phrase_groups import flatten_phrase
+        phrase_parts, _ = self._flatten_text("\\{a\\|b\\} \\\\")
+        self.assertEqual(
+            ''.join(item['result']
+                for item in flatten_phrase(phrase_parts, random.Random())),
+            "{a|b} \\"
+        )
+
+    def test_unclosed_bracket_kept_as_text(self):
+        from .phrase_groups import flatten_phrase
+        phrase_parts, msg_details = self._flatten_text("x{a|{b}")
+        self.assertEqual(
+            ''.join(item['result']
+                for item in flatten_phrase(phrase_parts, random.Random())),
+            "x{a|{b}"
+        )
+        self.assertEqual(len(msg_details), 1)
+
+    def test_deep_nesting(self):
+        depth = 5000
+        phrase_parts, _ = self._flatten_text(
+            "{a|" * depth + "b" + "}" * depth
+        )
+        # Follow the last choice all the way down
+        phrase_part = phrase_parts[0]
+        for _ in range(depth - 1):
+            phrase_part = phrase_part.phrases[-1][0]
+        self.assertEqual(phrase_part.choice_level, depth)
+        self.assertEqual(phrase_part.phrases[-1].result, 'b')
+
+    def test_flatten_deep_nesting(self):
+        from .phrase_groups import flatten_phrase
+        depth = 5000
+        phrase_parts, _ = self._flatten_text("{" * depth + "a}" * depth)
+        phrase_array = flatten_phrase(phrase_parts, random.Random())
+        self.assertEqual(
+            [item['choice_level'] for item in phrase_array],
+            list(range(depth, 0, -1))
+        )
+
+    def test_groups(self):
+        from .phrase_groups import compile_phrase
+        from .time_limiter import TimeLimiter
+        compiled_phrase = compile_phrase(
+            [], TimeLimiter(1), "one\r\n\n  \n# First\ntwo\n#\nthree\nfour"
+        )
+        self.assertEqual(
+            [(group_title, [
+                compiled_phrase.get_line_source(line_num)
+                for line_num in compiled_phrase.get_group_lines(group_num)
+            ]) for group_num, group_title in enumerate(
+                compiled_phrase.group_titles
+            )],
+            [('', ['one']), ('First', ['two']), ('', ['three', 'four'])]
+        )
+
+    def test_compiled_matches_parts(self):
+        from .phrase_groups import (
+            compile_phrase,
+            flatten_phrase,
+            process_phrase_part
+        )
+        from .time_limiter import TimeLimiter
+        phrase = "{a|b{c|d}} x{|{e|f}g}\\|{h} {i|{j|k|l}|}"
+        compiled_phrase = compile_phrase([], TimeLimiter(1), phrase)
+        phrase_parts = process_phrase_part([], TimeLimiter(1), phrase)
+        for seed in range(20):
+            self.assertEqual(
+                compiled_phrase.sample_line(0, random.Random(seed)),
+                flatten_phrase(phrase_parts, random.Random(seed))
+            )
+
+    def test_compiled_deep_nesting(self):
+        from .phrase_groups import compile_phrase
+        from .time_limiter import TimeLimiter
+        depth = 5000
+        compiled_phrase = compile_phrase(
+            [], TimeLimiter(1), "{a|" * depth + "b" + "}" * depth
+        )
+        # One text node per level, plus the choices and the final 'b'
+        self.assertEqual(compiled_phrase.node_count, depth * 2 + 1)
+        chosen = compiled_phrase.sample_line(0, random.Random('seed'))
+        self.assertIn(chosen[0]['result'], ('a', 'b'))
+
+
+class PhraseResultsTests(unittest.TestCase):
+    def test_rendered_html(self):
+        from .phrase_results import pack_phrase_results, render_result_html
+        packed_results = pack_phrase_results([{'title': '', 'result': [
+            {'choice_level': 0, 'result': '<b>'},
+            {'choice_level': 2, 'result': 'x'},
+            {'choice_level': 9, 'result': 'y'}
+        ]}])
+        self.assertNotIn('html', packed_results[0])
+        self.assertEqual(
+            render_result_html(packed_results[0]),
+            '<span class="phrase-results-normal">&lt;b&gt;</span>'
+            '<span class="phrase-results-highlight phrase-results-depth-2">'
+            'x</span>'
+            '<span class="phrase-results-highlight phrase-results-depth-9 '
+            'phrase-results-depth-max">y</span>'
+        )
+
+    def test_rendered_results_cache(self):
+        from unittest import mock
+        from .phrase_results import (
+            RenderedResultsCache,
+            pack_phrase_results
+        )
+        packed_results = pack_phrase_results([
+            {'title': '', 'result': [{'choice_level': 0, 'result': 'a'}]}
+        ])
+        rendered_cache = RenderedResultsCache(2)
+        with mock.patch(
+                'phrasal_appraisal.phrase_results.render_result_html',
+                return_value='html') as render_html:
+            for render_key in ('x', 'x', 'y', 'z', 'x'):
+                self.assertEqual(
+                    rendered_cache.get_results_html(
+                        render_key, packed_results
+                    ),
+                    ['html']
+                )
+        # 'x' was dropped for 'z', the least recently used
+        self.assertEqual(render_html.call_count, 4)
+        self.assertEqual(len(rendered_cache), 2)
+
+    def test_encoded_group_round_trip(self):
+        from .phrase_backend import decode_phrase_group, encode_phrase_group
+        from .phrase_groups import process_phrase
+        from .phrase_results import pack_phrase_results
+        from .phrase_storage import PhraseStorage
+        phrase_group = PhraseStorage.get_default_phrase_group()
+        phrase_group['results'] = pack_phrase_results(
+            process_phrase([], "{a|b}{c|{d|e}}\n# Second\nf", 'seed')
+        )
+        self.assertEqual(
+            decode_phrase_group(encode_phrase_group(phrase_group)),
+            phrase_group
+        )
+
+
+class PhraseStorageTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def _make_storage(self, max_active_groups = 10):
+        import os
+        from .phrase_backend import SQLitePhraseBackend
+        from .phrase_storage import PhraseStorage
+        backend = SQLitePhraseBackend(
+            os.path.join(self.temp_dir.name, 'groups.sqlite')
+        )
+        phrase_storage = PhraseStorage(max_active_groups, backend)
+        self.addCleanup(phrase_storage.close)
+        return phrase_storage
+
+    def test_cache_ttl_defaults(self):
+        import os
+        from .phrase_storage import PhraseStorage, default_cache_ttl_sec
+        phrase_storage = PhraseStorage(10)
+        self.addCleanup(phrase_storage.close)
+        backend_settings = {
+            'phrase_storage.backend': 'sqlite',
+            'phrase_storage.sqlite_path': os.path.join(
+                self.temp_dir.name, 'groups.sqlite'
+            )
+        }
+        phrase_storage.configure(backend_settings)
+        self.assertEqual(phrase_storage.cache_ttl_sec, default_cache_ttl_sec)
+        phrase_storage.configure(
+            dict(backend_settings, **{'phrase_storage.cache_ttl_sec': 'none'})
+        )
+        self.assertIsNone(phrase_storage.cache_ttl_sec)
+        # Memory only, so nothing else can change the groups
+        phrase_storage.configure({})
+        self.assertIsNone(phrase_storage.cache_ttl_sec)
+
+    def test_least_recently_used_evicted(self):
+        from .phrase_storage import PhraseStorage
+        phrase_storage = PhraseStorage(2)
+        for active_uuid in ('old', 'new'):
+            phrase_storage.set_phrase_group(
+                active_uuid, phrase_storage.get_phrase_group(active_uuid)
+            )
+        # Using the older group keeps it around
+        phrase_storage.get_phrase_group('old')
+        phrase_storage.set_phrase_group(
+            'newest', phrase_storage.get_phrase_group('newest')
+        )
+        self.assertEqual(
+            list(phrase_storage.phrase_groups), ['old', 'newest']
+        )
+
+    def test_new_group_not_kept_until_set(self):
+        from .phrase_storage import PhraseStorage
+        phrase_storage = PhraseStorage(1)
+        phrase_storage.set_phrase_group(
+            'saved', phrase_storage.get_phrase_group('saved')
+        )
+        phrase_group = phrase_storage.get_phrase_group('visitor')
+        self.assertEqual(phrase_group['uid'], 'visitor')
+        self.assertEqual(list(phrase_storage.phrase_groups), ['saved'])
+        self.assertFalse(phrase_storage.has_phrase_group('visitor'))
+        # Each new group has its own messages
+        phrase_group['msgs'].append('hi')
+        self.assertEqual(
+            phrase_storage.get_phrase_group('visitor')['msgs'], []
+        )
+
+    def test_byte_budget_evicts(self):
+        from .phrase_storage import PhraseStorage, estimate_stored_size
+        phrase_storage = PhraseStorage(100, max_active_bytes=20000)
+        for group_num in range(5):
+            phrase_group = phrase_storage.get_phrase_group(group_num)
+            phrase_group['phrases'] = 'x' * 6000
+            phrase_storage.set_phrase_group(group_num, phrase_group)
+        self.assertEqual(list(phrase_storage.phrase_groups), [2, 3, 4])
+        self.assertEqual(
+            phrase_storage.active_bytes,
+            sum(estimate_stored_size(phrase_group)
+                for phrase_group in phrase_storage.phrase_groups.values())
+        )
+
+    def test_concurrent_access(self):
+        import threading
+        from .phrase_storage import PhraseStorage
+        phrase_storage = PhraseStorage(20, max_active_bytes=50000)
+        errors = []
+        def use_groups(thread_num):
+            try:
+                for group_num in range(200):
+                    active_uuid = (thread_num * group_num) % 50
+                    with phrase_storage.lock_phrase_group(active_uuid):
+                        phrase_group = phrase_storage.get_phrase_group(
+                            active_uuid
+                        )
+                        phrase_group['phrases'] = 'x' * group_num
+                        phrase_storage.set_phrase_group(
+                            active_uuid, phrase_group
+                        )
+                    phrase_storage.has_phrase_group(group_num)
+            except Exception as e:
+                errors.append(e)
+        threads = [
+            threading.Thread(target=use_groups, args=(thread_num,))
+            for thread_num in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(phrase_storage.phrase_groups), 20)
+        self.assertEqual(
+            sorted(phrase_storage.phrase_groups),
+            sorted(phrase_storage.phrase_group_sizes)
+        )
+
+    def test_groups_survive_restart(self):
+        from .op_messages import MessageType, OpMessage
+        first = self._make_storage()
+        phrase_group = first.get_phrase_group('abc')
+        phrase_group['phrases'] = '{a|b}'
+        phrase_group['msgs'] = [OpMessage(MessageType.Info, 'Hi', 'Title')]
+        first.set_phrase_group('abc', phrase_group)
+        first.close()
+
+        second = self._make_storage()
+        self.assertTrue(second.has_phrase_group('abc'))
+        loaded = second.get_phrase_group('abc')
+        self.assertEqual(loaded['phrases'], '{a|b}')
+        self.assertEqual(loaded['msgs'][0].msg_type, MessageType.Info)
+        self.assertFalse(second.has_phrase_group('other'))
+
+    def test_evicted_group_reloaded(self):
+        phrase_storage = self._make_storage(max_active_groups=1)
+        phrase_group = phrase_storage.get_phrase_group('first')
+        phrase_group['seed'] = 'kept'
+        phrase_storage.set_phrase_group('first', phrase_group)
+        phrase_storage.set_phrase_group(
+            'second', phrase_storage.get_phrase_group('second')
+        )
+        self.assertNotIn('first', phrase_storage.phrase_groups)
+        # Still waiting to be written, or already written; either works
+        self.assertEqual(
+            phrase_storage.get_phrase_group('first')['seed'], 'kept'
+        )
+
+
+class PhraseBenchmarkTests(unittest.TestCase):
+    def test_corpus_runs(self):
+        from .benchmarks import benchmark_stages, run_benchmarks
+        stage_results = list(
+            run_benchmarks(size=200, repeat=1, sample_count=2)
+        )
+        self.assertEqual(
+            len(stage_results) % len(benchmark_stages), 0
+        )
+        for stage_result in stage_results:
+            self.assertGreater(stage_result.alloc_bytes, -1)
+
+    def test_compile_work_scales_linearly(self):
+        # Counts work rather than timing it, so a busy machine can't fail
+        # it; for timings, see "benchmarks --check-scaling"
+        from .benchmarks import benchmark_corpus
+        from .phrase_groups import compile_phrase
+        from .time_limiter import WorkBudget
+        for corpus_name, make_phrase in benchmark_corpus:
+            work_per_char = []
+            for size in (2500, 10000):
+                phrase_set = make_phrase(size)
+                work_budget = WorkBudget()
+                compile_phrase([], work_budget, phrase_set)
+                work_per_char.append(
+                    work_budget.work_spent / len(phrase_set)
+                )
+            self.assertLess(
+                work_per_char[1], work_per_char[0] * 1.1, corpus_name
+            )
+
+
+class MetricsTests(unittest.TestCase):
+    def test_histogram_buckets(self):
+        from .metrics import MetricsRegistry
+        metrics_registry = MetricsRegistry()
+        histogram = metrics_registry.histogram(
+            'test_seconds', 'Test', ('stage',), (0.1, 1)
+        )
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, 'a"b')
+        self.assertEqual(histogram.get_count('a"b'), 4)
+        rendered = metrics_registry.render()
+        self.assertIn('# TYPE test_seconds histogram', rendered)
+        self.assertIn(
+            'test_seconds_bucket{stage="a\\"b",le="0.1"} 2', rendered
+        )
+        self.assertIn('test_seconds_bucket{stage="a\\"b",le="1"} 3', rendered)
+        self.assertIn(
+            'test_seconds_bucket{stage="a\\"b",le="+Inf"} 4', rendered
+        )
+        self.assertIn('test_seconds_count{stage="a\\"b"} 4', rendered)
+
+    def test_counters_and_callbacks(self):
+        from .metrics import MetricsRegistry
+        metrics_registry = MetricsRegistry()
+        counter = metrics_registry.counter('test_total', 'Test')
+        counter.inc()
+        counter.inc(2)
+        self.assertIs(metrics_registry.counter('test_total', 'Test'), counter)
+        metrics_registry.callback('test_active', 'Test', lambda: 7)
+        rendered = metrics_registry.render()
+        self.assertIn('test_total 3\n', rendered)
+        self.assertIn('# TYPE test_active gauge\ntest_active 7\n', rendered)
+
+    def test_values_moved_between_registries(self):
+        from .metrics import MetricsRegistry
+        registries = [MetricsRegistry(), MetricsRegistry()]
+        for metrics_registry in registries:
+            metrics_registry.counter('test_total', 'Test').inc()
+            metrics_registry.histogram(
+                'test_seconds', 'Test', ('stage',), (0.1, 1)
+            ).observe(0.5, 'a')
+            metrics_registry.callback('test_active', 'Test', lambda: 7)
+        worker_registry, parent_registry = registries
+        parent_registry.add_values(worker_registry.take_values())
+        rendered = parent_registry.render()
+        self.assertIn('test_total 2\n', rendered)
+        self.assertIn('test_seconds_count{stage="a"} 2', rendered)
+        self.assertIn('test_seconds_sum{stage="a"} 1.0', rendered)
+        # Only sent once
+        rendered = worker_registry.render()
+        self.assertIn('test_total 0\n', rendered)
+        self.assertNotIn('test_seconds_count', rendered)
+
+    def test_stage_timed(self):
+        from .metrics import stage_seconds
+        from .phrase_groups import process_phrase
+        compile_count = stage_seconds.get_count('compile')
+        process_phrase([], "{a|b}")
+        self.assertEqual(stage_seconds.get_count('compile'), compile_count + 1)
+
+    def test_evictions_counted(self):
+        from .phrase_storage import PhraseStorage
+        phrase_storage = PhraseStorage(1)
+        for active_uuid in ('old', 'new'):
+            phrase_storage.set_phrase_group(
+                active_uuid, phrase_storage.get_phrase_group(active_uuid)
+            )
+        self.assertEqual(phrase_storage.evicted_count, 1)
+
+
+def sleep_in_worker(msgs, sleep_sec):
+    # Run by PhraseExecutorTests in a worker process
+    import time
+    time.sleep(sleep_sec)
+    return sleep_sec
+
+def exit_in_worker(msgs):
+    # Run by PhraseExecutorTests in a worker process, which dies
+    import os
+    os._exit(1)
+
+
+class PhraseExecutorTests(unittest.TestCase):
+    def setUp(self):
+        from .phrase_executor import PhraseExecutor
+        self.phrase_executor = PhraseExecutor()
+        self.phrase_executor.configure({
+            'phrase_executor.workers': '1',
+            'phrase_executor.limit_sec': '2'
+        })
+        self.addCleanup(self.phrase_executor.close)
+
+    def test_matches_inline(self):
+        from .phrase_groups import process_phrase
+        source = "{a|b}{c|{d|e}}\n# Second\n{f|g"
+        msgs = []
+        chosen_phrases = self.phrase_executor.run(
+            msgs, process_phrase, source, 'seed'
+        )
+        inline_msgs = []
+        self.assertEqual(
+            chosen_phrases, process_phrase(inline_msgs, source, 'seed')
+        )
+        self.assertEqual(
+            [msg.title for msg in msgs],
+            [msg.title for msg in inline_msgs]
+        )
+
+    def test_slow_worker_killed(self):
+        msgs = []
+        result = self.phrase_executor.run(
+            msgs, sleep_in_worker, 60, timeout_result='timed out'
+        )
+        self.assertEqual(result, 'timed out')
+        self.assertEqual(msgs[0].title, "Ran out of time")
+        # Replaced with a working one
+        self.assertEqual(
+            self.phrase_executor.run([], sleep_in_worker, 0), 0
+        )
+
+    def test_wait_counts_towards_limit(self):
+        import threading
+        import time
+        from .phrase_executor import worker_kills
+        pool = self.phrase_executor.pool
+        worker_pid = pool.workers[0].process.pid
+        kill_count = worker_kills.get_value()
+        busy_thread = threading.Thread(
+            target=self.phrase_executor.run, args=([], sleep_in_worker, 1.5)
+        )
+        busy_thread.start()
+        self.addCleanup(busy_thread.join)
+        while pool.idle_count:
+            time.sleep(0.01)
+        # Would fit in the limit on its own, but not after the wait
+        self.assertEqual(
+            self.phrase_executor.run(
+                [], sleep_in_worker, 1.5, timeout_result='timed out'
+            ),
+            'timed out'
+        )
+        # The worker finishes in the background, and is kept
+        self.assertEqual(
+            self.phrase_executor.run([], sleep_in_worker, 0), 0
+        )
+        self.assertEqual(pool.workers[0].process.pid, worker_pid)
+        self.assertEqual(worker_kills.get_value(), kill_count)
+
+    def test_dead_worker_replaced(self):
+        msgs = []
+        result = self.phrase_executor.run(
+            msgs, exit_in_worker, timeout_result='failed'
+        )
+        self.assertEqual(result, 'failed')
+        self.assertEqual(msgs[0].title, "Something unexpected happened")
+        self.assertEqual(
+            self.phrase_executor.run([], sleep_in_worker, 0), 0
+        )
+
+    def test_worker_metrics_forwarded(self):
+        from .metrics import stage_seconds
+        from .phrase_groups import process_phrase
+        compile_count = stage_seconds.get_count('compile')
+        self.phrase_executor.run([], process_phrase, "{a|b}", 'seed')
+        self.assertEqual(
+            stage_seconds.get_count('compile'), compile_count + 1
+        )
+
+
+class PhraseJobTests(unittest.TestCase):
+    def _make_jobs(self, mode = 'thread', workers = 1):
+        import tempfile
+        from .phrase_jobs import PhraseJobQueue
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        phrase_jobs = PhraseJobQueue()
+        phrase_jobs.configure({
+            'phrase_jobs.spool_dir': temp_dir.name,
+            'phrase_jobs.workers': str(workers),
+            'phrase_jobs.mode': mode
+        })
+        self.addCleanup(phrase_jobs.close)
+        return phrase_jobs
+
+    def _job_params(self, **job_params):
+        job_params.setdefault('phrases', "{a|b}{c|d|e}\n# Second\n{f|g}")
+        job_params.setdefault('seed', 'seed')
+        job_params.setdefault('count', 20)
+        job_params.setdefault('seed_per_sample', False)
+        job_params.setdefault('kind', 'samples')
+        job_params.setdefault('format', 'ndjson')
+        job_params.setdefault('annotate', False)
+        return job_params
+
+    def test_samples_match_batch(self):
+        import json
+        from .phrase_groups import process_phrase_batch
+        phrase_jobs = self._make_jobs()
+        job_params = self._job_params(seed_per_sample=True)
+        job_state = phrase_jobs.submit_job(job_params)
+        job_state = phrase_jobs.wait_for_job(job_state['id'], 10)
+        self.assertEqual(job_state['status'], 'done')
+        self.assertEqual(job_state['done'], 20)
+        with open(phrase_jobs.get_job_result_path(job_state['id'])) as f:
+            samples = [json.loads(line) for line in f]
+        _, batch_samples = process_phrase_batch(
+            [], job_params['phrases'], 20, 'seed', True
+        )
+        self.assertEqual(
+            [sample['seed'] for sample in samples],
+            [sample['seed'] for sample in batch_samples]
+        )
+
+    def test_outputs_text(self):
+        phrase_jobs = self._make_jobs()
+        job_state = phrase_jobs.submit_job(
+            self._job_params(kind='outputs', format='text', count=100)
+        )
+        job_state = phrase_jobs.wait_for_job(job_state['id'], 10)
+        self.assertEqual(job_state['total'], 12)
+        with open(phrase_jobs.get_job_result_path(job_state['id'])) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(set(lines)), 12)
+        self.assertIn('ac\tf', lines)
+
+    def test_cancel_and_expire(self):
+        phrase_jobs = self._make_jobs(workers=0)
+        job_state = phrase_jobs.submit_job(self._job_params())
+        job_state = phrase_jobs.cancel_job(job_state['id'])
+        self.assertEqual(job_state['status'], 'cancelled')
+        self.assertIsNone(phrase_jobs.get_job_result_path(job_state['id']))
+        phrase_jobs.max_age_sec = -1
+        phrase_jobs.prune_jobs()
+        self.assertIsNone(phrase_jobs.get_job_state(job_state['id']))
+        self.assertIsNone(phrase_jobs.get_job_state('../' + job_state['id']))
+
+    def test_cancel_running(self):
+        phrase_jobs = self._make_jobs()
+        job_state = phrase_jobs.submit_job(
+            self._job_params(count=1000000, phrases="{a|b}" * 200)
+        )
+        import time
+        for _ in range(500):
+            if phrase_jobs.get_job_state(job_state['id'])['done']:
+                break
+            time.sleep(0.01)
+        phrase_jobs.cancel_job(job_state['id'])
+        job_state = phrase_jobs.wait_for_job(job_state['id'], 10)
+        self.assertEqual(job_state['status'], 'cancelled')
+        self.assertLess(job_state['done'], 1000000)
+
+    def test_queued_jobs_run_after_restart(self):
+        from .phrase_jobs import PhraseJobQueue
+        phrase_jobs = self._make_jobs(workers=0)
+        job_state = phrase_jobs.submit_job(self._job_params())
+        phrase_jobs.close()
+        restarted_jobs = PhraseJobQueue()
+        restarted_jobs.configure({
+            'phrase_jobs.spool_dir': phrase_jobs.spool_dir
+        })
+        self.addCleanup(restarted_jobs.close)
+        job_state = restarted_jobs.wait_for_job(job_state['id'], 10)
+        self.assertEqual(job_state['status'], 'done')
+
+    def test_claimed_once(self):
+        import os
+        from .phrase_jobs import claim_job
+        phrase_jobs = self._make_jobs(workers=0)
+        job_state = phrase_jobs.submit_job(self._job_params())
+        job_dir = phrase_jobs.get_job_dir(job_state['id'])
+        claim_file = claim_job(job_dir)
+        self.assertIsNotNone(claim_file)
+        self.assertIsNone(claim_job(job_dir))
+        claim_file.close()
+        claim_job(job_dir).close()
+        self.assertIsNone(claim_job(os.path.join(job_dir, 'missing')))
+
+    def test_running_job_left_to_its_process(self):
+        from .phrase_jobs import PhraseJobQueue
+        phrase_jobs = self._make_jobs()
+        job_state = phrase_jobs.submit_job(
+            self._job_params(count=1000000, phrases="{a|b}" * 200)
+        )
+        import time
+        for _ in range(500):
+            if phrase_jobs.get_job_state(job_state['id'])['done']:
+                break
+            time.sleep(0.01)
+        # Another server sharing the spool starts up meanwhile
+        other_jobs = PhraseJobQueue()
+        other_jobs.configure({
+            'phrase_jobs.spool_dir': phrase_jobs.spool_dir,
+            'phrase_jobs.workers': '0'
+        })
+        self.addCleanup(other_jobs.close)
+        self.assertEqual(other_jobs.queued_count, 0)
+        self.assertEqual(
+            other_jobs.get_job_state(job_state['id'])['status'], 'running'
+        )
+        # Cancelled by the server that isn't running it
+        self.assertEqual(
+            other_jobs.cancel_job(job_state['id'])['status'], 'running'
+        )
+        job_state = phrase_jobs.wait_for_job(job_state['id'], 10)
+        self.assertEqual(job_state['status'], 'cancelled')
+        self.assertLess(job_state['done'], 1000000)
+
+    def test_process_mode(self):
+        phrase_jobs = self._make_jobs(mode='process')
+        job_state = phrase_jobs.submit_job(self._job_params())
+        job_state = phrase_jobs.wait_for_job(job_state['id'], 30)
+        self.assertEqual(job_state['status'], 'done')
 
 
 class FunctionalTests(unittest.TestCase):
@@ -27,3 +920,216 @@ class FunctionalTests(unittest.TestCase):
     def test_root(self):
         res = self.testapp.get('/', status=200)
         self.assertTrue(b'Pyramid' in res.body)
+
+    def test_submit_shows_results(self):
+        res = self.testapp.post(
+            '/', {'phrases': 'Hello {there|world}', 'submit': 'submit'},
+            status=302
+        )
+        res = res.follow(status=200)
+        self.assertIn(b'generated_phrase', res.body)
+        self.assertIn(b'phrase-results-highlight', res.body)
+        # New results aren't hidden by the ones rendered before
+        res = self.testapp.post(
+            '/', {'phrases': 'Goodbye {moon}', 'submit': 'submit'},
+            status=302
+        )
+        res = res.follow(status=200)
+        self.assertIn(b'Goodbye', res.body)
+
+    def test_form_errors_not_shared(self):
+        res = self.testapp.post(
+            '/', {'phrases': 'x' * 10001, 'submit': 'submit'}, status=200
+        )
+        self.assertIn(b'error', res.body)
+        other_app = self.testapp.__class__(self.testapp.app)
+        res = other_app.get('/', status=200)
+        self.assertNotIn(b'Longer than maximum length', res.body)
+
+    def test_anonymous_get_leaves_storage_alone(self):
+        from .views import phrase_storage
+        group_count = len(phrase_storage.phrase_groups)
+        res = self.testapp.get('/', status=200)
+        self.assertNotIn('Set-Cookie', res.headers)
+        self.assertEqual(len(phrase_storage.phrase_groups), group_count)
+
+    def test_first_visit_not_welcomed_back(self):
+        res = self.testapp.get('/', status=200)
+        self.assertNotIn(b'Welcome back', res.body)
+        res = self.testapp.get('/', status=200)
+        self.assertNotIn(b'Welcome back', res.body)
+
+    def test_batch_api(self):
+        res = self.testapp.post_json(
+            '/api/batch', {'phrases': '{a|b}', 'count': 3}, status=200
+        )
+        self.assertEqual(res.json['count'], 3)
+        for sample in res.json['samples']:
+            self.assertIn(sample['phrases'][0]['result'][0]['result'], 'ab')
+
+    def test_stream_api(self):
+        res = self.testapp.get(
+            '/api/stream',
+            {'phrases': '{a|b}\n#\n{c|d}', 'count': '250', 'format': 'text'},
+            status=200
+        )
+        lines = res.text.splitlines()
+        self.assertEqual(len(lines), 250)
+        for line in lines:
+            self.assertIn(line, ['a\tc', 'a\td', 'b\tc', 'b\td'])
+
+    def test_stream_api_ndjson(self):
+        import json
+        res = self.testapp.post_json(
+            '/api/stream',
+            {'phrases': '{a|b}', 'count': 2, 'seed': 's', 'annotate': True},
+            status=200
+        )
+        samples = [json.loads(line) for line in res.text.splitlines()]
+        self.assertEqual(len(samples), 2)
+        self.assertEqual(
+            samples[0]['phrases'][0]['result'][0]['choice_level'], 1
+        )
+
+    def test_count_api(self):
+        res = self.testapp.post(
+            '/api/count', {'phrases': '{a|b}\n#\n{c|d|e}'}, status=200
+        )
+        self.assertEqual(res.json['total'], 6)
+        self.assertEqual(res.json['groups'], [2, 3])
+
+    def test_count_api_huge_total(self):
+        res = self.testapp.post_json(
+            '/api/count', {'phrases': '{a|b}' * 200}, status=200
+        )
+        self.assertEqual(res.json['total'], str(2 ** 200))
+        self.assertEqual(res.json['groups'], [str(2 ** 200)])
+        # Still a number while JavaScript can hold it exactly
+        res = self.testapp.post_json(
+            '/api/count', {'phrases': '{a|b}' * 52}, status=200
+        )
+        self.assertEqual(res.json['total'], 2 ** 52)
+        res = self.testapp.post_json(
+            '/api/outputs',
+            {'phrases': '{a|b}' * 200, 'start': 2 ** 199, 'count': 1},
+            status=200
+        )
+        self.assertEqual(res.json['total'], str(2 ** 200))
+        self.assertEqual(res.json['outputs'][0]['index'], str(2 ** 199))
+        self.assertEqual(res.json['next'], str(2 ** 199 + 1))
+
+    def test_outputs_api(self):
+        res = self.testapp.post_json(
+            '/api/outputs',
+            {'phrases': '{a|b|c}', 'start': 1, 'count': 5}, status=200
+        )
+        self.assertEqual(
+            [output['index'] for output in res.json['outputs']], [1, 2]
+        )
+        self.assertIsNone(res.json['next'])
+
+    def test_stream_api_warnings_first(self):
+        import json
+        res = self.testapp.get(
+            '/api/stream', {'phrases': '{a|b', 'count': '3'}, status=200
+        )
+        self.assertTrue(res.headers['X-Phrase-Seed'])
+        lines = [json.loads(line) for line in res.text.splitlines()]
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(
+            lines[0]['messages'][0]['title'], "Trouble building phrases"
+        )
+        self.assertIn('phrases', lines[1])
+
+    def test_stream_api_text_escaped(self):
+        res = self.testapp.post(
+            '/api/stream',
+            {'phrases': '{#a}\tb\\\\c\n#\nd', 'count': '2', 'format': 'text'},
+            status=200
+        )
+        self.assertEqual(res.text, '\\#a\\tb\\\\c\td\n' * 2)
+
+    def test_outputs_api_over_budget(self):
+        from unittest import mock
+        from .phrase_groups import PhraseLimits, phrase_limits
+        with mock.patch.dict(phrase_limits, api=PhraseLimits(300, None)):
+            res = self.testapp.post_json(
+                '/api/outputs',
+                {'phrases': '{a|b}' * 10, 'count': 500}, status=400
+            )
+        self.assertEqual(res.json['messages'][0]['title'], "Too much to do")
+
+    def test_stream_api_over_budget(self):
+        import json
+        from unittest import mock
+        from .phrase_groups import PhraseLimits, phrase_limits
+        with mock.patch.dict(phrase_limits, stream=PhraseLimits(300, None)):
+            res = self.testapp.get(
+                '/api/stream',
+                {'phrases': '{a|b} {c|d}', 'count': '100', 'seed': 's'},
+                status=200
+            )
+            text_res = self.testapp.get(
+                '/api/stream',
+                {'phrases': '{a|b} {c|d}', 'count': '100', 'seed': 's',
+                    'format': 'text'},
+                status=200
+            )
+        lines = [json.loads(line) for line in res.text.splitlines()]
+        self.assertLess(len(lines), 100)
+        self.assertIn('phrases', lines[0])
+        self.assertEqual(lines[-1]['messages'][0]['title'], "Too much to do")
+        text_lines = text_res.text.splitlines()
+        self.assertEqual(len(text_lines), len(lines))
+        self.assertTrue(text_lines[-1].startswith("# Too much to do: "))
+
+    def test_stream_api_unique(self):
+        res = self.testapp.get(
+            '/api/stream',
+            {'phrases': '{a|b|c}{d|e|f}', 'count': '20', 'format': 'text',
+                'unique': 'true'},
+            status=200
+        )
+        lines = res.text.splitlines()
+        self.assertEqual(len(lines), 9)
+        self.assertEqual(len(set(lines)), 9)
+
+    def test_batch_api_invalid(self):
+        res = self.testapp.post(
+            '/api/batch', {'phrases': '{a|b}', 'count': '0'}, status=400
+        )
+        self.assertIn('count', res.json['errors'])
+
+    def test_metrics(self):
+        self.testapp.get('/', status=200)
+        res = self.testapp.get('/metrics', status=200)
+        self.assertEqual(res.content_type, 'text/plain')
+        self.assertIn(
+            'phrasal_request_seconds_count{route="phrasal_form_view",'
+            'method="GET",status="200"}', res.text
+        )
+        self.assertIn('phrasal_stage_seconds_count{stage="render"}', res.text)
+        self.assertIn('phrasal_storage_active_groups ', res.text)
+        self.assertIn('phrasal_storage_evictions_total ', res.text)
+
+    def test_jobs_api(self):
+        import tempfile
+        from phrasal_appraisal import main
+        from .phrase_jobs import phrase_jobs
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        testapp = self.testapp.__class__(
+            main({}, **{'phrase_jobs.spool_dir': temp_dir.name})
+        )
+        self.addCleanup(phrase_jobs.configure, {})
+        res = testapp.post_json(
+            '/api/jobs', {'phrases': '{a|b}', 'count': 5, 'format': 'text'},
+            status=202
+        )
+        phrase_jobs.wait_for_job(res.json['id'], 10)
+        res = testapp.get(res.json['status_url'], status=200)
+        self.assertEqual(res.json['status'], 'done')
+        res = testapp.get(res.json['result_url'], status=200)
+        self.assertEqual(len(res.text.splitlines()), 5)
+        self.assertIn('attachment', res.headers['Content-Disposition'])
+        testapp.get('/api/jobs/' + '0' * 32, status=404)
@@ -8,13 +8,17 @@ class TimeoutException(Exception):
     """"Raise for when the time limit is exceeded."""
     # See https://stackoverflow.com/questions/1319615/proper-way-to-declare-custom-exceptions-in-modern-python
 
+class WorkBudgetExceeded(TimeoutException):
+    """Raise for when the work budget is used up."""
+
 class TimeLimiter(object):
     def __init__(self, limit_sec = 1):
+        # With no limit_sec, check never raises
         self.cur_limit_sec = limit_sec
         self.reset()
         log.debug(
-            "TimeLimiter: Created new time limit of '{0}' sec"
-            .format(limit_sec)
+            "TimeLimiter: Created new time limit of '%s' sec",
+            limit_sec
         )
 
     @property
@@ -23,17 +27,50 @@ class TimeLimiter(object):
 
     def reset(self):
         # Reset the start time
-        self.start_time = time.time()
+        # Monotonic, so changes to the system clock don't count
+        self.start_time = time.monotonic()
+
+    def spend(self, work):
+        # Only time is limited here, see WorkBudget
+        pass
 
     def check(self):
         # Compare the start with the current time
         limit_sec = self.limit_sec
-        cur_time = time.time()
+        if limit_sec is None:
+            return
+        cur_time = time.monotonic()
         if (cur_time - self.start_time) > limit_sec:
             log.info(
-                "TimeLimiter: Exceeded limit of '{0}' sec, throwing exception"
-                .format(limit_sec)
+                "TimeLimiter: Exceeded limit of '%s' sec, throwing exception",
+                limit_sec
             )
             raise TimeoutException(
                 "Exceeded time limit of '{0}' sec".format(limit_sec)
             )
+
+# Limit how much work is done rather than how long it takes
+class WorkBudget(TimeLimiter):
+    # The same phrases always pass or fail, however busy the machine is
+    # Work is whatever the caller counts with spend, e.g. characters parsed
+    # and phrase nodes created or sampled.  limit_sec is kept as a backstop
+    # for anything not counted, checked with check as before.
+    def __init__(self, max_work = None, limit_sec = None):
+        self.max_work = max_work
+        self.work_spent = 0
+        super(WorkBudget, self).__init__(limit_sec)
+
+    def reset(self):
+        super(WorkBudget, self).reset()
+        self.work_spent = 0
+
+    def spend(self, work):
+        self.work_spent += work
+        if self.max_work is not None and self.work_spent > self.max_work:
+            log.info(
+                "WorkBudget: Exceeded budget of %s, throwing exception",
+                self.max_work
+            )
+            raise WorkBudgetExceeded(
+                "Exceeded work budget of {0}".format(self.max_work)
+            )
@@ -3,12 +3,52 @@ log = logging.getLogger(__name__)
 
 from pyramid.view import view_config
 from pyramid.httpexceptions import HTTPFound
+from pyramid.response import FileResponse, Response
 
 import deform
 import colander
 
+import os
+import random
+import threading
+import time
 import uuid
-from .phrase_groups import process_phrase
+from .metrics import (
+    metrics_registry,
+    time_stage
+)
+from .phrase_groups import (
+    get_batch_seed,
+    iter_limited_samples,
+    iter_phrase_samples,
+    load_compiled_phrase,
+    make_work_budget,
+    max_batch_samples,
+    max_stream_samples,
+    process_phrase,
+    process_phrase_batch
+)
+from .phrase_space import (
+    count_phrase,
+    format_json_count,
+    format_output_count,
+    iter_unique_phrase_samples,
+    process_phrase_outputs,
+    process_unique_phrase_batch
+)
+from .phrase_executor import phrase_executor
+from .phrase_jobs import (
+    JOB_OUTPUTS,
+    JOB_SAMPLES,
+    JOB_UNIQUE,
+    max_job_samples,
+    phrase_jobs
+)
+from .phrase_results import (
+    encode_phrase_stream,
+    pack_phrase_results,
+    rendered_results_cache
+)
 from .phrase_storage import PhraseStorage
 
 from .op_messages import (
@@ -19,6 +59,25 @@ from .op_messages import (
 
 max_active_groups = 250
 phrase_storage = PhraseStorage(max_active_groups)
+metrics_registry.callback(
+    'phrasal_storage_active_groups', 'Phrase groups kept in memory',
+    lambda: len(phrase_storage.phrase_groups)
+)
+metrics_registry.callback(
+    'phrasal_storage_active_bytes',
+    'Rough size of the phrase groups kept in memory',
+    lambda: phrase_storage.active_bytes
+)
+metrics_registry.callback(
+    'phrasal_storage_evictions_total',
+    'Phrase groups dropped from memory to make room',
+    lambda: phrase_storage.evicted_count, 'counter'
+)
+metrics_registry.callback(
+    'phrasal_storage_pending_writes',
+    'Phrase groups waiting to be saved to the backend',
+    lambda: len(phrase_storage.pending_writes)
+)
 
 class PhraseForm(colander.Schema):
     phrases = colander.SchemaNode(
@@ -37,18 +96,135 @@ class PhraseForm(colander.Schema):
         )
     )
 
+class PhraseBatchForm(colander.Schema):
+    phrases = colander.SchemaNode(
+        colander.String(),
+        validator=colander.Length(max=10000)
+    )
+    seed = colander.SchemaNode(
+        colander.String(),
+        validator=colander.Length(max=150),
+        missing=''
+    )
+    count = colander.SchemaNode(
+        colander.Integer(),
+        validator=colander.Range(min=1, max=max_batch_samples),
+        missing=1
+    )
+    seed_per_sample = colander.SchemaNode(
+        colander.Boolean(),
+        missing=False
+    )
+    unique = colander.SchemaNode(
+        colander.Boolean(),
+        missing=False
+    )
+
+class PhraseCountForm(colander.Schema):
+    phrases = colander.SchemaNode(
+        colander.String(),
+        validator=colander.Length(max=10000)
+    )
+
+class PhraseOutputsForm(PhraseCountForm):
+    start = colander.SchemaNode(
+        colander.Integer(),
+        validator=colander.Range(min=0),
+        missing=0
+    )
+    count = colander.SchemaNode(
+        colander.Integer(),
+        validator=colander.Range(min=1, max=max_batch_samples),
+        missing=1
+    )
+    step = colander.SchemaNode(
+        colander.Integer(),
+        validator=colander.Range(min=1),
+        missing=1
+    )
+
+class PhraseStreamForm(PhraseBatchForm):
+    count = colander.SchemaNode(
+        colander.Integer(),
+        validator=colander.Range(min=1, max=max_stream_samples),
+        missing=1
+    )
+    format = colander.SchemaNode(
+        colander.String(),
+        validator=colander.OneOf(['ndjson', 'text']),
+        missing='ndjson'
+    )
+    annotate = colander.SchemaNode(
+        colander.Boolean(),
+        missing=False
+    )
+
+class PhraseJobForm(PhraseStreamForm):
+    count = colander.SchemaNode(
+        colander.Integer(),
+        validator=colander.Range(min=1, max=max_job_samples),
+        missing=1
+    )
+    # Every output in order, like the outputs API, up to count of them
+    outputs = colander.SchemaNode(
+        colander.Boolean(),
+        missing=False
+    )
+
+# Forms keep the values they last rendered, so each thread reuses its own
+# rather than building a new one for every request
+phrase_form_local = threading.local()
+# Rendered forms that are the same for everyone, by (phrases, seed)
+rendered_phrase_forms = {}
+phrase_form_resources = None
+
+def build_phrase_form():
+    schema = PhraseForm()
+    return deform.Form(schema, buttons=('submit', 'clear', 'demo'))
+
+def get_phrase_form():
+    phrase_form = getattr(phrase_form_local, 'phrase_form', None)
+    if phrase_form is None:
+        phrase_form = build_phrase_form()
+        phrase_form_local.phrase_form = phrase_form
+    return phrase_form
+
+def render_phrase_form(phrase_group):
+    # Only the phrases and seed are shown in the form
+    form_values = (
+        phrase_group.get('phrases', ''), phrase_group.get('seed', '')
+    )
+    rendered_form = rendered_phrase_forms.get(form_values)
+    if rendered_form is not None:
+        return rendered_form
+    rendered_form = get_phrase_form().render(phrase_group)
+    if form_values in (('', ''), (PhraseStorage.get_demo_phrase_source(), '')):
+        # Blank or demo, as seen by new visitors; safe to share
+        rendered_phrase_forms[form_values] = rendered_form
+    return rendered_form
+
+def get_phrase_form_resources():
+    # Widget resources never change, so only look them up once
+    global phrase_form_resources
+    if phrase_form_resources is None:
+        phrase_form_resources = get_phrase_form().get_widget_resources()
+    return phrase_form_resources
+
 class PhrasalViews(object):
     def __init__(self, request):
         self.request = request
+        # Set once a new session UUID is made for this request
+        self.session_created = False
+        # The group is only looked up once per request
+        self.phrase_group_cached = None
 
     @property
     def phrase_form(self):
-        schema = PhraseForm()
-        return deform.Form(schema, buttons=('submit', 'clear', 'demo'))
+        return get_phrase_form()
 
     @property
     def reqts(self):
-        return self.phrase_form.get_widget_resources()
+        return get_phrase_form_resources()
 
     @property
     def session_uuid(self):
@@ -57,8 +233,9 @@ class PhrasalViews(object):
         active_uuid = ''
         if 'phrase_group_uuid' not in session:
             active_uuid = uuid.uuid4()
-            log.info("session: Creating new UUID {0}".format(active_uuid))
+            log.info("session: Creating new UUID %s", active_uuid)
             session['phrase_group_uuid'] = active_uuid
+            self.session_created = True
         else:
             active_uuid = session['phrase_group_uuid']
 
@@ -69,11 +246,7 @@ class PhrasalViews(object):
         session = self.request.session
         if 'session_reset' not in session:
             # Wasn't tracked before, assume a fresh visitor
-            log.debug(
-                "session_was_lost: Setting session reset status to: {0}"
-                .format(False)
-            )
-            self.session_was_lost = False
+            # Not saved, so just looking doesn't change the session
             return False
         # Get the value of the session_reset state
         return session['session_reset']
@@ -82,38 +255,69 @@ class PhrasalViews(object):
     def session_was_lost(self, value):
         session = self.request.session
         log.debug(
-            "session_was_lost: Setting session reset status to: {0}"
-            .format(value)
+            "session_was_lost: Setting session reset status to: %s",
+            value
         )
         session['session_reset'] = value
 
     def session_check_reset(self):
         # Check if the session UUID exists
         session = self.request.session
-        # Do we have a session UUID?
-        if 'phrase_group_uuid' in session:
+        # Do we have a session UUID from a prior visit, with a group saved?
+        if (session.get('phrase_group_saved')
+                and 'phrase_group_uuid' in session
+                and not self.session_created):
             # Does storage -not- have it?
             if not phrase_storage.has_phrase_group(self.session_uuid):
                 # We've lost the session
                 log.warn(
-                    "session_check_reset: Session '{0}' was lost"
-                    .format(str(self.session_uuid))
+                    "session_check_reset: Session '%s' was lost",
+                    self.session_uuid
                 )
                 self.session_was_lost = True
 
+    @property
+    def is_read_only(self):
+        # Just showing the page, e.g. a first visit, health check or link
+        # preview
+        return self.request.method == 'GET' and not any(
+            action in self.request.params
+            for action in ('submit', 'clear', 'demo')
+        )
+
+    @property
+    def has_session(self):
+        return 'phrase_group_uuid' in self.request.session
+
     @property
     def phrase_group(self):
-        # Check if the phrase group is missing before potentially creating a
-        # new one
-        self.session_check_reset()
-        return phrase_storage.get_phrase_group(self.session_uuid)
+        if self.phrase_group_cached is None and not self.has_session:
+            if self.is_read_only:
+                # Nothing to save, so don't make a UUID or touch storage
+                self.phrase_group_cached = (
+                    PhraseStorage.get_default_phrase_group()
+                )
+        if self.phrase_group_cached is None:
+            # Check if the phrase group is missing before potentially getting
+            # a new one
+            self.session_check_reset()
+            # New groups aren't stored until they're set below
+            with time_stage('storage_get'):
+                self.phrase_group_cached = phrase_storage.get_phrase_group(
+                    self.session_uuid
+                )
+        return self.phrase_group_cached
 
     @phrase_group.setter
     def phrase_group(self, value):
         # Check if the phrase group is missing before potentially creating a
         # new one
         self.session_check_reset()
-        phrase_storage.set_phrase_group(self.session_uuid, value)
+        with time_stage('storage_set'):
+            phrase_storage.set_phrase_group(self.session_uuid, value)
+        self.phrase_group_cached = value
+        # From now on, a missing group means it was lost
+        self.request.session['phrase_group_saved'] = True
 
     @property
     def msgs(self):
@@ -122,17 +326,319 @@ class PhrasalViews(object):
     @msgs.setter
     def msgs(self, value):
         if isinstance(value, list):
-            log.debug("msgs: Storing list messages of {0}".format(value))
+            log.debug("msgs: Storing list messages of %s", value)
         else:
-            log.debug("msgs: Storing single messages of {0}".format(value))
+            log.debug("msgs: Storing single messages of %s", value)
             # Encapulsate the value in a list
             value = [ value ]
-        self.phrase_group['msgs'] = value
+        phrase_group = self.phrase_group
+        phrase_group['msgs'] = value
+        self.phrase_group = phrase_group
+
+    def get_output_count(self, phrase_set):
+        # Any trouble was already reported while building the phrases
+        output_count = phrase_executor.run([], count_phrase, phrase_set)
+        if output_count is None:
+            return None
+        return dict(
+            total=output_count.total,
+            total_text=format_output_count(output_count.total),
+            groups=[
+                format_output_count(group_count)
+                for group_count in output_count.groups
+            ]
+        )
+
+    @property
+    def api_params(self):
+        # Accept either a JSON body or regular form/query parameters
+        if self.request.content_type == 'application/json':
+            return self.request.json_body
+        return self.request.params.mixed()
+
+    @view_config(route_name='phrase_batch_api', renderer='json')
+    def phrase_batch_api(self):
+        try:
+            appstruct = PhraseBatchForm().deserialize(self.api_params)
+        except (colander.Invalid, ValueError) as e:
+            self.request.response.status = 400
+            if isinstance(e, colander.Invalid):
+                return dict(errors=e.asdict())
+            return dict(errors={'': 'Request body is not valid JSON'})
+
+        msgs = []
+        if appstruct['unique']:
+            seed, samples = phrase_executor.run(
+                msgs,
+                process_unique_phrase_batch,
+                appstruct['phrases'],
+                appstruct['count'],
+                appstruct['seed'],
+                timeout_result=(appstruct['seed'], [])
+            )
+        else:
+            seed, samples = phrase_executor.run(
+                msgs,
+                process_phrase_batch,
+                appstruct['phrases'],
+                appstruct['count'],
+                appstruct['seed'],
+                appstruct['seed_per_sample'],
+                timeout_result=(appstruct['seed'], [])
+            )
+        return dict(
+            seed=seed, count=len(samples), samples=samples,
+            messages=parse_messages(msgs)
+        )
+
+    @view_config(route_name='phrase_count_api', renderer='json')
+    def phrase_count_api(self):
+        try:
+            appstruct = PhraseCountForm().deserialize(self.api_params)
+        except (colander.Invalid, ValueError) as e:
+            self.request.response.status = 400
+            if isinstance(e, colander.Invalid):
+                return dict(errors=e.asdict())
+            return dict(errors={'': 'Request body is not valid JSON'})
+
+        msgs = []
+        output_count = phrase_executor.run(
+            msgs, count_phrase, appstruct['phrases']
+        )
+        if output_count is None:
+            self.request.response.status = 400
+            return dict(messages=parse_messages(msgs))
+        return dict(
+            total=format_json_count(output_count.total),
+            groups=[
+                format_json_count(group_count)
+                for group_count in output_count.groups
+            ],
+            messages=parse_messages(msgs)
+        )
+
+    @view_config(route_name='phrase_outputs_api', renderer='json')
+    def phrase_outputs_api(self):
+        # Outputs by index, see phrase_space.iter_phrase_outputs
+        try:
+            appstruct = PhraseOutputsForm().deserialize(self.api_params)
+        except (colander.Invalid, ValueError) as e:
+            self.request.response.status = 400
+            if isinstance(e, colander.Invalid):
+                return dict(errors=e.asdict())
+            return dict(errors={'': 'Request body is not valid JSON'})
+
+        msgs = []
+        start = appstruct['start']
+        step = appstruct['step']
+        total_count, outputs = phrase_executor.run(
+            msgs,
+            process_phrase_outputs,
+            appstruct['phrases'],
+            start,
+            appstruct['count'],
+            step,
+            timeout_result=(None, [])
+        )
+        if total_count is None:
+            self.request.response.status = 400
+            return dict(messages=parse_messages(msgs))
+
+        # Where to resume from, if anything's left
+        stop = start + appstruct['count'] * step
+        next_start = stop if stop < total_count else None
+        return dict(
+            total=format_json_count(total_count),
+            outputs=[
+                dict(output, index=format_json_count(output['index']))
+                for output in outputs
+            ],
+            next=format_json_count(next_start),
+            messages=parse_messages(msgs)
+        )
+
+    @view_config(route_name='phrase_stream_api')
+    def phrase_stream_api(self):
+        try:
+            appstruct = PhraseStreamForm().deserialize(self.api_params)
+        except colander.Invalid as e:
+            return Response(json_body=dict(errors=e.asdict()), status=400)
+        except ValueError:
+            return Response(
+                json_body=dict(errors={'': 'Request body is not valid JSON'}),
+                status=400
+            )
+
+        msgs = []
+        compiled_phrase = load_compiled_phrase(msgs, appstruct['phrases'])
+        if compiled_phrase is None:
+            return Response(
+                json_body=dict(messages=parse_messages(msgs)), status=400
+            )
+
+        # Text lines can't show choices
+        annotate = appstruct['annotate'] and appstruct['format'] == 'ndjson'
+        # Sent as it's made, so running out stops the stream early instead
+        time_limit = make_work_budget('stream')
+        if appstruct['unique']:
+            seed = get_batch_seed(appstruct['seed'], True)
+            samples = iter_unique_phrase_samples(
+                compiled_phrase,
+                appstruct['count'],
+                random.Random(seed),
+                time_limit,
+                annotate
+            )
+        else:
+            # Always seeded, so any stream can be repeated
+            seed = get_batch_seed(appstruct['seed'], True)
+            samples = iter_phrase_samples(
+                compiled_phrase,
+                appstruct['count'],
+                seed,
+                appstruct['seed_per_sample'],
+                time_limit,
+                annotate
+            )
+        samples = iter_limited_samples(msgs, time_limit, samples)
+        if appstruct['format'] == 'ndjson':
+            content_type = 'application/x-ndjson'
+        else:
+            content_type = 'text/plain'
+        response = Response(
+            app_iter=encode_phrase_stream(
+                samples, appstruct['format'], msgs
+            ),
+            content_type=content_type,
+            charset='utf-8'
+        )
+        # Let clients repeat the stream, even if no seed was given
+        response.headers['X-Phrase-Seed'] = seed
+        return response
+
+    def get_job_info(self, job_state):
+        # What clients are told about a job
+        job_id = job_state['id']
+        return dict(
+            id=job_id,
+            status=job_state['status'],
+            done=job_state['done'],
+            total=format_json_count(job_state['total']),
+            seed=job_state['params']['seed'],
+            messages=job_state['messages'],
+            status_url=self.request.route_url(
+                'phrase_job_api', job_id=job_id
+            ),
+            result_url=self.request.route_url(
+                'phrase_job_result_api', job_id=job_id
+            )
+        )
+
+    def get_jobs_disabled(self):
+        self.request.response.status = 503
+        return dict(errors={'': 'Background jobs are not enabled'})
+
+    def get_job_missing(self):
+        self.request.response.status = 404
+        return dict(errors={'': 'No such job, or it expired'})
+
+    @view_config(
+        route_name='phrase_jobs_api', request_method='POST', renderer='json'
+    )
+    def phrase_job_submit_api(self):
+        # Start a background job, see phrase_jobs
+        if not phrase_jobs.enabled:
+            return self.get_jobs_disabled()
+        try:
+            appstruct = PhraseJobForm().deserialize(self.api_params)
+        except (colander.Invalid, ValueError) as e:
+            self.request.response.status = 400
+            if isinstance(e, colander.Invalid):
+                return dict(errors=e.asdict())
+            return dict(errors={'': 'Request body is not valid JSON'})
+
+        outputs = appstruct.pop('outputs')
+        unique = appstruct.pop('unique')
+        if outputs:
+            appstruct['kind'] = JOB_OUTPUTS
+        elif unique:
+            appstruct['kind'] = JOB_UNIQUE
+        else:
+            appstruct['kind'] = JOB_SAMPLES
+        job_state = phrase_jobs.submit_job(appstruct)
+        self.request.response.status = 202
+        return self.get_job_info(job_state)
+
+    @view_config(
+        route_name='phrase_job_api', request_method='GET', renderer='json'
+    )
+    def phrase_job_status_api(self):
+        if not phrase_jobs.enabled:
+            return self.get_jobs_disabled()
+        job_state = phrase_jobs.get_job_state(
+            self.request.matchdict['job_id']
+        )
+        if job_state is None:
+            return self.get_job_missing()
+        return self.get_job_info(job_state)
+
+    @view_config(
+        route_name='phrase_job_api', request_method='DELETE', renderer='json'
+    )
+    def phrase_job_cancel_api(self):
+        # Stops the job if it's not done yet; finished jobs are kept until
+        # they expire either way
+        if not phrase_jobs.enabled:
+            return self.get_jobs_disabled()
+        job_state = phrase_jobs.cancel_job(self.request.matchdict['job_id'])
+        if job_state is None:
+            return self.get_job_missing()
+        return self.get_job_info(job_state)
+
+    @view_config(
+        route_name='phrase_job_result_api', request_method='GET',
+        renderer='json'
+    )
+    def phrase_job_result_api(self):
+        if not phrase_jobs.enabled:
+            return self.get_jobs_disabled()
+        job_id = self.request.matchdict['job_id']
+        job_state = phrase_jobs.get_job_state(job_id)
+        if job_state is None:
+            return self.get_job_missing()
+        result_path = phrase_jobs.get_job_result_path(job_id)
+        if result_path is None:
+            self.request.response.status = 409
+            return dict(
+                errors={'': 'The job is {0}'.format(job_state['status'])}
+            )
+        if job_state['params']['format'] == 'ndjson':
+            content_type = 'application/x-ndjson'
+        else:
+            content_type = 'text/plain'
+        response = FileResponse(
+            result_path, request=self.request, content_type=content_type
+        )
+        response.content_disposition = (
+            'attachment; filename="phrases-{0}{1}"'.format(
+                job_id, os.path.splitext(result_path)[1]
+            )
+        )
+        return response
 
     @view_config(route_name='phrasal_form_view', renderer='templates/phrase_generate_form.pt')
     def phrasal_form_view(self):
+        # Changes are read, made and saved in several steps, so don't let
+        # another request for the same group (e.g. a double-click) get in
+        # between
+        if self.is_read_only and not self.has_session:
+            # Nothing to lock either
+            return self.process_form_view()
+        with phrase_storage.lock_phrase_group(self.session_uuid):
+            return self.process_form_view()
+
+    def process_form_view(self):
         phrase_group = self.phrase_group
-        phrase_form = self.phrase_form
 
         if 'POST' in self.request.method:
             # If posting, no data would've been persisted anyways
@@ -151,16 +657,19 @@ class PhrasalViews(object):
                     "Welcome back!"
                 )
             )
+            self.phrase_group = phrase_group
             self.session_was_lost = False
 
         if 'clear' in self.request.params:
             log.debug(
-                "phrasal_form_view: Clearing UUID {0}"
-                .format(self.session_uuid)
+                "phrasal_form_view: Clearing UUID %s",
+                self.session_uuid
             )
             phrase_group['seed'] = ''
             phrase_group['phrases'] = ''
             phrase_group['results'] = ''
+            phrase_group['output_count'] = None
+            self.phrase_group = phrase_group
             # Shift focus to the form
             url = self.request.route_url(
                 'phrasal_form_view', _anchor='form'
@@ -168,12 +677,13 @@ class PhrasalViews(object):
             return HTTPFound(url)
         elif 'demo' in self.request.params:
             log.debug(
-                "phrasal_form_view: Resetting UUID {0} to demo"
-                .format(self.session_uuid)
+                "phrasal_form_view: Resetting UUID %s to demo",
+                self.session_uuid
             )
             phrase_group['seed'] = ''
             phrase_group['phrases'] = PhraseStorage.get_demo_phrase_source()
             phrase_group['results'] = ''
+            phrase_group['output_count'] = None
             self.msgs.append(
                 OpMessage(
                     MessageType.Info,
@@ -182,6 +692,7 @@ class PhrasalViews(object):
                     "Demo ready"
                 )
             )
+            self.phrase_group = phrase_group
             # Shift focus to the form
             url = self.request.route_url(
                 'phrasal_form_view', _anchor='form'
@@ -190,10 +701,14 @@ class PhrasalViews(object):
         elif 'submit' in self.request.params:
             controls = self.request.POST.items()
             try:
-                appstruct = phrase_form.validate(controls)
+                # Errors are kept on the form, so don't use a shared one
+                with time_stage('form_validate'):
+                    appstruct = build_phrase_form().validate(controls)
             except deform.ValidationFailure as e:
                 return dict(
                     phrase_group=phrase_group,
+                    results=phrase_group['results'],
+                    results_html=self.get_results_html(phrase_group),
                     form=e.render()
                 )
 
@@ -201,16 +716,26 @@ class PhrasalViews(object):
             phrase_group['seed'] = appstruct['seed']
             phrase_group['phrases'] = appstruct['phrases']
             # Process the source, get the results
-            phrase_group['results'] = (
-                process_phrase(
-                    self.msgs,
-                    phrase_group['phrases'],
-                    phrase_group['seed']
-                )
+            chosen_phrases = phrase_executor.run(
+                self.msgs,
+                process_phrase,
+                phrase_group['phrases'],
+                phrase_group['seed'],
+                timeout_result=[]
             )
+            # Kept packed until shown, see phrase_results
+            with time_stage('pack'):
+                phrase_group['results'] = pack_phrase_results(chosen_phrases)
+            # New results get rendered again, see get_results_html
+            phrase_group['results_time'] = time.time()
+            # Already compiled above, so counting is cheap
+            with time_stage('count'):
+                phrase_group['output_count'] = self.get_output_count(
+                    phrase_group['phrases']
+                )
             log.debug(
-                "phrasal_form_view: Updating UUID {0}, new group {1}"
-                .format(self.session_uuid, phrase_group)
+                "phrasal_form_view: Updating UUID %s, new group %s",
+                self.session_uuid, phrase_group
             )
             self.phrase_group = phrase_group
 
@@ -219,15 +744,31 @@ class PhrasalViews(object):
             )
             return HTTPFound(url)
 
-        form = phrase_form.render(phrase_group)
+        with time_stage('form_render'):
+            form = render_phrase_form(phrase_group)
 
         parsed_msgs = parse_messages(self.msgs)
         if parsed_msgs:
             log.debug(
-                "phrasal_form_view: parsed_msgs: '{0}'"
-                .format(parsed_msgs)
+                "phrasal_form_view: parsed_msgs: '%s'",
+                parsed_msgs
             )
 
         return dict(
-            phrase_group=phrase_group, parsed_msgs=parsed_msgs, form=form
+            phrase_group=phrase_group,
+            results=phrase_group['results'],
+            results_html=self.get_results_html(phrase_group),
+            parsed_msgs=parsed_msgs,
+            form=form
         )
+
+    def get_results_html(self, phrase_group):
+        # The results of recently viewed groups are only rendered once,
+        # instead of on every page view
+        if not phrase_group['results']:
+            return []
+        with time_stage('results_render'):
+            return rendered_results_cache.get_results_html(
+                (str(phrase_group['uid']), phrase_group.get('results_time')),
+                phrase_group['results']
+            )